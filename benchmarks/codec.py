@@ -0,0 +1,235 @@
+"""
+Micro-benchmark of the per-command protocol overhead, without any I/O.
+
+codec: encode + decode + sync/async dispatch. Compares the legacy code path
+(str.format + encode on every request, text based decode, per value syncer
+dispatch) with the current one (pre-encoded fixed commands, bytes based
+decode, dispatch decided per protocol).
+
+round trip: a full query (PFCU.shutter_status()) on an in-memory line which
+replies right away, async and sync. Compares the legacy protocol (a lock
+around connection.write_readline()) with the current one (bus scheduling,
+reply routing, statistics).
+
+Usage:
+
+    $ python benchmarks/codec.py [-n NUMBER]
+"""
+
+import argparse
+import asyncio
+import collections
+import threading
+import time
+import timeit
+
+from xia_pfcu import PFCU
+from xia_pfcu.protocol import (
+    REQ_HEADER,
+    PFCUError,
+    ShutterStatus,
+    Protocol,
+    decode,
+    decode_shutter_status,
+    syncer,
+)
+
+REPLY = b"%PFCU15 OK Shutter Closed DONE;\r\n"
+REPEAT = 5
+
+
+# legacy implementation (as of xia-pfcu 1.6.0)
+
+
+def legacy_encode(module, cmd):
+    return "{}{} {}\r".format(REQ_HEADER, module, cmd).encode()
+
+
+def legacy_decode(reply):
+    reply = reply.decode()
+    assert reply.startswith("%")
+    pfcu, result, text = reply.split(" ", 2)
+    result = "OK" if result == "OK" else "ERROR"
+    text = text.replace("DONE", "")
+    text = text.strip()
+    text = text.rstrip(";")
+    text = text.strip()
+    if result == "ERROR":
+        raise PFCUError(text)
+    return text
+
+
+@syncer
+def legacy_decode_shutter_status(status):
+    status = status.lower()
+    if "open" in status:
+        return ShutterStatus.Open
+    elif "closed" in status:
+        return ShutterStatus.Closed
+    raise PFCUError("Unexpected reply: {!r}".format(status))
+
+
+class LegacyAIOProtocol:
+    def __init__(self, connection, module):
+        self.conn = connection
+        self.module = module
+        self._last_command = 0
+        self._lock = asyncio.Lock()
+
+    async def write_readline(self, data):
+        data = legacy_encode(self.module, data)
+        wait = self._last_command - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            async with self._lock:
+                reply = await self.conn.write_readline(data)
+                if b"End of Exposure" in reply:
+                    reply = await self.conn.readline()
+            return legacy_decode(reply)
+        finally:
+            self._last_command = time.monotonic()
+
+
+class LegacyIOProtocol:
+    def __init__(self, connection, module):
+        self.conn = connection
+        self.module = module
+        self._last_command = 0
+        self._lock = threading.Lock()
+
+    def write_readline(self, data):
+        data = legacy_encode(self.module, data)
+        wait = self._last_command - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            with self._lock:
+                reply = self.conn.write_readline(data)
+                if b"End of Exposure" in reply:
+                    reply = self.conn.readline()
+            return legacy_decode(reply)
+        finally:
+            self._last_command = time.monotonic()
+
+
+# in-memory lines which reply right away
+
+
+class NullConnection:
+    is_open = True
+
+    def __init__(self):
+        self.frames = collections.deque()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def in_waiting(self):
+        return len(self.frames)
+
+    def write(self, data):
+        self.frames.append(REPLY)
+
+    def readline(self):
+        return self.frames.popleft()
+
+    def write_readline(self, data):
+        return REPLY
+
+
+class AIONullConnection(NullConnection):
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def write(self, data):
+        self.frames.append(REPLY)
+
+    async def readline(self):
+        return self.frames.popleft()
+
+    async def write_readline(self, data):
+        return REPLY
+
+
+def legacy():
+    legacy_encode("15", "H")
+    return legacy_decode_shutter_status(legacy_decode(REPLY))
+
+
+def current(protocol=Protocol(NullConnection(), module="15")):
+    protocol.encode("H")
+    return decode_shutter_status.func(decode(REPLY))
+
+
+def legacy_sync(number):
+    protocol = LegacyIOProtocol(NullConnection(), "15")
+
+    def run():
+        for _ in range(number):
+            legacy_decode_shutter_status(protocol.write_readline("H"))
+
+    return run
+
+
+def current_sync(number):
+    pfcu = PFCU(NullConnection(), module=15)
+
+    def run():
+        for _ in range(number):
+            pfcu.shutter_status()
+
+    return run
+
+
+def legacy_async(number):
+    async def run():
+        protocol = LegacyAIOProtocol(AIONullConnection(), "15")
+        for _ in range(number):
+            legacy_decode_shutter_status(await protocol.write_readline("H"))
+
+    return lambda: asyncio.run(run())
+
+
+def current_async(number):
+    async def run():
+        pfcu = PFCU(AIONullConnection(), module=15)
+        for _ in range(number):
+            await pfcu.shutter_status()
+
+    return lambda: asyncio.run(run())
+
+
+def report(name, func, number):
+    best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+    print("{:>14}: {:8.0f} ns/command".format(name, best / number * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--number", type=int, default=200_000)
+    args = parser.parse_args()
+    assert legacy() == current() == ShutterStatus.Closed
+    print("codec")
+    for name, func in (("legacy", legacy), ("current", current)):
+        best = min(timeit.repeat(func, number=args.number, repeat=REPEAT))
+        print("{:>14}: {:8.0f} ns/command".format(name, best / args.number * 1e9))
+    print("round trip")
+    number = max(args.number // 10, 1)
+    for name, factory in (
+        ("legacy async", legacy_async),
+        ("current async", current_async),
+        ("legacy sync", legacy_sync),
+        ("current sync", current_sync),
+    ):
+        report(name, factory(number), number)
+
+
+if __name__ == "__main__":
+    main()
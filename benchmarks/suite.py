@@ -0,0 +1,425 @@
+"""
+End-to-end benchmark against the PFCU simulator.
+
+Starts a xia_pfcu.simulator.PFCU on a local TCP port (sinstruments server
+in a sub-process) and drives it with N concurrent clients, either async
+(one asyncio task and connection per client) or threaded (one thread and
+connection per client), with a command profile. Each client drives its
+own simulated module (client i: module i, up to 16 clients) so that the
+End of Exposure of one client doesn't end the exposure of another:
+
+* status: status polling (S)
+* filters: insert/remove a filter followed by a filters status (W, F)
+* exposure: short exposure until the device reports its end (D, E)
+* mixed: a random mix of the above (mostly status polling)
+
+Reports the throughput and the p50/p95/p99 latency of each operation and
+writes the results to a JSON file so that runs can be compared.
+
+It can also replay a wire capture of a real session (see xia_pfcu.wire)
+through the bus, to benchmark protocol changes against real traffic.
+
+Usage:
+
+    $ python benchmarks/suite.py [-c CLIENTS] [-d DURATION] [-t TIMING] [-o FILE]
+    $ python benchmarks/suite.py --replay session.wire [--speed SPEED]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from connio import connection_for_url
+
+import xia_pfcu
+from xia_pfcu import PFCU, Bus
+from xia_pfcu.protocol import REQ_HEADER, command_code
+from xia_pfcu.wire import WRITE, Replay, read_capture
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EOL = b";\r\n"
+MODULE = 15
+MAX_CLIENTS = 16  # one module per client
+EXPOSURE = 0.01
+MIX = (("status", 6), ("filters", 3), ("exposure", 1))
+PROFILES = ("status", "filters", "exposure", "mixed")
+CONCURRENCIES = ("async", "sync")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class Simulator:
+    """PFCU simulator running in a sinstruments server sub-process"""
+
+    def __init__(self, port=None, **opts):
+        self.port = port or free_port()
+        self.opts = opts
+        self.process = None
+        self.directory = None
+
+    @property
+    def url(self):
+        return "tcp://localhost:{}".format(self.port)
+
+    def config(self):
+        device = {
+            "class": "PFCU",
+            "name": "pfcu-bench",
+            "package": "xia_pfcu.simulator",
+            "module_id": MODULE,
+            "shutter_mode": True,
+            "transports": [{"type": "tcp", "url": ":{}".format(self.port)}],
+        }
+        device.update(self.opts)
+        return {"devices": [device]}
+
+    def start(self, timeout=10):
+        self.directory = tempfile.TemporaryDirectory(prefix="xia-pfcu-bench-")
+        config = os.path.join(self.directory.name, "simulator.json")
+        with open(config, "w") as fobj:
+            json.dump(self.config(), fobj)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            path for path in (ROOT, env.get("PYTHONPATH")) if path
+        )
+        cmd = [sys.executable, "-m", "sinstruments", "-c", config]
+        self.process = subprocess.Popen(cmd, env=env)
+        start = time.monotonic()
+        while time.monotonic() - start < timeout:
+            if self.process.poll() is not None:
+                code = self.process.returncode
+                raise RuntimeError("simulator exited with {}".format(code))
+            try:
+                socket.create_connection(("localhost", self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise TimeoutError("simulator not listening after {}s".format(timeout))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+def percentile(samples, q):
+    if samples:
+        return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+
+def summarize(samples, errors, elapsed):
+    """{operation: {count, errors, throughput, mean, p50, p95, p99}}"""
+    result = {}
+    for name in sorted(set(samples) | set(errors)):
+        values = sorted(samples.get(name, ()))
+        result[name] = dict(
+            count=len(values),
+            errors=errors.get(name, 0),
+            throughput=len(values) / elapsed,
+            mean=sum(values) / len(values) if values else None,
+            p50=percentile(values, 50),
+            p95=percentile(values, 95),
+            p99=percentile(values, 99),
+        )
+    return result
+
+
+def next_operation(profile, rng):
+    if profile != "mixed":
+        return profile
+    names, weights = zip(*MIX)
+    return rng.choices(names, weights)[0]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, start, error=None):
+        duration = time.perf_counter() - start
+        with self.lock:
+            if error is None:
+                self.samples.setdefault(name, []).append(duration)
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+# async clients
+
+
+async def aio_operation(pfcu, name, filt):
+    if name == "status":
+        await pfcu.status()
+    elif name == "filters":
+        await pfcu.insert_filter(filt)
+        await pfcu.filters_status()
+        await pfcu.remove_filter(filt)
+    elif name == "exposure":
+        await asyncio.wait_for(await pfcu.start_exposure(EXPOSURE), 5)
+
+
+async def aio_client(url, index, profile, deadline, recorder):
+    conn = connection_for_url(url, eol=EOL)
+    pfcu = PFCU(conn, module=index)
+    rng = random.Random(index)
+    try:
+        while time.monotonic() < deadline:
+            name = next_operation(profile, rng)
+            start = time.perf_counter()
+            try:
+                await aio_operation(pfcu, name, index % 4 + 1)
+            except Exception as error:
+                recorder.record(name, start, error)
+            else:
+                recorder.record(name, start)
+    finally:
+        await pfcu.protocol.bus.close()
+
+
+async def aio_run(url, clients, profile, duration, recorder):
+    deadline = time.monotonic() + duration
+    await asyncio.gather(
+        *[
+            aio_client(url, index, profile, deadline, recorder)
+            for index in range(clients)
+        ]
+    )
+
+
+def run_async(url, clients, profile, duration):
+    recorder = Recorder()
+    start = time.monotonic()
+    asyncio.run(aio_run(url, clients, profile, duration, recorder))
+    return recorder, time.monotonic() - start
+
+
+# threaded clients
+
+
+def io_operation(pfcu, name, filt):
+    if name == "status":
+        pfcu.status()
+    elif name == "filters":
+        pfcu.insert_filter(filt)
+        pfcu.filters_status()
+        pfcu.remove_filter(filt)
+    elif name == "exposure":
+        pfcu.start_exposure(EXPOSURE).result(5)
+
+
+def io_client(conn, index, profile, deadline, recorder):
+    pfcu = PFCU(conn, module=index)
+    rng = random.Random(index)
+    try:
+        while time.monotonic() < deadline:
+            name = next_operation(profile, rng)
+            start = time.perf_counter()
+            try:
+                io_operation(pfcu, name, index % 4 + 1)
+            except Exception as error:
+                recorder.record(name, start, error)
+            else:
+                recorder.record(name, start)
+    finally:
+        pfcu.protocol.bus.close()
+
+
+def run_sync(url, clients, profile, duration):
+    recorder = Recorder()
+    # sockio sync event loop is not thread safe to start: connect from here
+    conns = [
+        connection_for_url(url, eol=EOL, concurrency="sync") for _ in range(clients)
+    ]
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(
+            target=io_client,
+            args=(conn, index, profile, deadline, recorder),
+            name="PFCUBenchClient-{}".format(index),
+        )
+        for index, conn in enumerate(conns)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.monotonic() - start
+
+
+RUNNERS = {"async": run_async, "sync": run_sync}
+
+
+def run(url, clients, profiles, concurrencies, duration):
+    results = []
+    for concurrency in concurrencies:
+        for profile in profiles:
+            recorder, elapsed = RUNNERS[concurrency](url, clients, profile, duration)
+            operations = summarize(recorder.samples, recorder.errors, elapsed)
+            total = sum(op["count"] for op in operations.values())
+            results.append(
+                dict(
+                    concurrency=concurrency,
+                    profile=profile,
+                    clients=clients,
+                    elapsed=elapsed,
+                    throughput=total / elapsed,
+                    operations=operations,
+                )
+            )
+            print_result(results[-1])
+    return results
+
+
+# wire capture replay
+
+
+async def aio_replay(path, speed, recorder):
+    _, events = read_capture(path)
+    bus = Bus(Replay(events, speed=speed))
+    try:
+        for event in events:
+            if event.kind != WRITE:
+                continue
+            data, code = event.data, command_code(event.data)
+            module = data.split(b" ", 1)[0][len(REQ_HEADER) :].decode()
+            end = bus.expect_end_of_exposure(module) if code == "E" else None
+            start = time.perf_counter()
+            try:
+                await bus.write_readline(data, module)
+                if end is not None:
+                    await asyncio.wait_for(end, 60)
+            except Exception as error:
+                recorder.record(code, start, error)
+            else:
+                recorder.record(code, start)
+    finally:
+        await bus.close()
+
+
+def run_replay(path, speed):
+    recorder = Recorder()
+    start = time.monotonic()
+    asyncio.run(aio_replay(path, speed, recorder))
+    elapsed = time.monotonic() - start
+    operations = summarize(recorder.samples, recorder.errors, elapsed)
+    total = sum(op["count"] for op in operations.values())
+    result = dict(
+        concurrency="async",
+        profile="replay",
+        clients=1,
+        elapsed=elapsed,
+        throughput=total / elapsed,
+        operations=operations,
+    )
+    print_result(result)
+    return [result]
+
+
+def ms(value):
+    return "{:8.1f}".format(value * 1e3) if value is not None else "       -"
+
+
+def print_result(result):
+    print(
+        "{concurrency:>5} {profile:<8} {clients:3d} clients: "
+        "{throughput:8.1f} op/s".format(**result)
+    )
+    for name, op in result["operations"].items():
+        print(
+            "      {:<8} n={:<6d} err={:<4d} p50={}ms p95={}ms p99={}ms".format(
+                name, op["count"], op["errors"], ms(op["p50"]), ms(op["p95"]),
+                ms(op["p99"])
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-c", "--clients", type=int, default=4,
+        help="number of clients (1-16), each one driving its own module"
+    )
+    parser.add_argument(
+        "-d", "--duration", type=float, default=5.0, help="seconds per run"
+    )
+    parser.add_argument(
+        "-p", "--profile", action="append", choices=PROFILES, dest="profiles"
+    )
+    parser.add_argument(
+        "--concurrency", action="append", choices=CONCURRENCIES,
+        dest="concurrencies"
+    )
+    parser.add_argument(
+        "-t", "--timing", default="realistic",
+        help="simulator timing profile (realistic, zero-latency or jittery)"
+    )
+    parser.add_argument(
+        "--url",
+        help="use an already running simulator instead of starting one (it "
+        "must simulate the modules 0 to CLIENTS-1)"
+    )
+    parser.add_argument("--replay", help="replay the given wire capture")
+    parser.add_argument(
+        "--speed", type=float, default=0,
+        help="replay speed factor (default: 0, as fast as possible)"
+    )
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    args = parser.parse_args()
+    if not 0 < args.clients <= MAX_CLIENTS:
+        parser.error("clients must be between 1 and {}".format(MAX_CLIENTS))
+    profiles = args.profiles or PROFILES
+    concurrencies = args.concurrencies or CONCURRENCIES
+
+    if args.replay:
+        results = run_replay(args.replay, args.speed)
+    elif args.url:
+        results = run(args.url, args.clients, profiles, concurrencies, args.duration)
+    else:
+        modules = list(range(args.clients))
+        with Simulator(timing=args.timing, modules=modules) as simulator:
+            results = run(
+                simulator.url, args.clients, profiles, concurrencies, args.duration
+            )
+    report = dict(
+        version=xia_pfcu.__version__,
+        timing=None if args.url or args.replay else args.timing,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        results=results,
+    )
+    with open(args.output, "w") as fobj:
+        json.dump(report, fobj, indent=2)
+    print("results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
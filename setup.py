@@ -11,7 +11,8 @@ with open("README.md") as f:
 
 extras_require={
     "tango": ["pytango"],
-    "simulator": ["sinstruments>=1.3"]
+    "simulator": ["sinstruments>=1.3"],
+    "timeline": ["numpy"],
 }
 
 extras_require["all"] = list(
@@ -29,6 +30,8 @@ setup(
     entry_points={
         "console_scripts": [
             "PFCU = xia_pfcu.tango.server:main [tango]",
+            # (not "pfcu": it would clash with "PFCU" on case insensitive file systems)
+            "xia-pfcu = xia_pfcu.cli:main",
         ],
         'sinstruments.device': [
             'PFCU = xia_pfcu.simulator:PFCU [simulator]'
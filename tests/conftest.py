@@ -0,0 +1,11 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def simulator():
+    """Zero-latency simulator of modules 1, 2 and 5 on the same line"""
+    pytest.importorskip("sinstruments")
+    from launcher import Simulator
+
+    with Simulator(timing="zero-latency", modules=[1, 2, 5], settle_time=0.02) as sim:
+        yield sim
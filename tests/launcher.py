@@ -0,0 +1,85 @@
+"""
+Simulator (see xia_pfcu.simulator) served by sinstruments in a sub-process,
+on a free local TCP port.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class Simulator:
+    """PFCU simulator running in a sinstruments server sub-process"""
+
+    def __init__(self, **opts):
+        self.port = free_port()
+        self.opts = opts
+        self.process = None
+        self.directory = None
+
+    @property
+    def url(self):
+        return "tcp://localhost:{}".format(self.port)
+
+    def config(self):
+        device = {
+            "class": "PFCU",
+            "name": "pfcu-test",
+            "package": "xia_pfcu.simulator",
+            "shutter_mode": True,
+            "transports": [{"type": "tcp", "url": ":{}".format(self.port)}],
+        }
+        device.update(self.opts)
+        return {"devices": [device]}
+
+    def start(self, timeout=10):
+        self.directory = tempfile.TemporaryDirectory(prefix="xia-pfcu-test-")
+        config = os.path.join(self.directory.name, "simulator.json")
+        with open(config, "w") as fobj:
+            json.dump(self.config(), fobj)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            path for path in (ROOT, env.get("PYTHONPATH")) if path
+        )
+        cmd = [sys.executable, "-m", "sinstruments", "-c", config]
+        self.process = subprocess.Popen(cmd, env=env)
+        start = time.monotonic()
+        while time.monotonic() - start < timeout:
+            if self.process.poll() is not None:
+                code = self.process.returncode
+                raise RuntimeError("simulator exited with {}".format(code))
+            try:
+                socket.create_connection(("localhost", self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise TimeoutError("simulator not listening after {}s".format(timeout))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
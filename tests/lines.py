@@ -0,0 +1,156 @@
+"""
+In-memory lines (async and sync) with the connio interface used by the bus.
+
+Each request written is answered by the responder (a function of the raw
+request returning the list of frames the modules send back). Frames can
+also be pushed at any time (ex: an End of Exposure message).
+"""
+
+import asyncio
+import queue
+import time
+
+TEXTS = {
+    "H": "Shutter Open",
+    "O": "Shutter Open",
+    "C": "Shutter Closed",
+    "F": "0010",
+    "W": "0010",
+    "I": "0010",
+    "R": "0010",
+    "Z": "0010",
+    "D": "Decimation = {}",
+    "E": "Exposure Started",
+    "S": "PFCU v1.0\r\nExposure Decimation: 1",
+    "L": "Locked",
+    "U": "Unlocked",
+    "2": "Shutter mode enabled",
+    "4": "Shutter mode disabled",
+}
+
+
+def frame(module, text, result="OK"):
+    return "%PFCU{} {} {} DONE;\r\n".format(module, result, text).encode()
+
+
+def request(data):
+    """(module, cmd) of a raw request (ex: b"!PFCU01 D 3\r" -> ("01", "D 3"))"""
+    module, cmd = data.decode()[5:].strip().split(" ", 1)
+    return module, cmd
+
+
+def device(modules=("01", "02", "15")):
+    """Responder of the given modules (broadcasts are answered by all)"""
+
+    def respond(data):
+        module, cmd = request(data)
+        text = TEXTS[cmd[:1]].format(*cmd.split()[1:])
+        targets = modules if module == "ALL" else [module]
+        return [frame(target, text) for target in targets if target in modules]
+
+    return respond
+
+
+class BaseLine:
+    def __init__(self, respond=None, delay=0.0):
+        self.respond = respond or device()
+        self.delay = delay
+        self.written = []
+        self.is_open = True
+        self.opens = self.closes = 0
+
+    def _replies(self, data):
+        self.written.append(data)
+        return self.respond(data) or []
+
+
+class AIOLine(BaseLine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._frames = None
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = asyncio.Queue()
+        return self._frames
+
+    def push(self, frame):
+        self.frames.put_nowait(frame)
+
+    def in_waiting(self):
+        return self.frames.qsize()
+
+    async def open(self):
+        self.opens += 1
+        self.is_open = True
+
+    async def close(self):
+        self.closes += 1
+        self.is_open = False
+        # (unblocks a pending readline; unread frames are lost)
+        self.frames.put_nowait(None)
+        self._frames = asyncio.Queue()
+
+    async def write(self, data):
+        for reply in self._replies(data):
+            self.push(reply)
+
+    async def readline(self):
+        # (as a stream reader, a cancelled readline doesn't lose the frame)
+        await asyncio.sleep(self.delay)
+        frame = await self.frames.get()
+        if frame is None:
+            raise ConnectionResetError("closed")
+        return frame
+
+    async def write_readline(self, data):
+        await self.write(data)
+        return await self.readline()
+
+
+class IOLine(BaseLine):
+    def __init__(self, *args, write_time=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_time = write_time
+        self.frames = queue.Queue()
+
+    def push(self, frame):
+        self.frames.put(frame)
+
+    def in_waiting(self):
+        return self.frames.qsize()
+
+    def open(self):
+        self.opens += 1
+        self.is_open = True
+
+    def close(self):
+        self.closes += 1
+        self.is_open = False
+        # (unblocks a pending readline; unread frames are lost)
+        self.frames.put(None)
+        self.frames = queue.Queue()
+
+    def write(self, data):
+        for reply in self._replies(data):
+            self.push(reply)
+        # (slow line: the reply may arrive before write() returns)
+        time.sleep(self.write_time)
+
+    def readline(self):
+        frame = self.frames.get()
+        if frame is None:
+            raise ConnectionResetError("closed")
+        time.sleep(self.delay)
+        return frame
+
+    def write_readline(self, data):
+        self.write(data)
+        return self.readline()
+
+
+def count(bus, name):
+    """Total of the given stats counter of the bus (ex: "discarded")"""
+    counters = bus.stats.counters
+    return sum(value for (counter, _, _), value in counters.items() if counter == name)
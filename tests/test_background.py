@@ -0,0 +1,36 @@
+import concurrent.futures
+
+import pytest
+
+from xia_pfcu import BackgroundLoop, FilterStatus, PFCUError, ShutterStatus
+
+EOL = b";\r\n"
+
+
+def test_background_loop(simulator):
+    with BackgroundLoop(eol=EOL) as loop:
+        devices = [loop.pfcu((simulator.url, module)) for module in (1, 2, 5)]
+        # modules on the same line share the bus
+        assert len(loop.buses) == 1
+        futures = [device.close_shutter() for device in devices]
+        assert all(isinstance(f, concurrent.futures.Future) for f in futures)
+        loop.gather(futures, timeout=5)
+        statuses = loop.gather([device.shutter_status() for device in devices])
+        assert statuses == [ShutterStatus.Closed] * 3
+        assert "Exposure Decimation" in devices[0].wait.status()
+        with devices[1].filter_changes(wait=True) as changes:
+            changes.insert(2)
+        assert changes.result.result(5)[1] == FilterStatus.In
+        end = devices[2].start_exposure(0.01).result(5)
+        assert "End of Exposure" in end.result(5)
+
+
+def test_gather_errors(simulator):
+    with BackgroundLoop(eol=EOL) as loop:
+        device = loop.pfcu(simulator.url, module=1)
+        futures = [device.write_readline("X"), device.shutter_status()]
+        with pytest.raises(PFCUError):
+            loop.gather(futures, timeout=5)
+        results = loop.gather(futures, timeout=5, return_exceptions=True)
+        assert isinstance(results[0], PFCUError)
+        assert isinstance(results[1], ShutterStatus)
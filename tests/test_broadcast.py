@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus, PFCUError
+
+from lines import AIOLine, IOLine, count, device, frame, request
+
+
+def faulty(modules):
+    """Responder of modules where module 07 replies errors"""
+    answer = device(modules)
+
+    def respond(data):
+        return [
+            frame("07", "Bad command", result="ERROR") if b"%PFCU07" in f else f
+            for f in answer(data)
+        ]
+
+    return respond
+
+
+def test_expected_modules():
+    async def main():
+        line = AIOLine(device(("01", "02", "15")))
+        bus = Bus(line)
+        result = await bus.pfcu("ALL").broadcast("filters_status", modules=[1, 2, 15])
+        return bus, result
+
+    bus, result = asyncio.run(main())
+    assert sorted(result) == ["01", "02", "15"]
+    assert all(len(status) == 4 for status in result.values())
+    assert count(bus, "resyncs") == 0
+
+
+@pytest.mark.parametrize("line_type", [AIOLine, IOLine])
+def test_collects_unknown_modules(line_type):
+    line = line_type(faulty(("01", "02", "07")))
+    bus = Bus(line)
+    bus.pfcu(1)  # the only module known on the line
+
+    async def main():
+        result = await bus.pfcu("ALL").broadcast("shutter_status")
+        # the line is clean for the next command
+        return result, await bus.pfcu(2).shutter_status()
+
+    if line_type is AIOLine:
+        result, status = asyncio.run(main())
+    else:
+        try:
+            result = bus.pfcu("ALL").broadcast("shutter_status")
+            status = bus.pfcu(2).shutter_status()
+        finally:
+            bus.close()
+    assert sorted(result) == ["01", "02", "07"]
+    assert isinstance(result["07"], PFCUError)
+    assert status == result["02"]
+    assert count(bus, "discarded") == 0
+    assert count(bus, "resyncs") == 0
+
+
+def test_missing_module_returns_at_deadline():
+    async def main():
+        line = AIOLine(device(("01", "02")))
+        bus = Bus(line)
+        bus.latency.DEFAULT_TIMEOUT = 0.1
+        result = await bus.pfcu("ALL").broadcast("filters_status", modules=[1, 2, 3])
+        return line, result, await bus.pfcu(1).write_readline("L")
+
+    line, result, reply = asyncio.run(main())
+    assert sorted(result) == ["01", "02"]
+    assert reply == "Locked"
+    assert request(line.written[-1]) == ("01", "L")
@@ -0,0 +1,153 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from xia_pfcu import Bus, Priority
+from xia_pfcu.protocol import encode
+
+from lines import AIOLine, IOLine, count, frame, request
+
+
+def commands(line):
+    return [request(data) for data in line.written]
+
+
+async def in_flight(coro, line):
+    """Start coro and return its task once its command is on the line"""
+    sent = len(line.written)
+    task = asyncio.ensure_future(coro)
+    while len(line.written) == sent:
+        await asyncio.sleep(0.001)
+    return task
+
+
+def test_round_robin_between_modules():
+    async def main():
+        line = AIOLine(delay=0.01)
+        bus = Bus(line)
+        send = [bus.write_readline(encode(m, "F"), m) for m in ("01",) * 4 + ("02",)]
+        first = await in_flight(send[0], line)
+        await asyncio.gather(first, *send[1:])
+        return [module for module, _ in commands(line)]
+
+    # the command of module 02 doesn't wait for all the queued ones of 01
+    assert asyncio.run(main()) == ["01", "01", "02", "01", "01"]
+
+
+def test_modules_share_the_line():
+    async def main():
+        line = AIOLine()
+        bus = Bus(line)
+        pfcus = [bus.pfcu(module) for module in (1, 2, 15)]
+        assert bus.pfcu(2) is pfcus[1]
+        return await asyncio.gather(
+            *[pfcu.write_readline("L") for pfcu in pfcus for _ in range(3)]
+        )
+
+    assert asyncio.run(main()) == ["Locked"] * 9
+
+
+def test_sync_modules_share_the_line():
+    line = IOLine()
+    bus = Bus(line)
+    pfcus = [bus.pfcu(module) for module in (1, 2, 15)]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(6) as pool:
+            replies = list(
+                pool.map(lambda pfcu: pfcu.write_readline("L"), pfcus * 10)
+            )
+    finally:
+        bus.close()
+    assert replies == ["Locked"] * 30
+    assert sorted(set(commands(line))) == [("01", "L"), ("02", "L"), ("15", "L")]
+
+
+def test_end_of_exposure():
+    async def main():
+        line = AIOLine()
+        bus = Bus(line)
+        p1, p15 = bus.pfcu(1), bus.pfcu(15)
+        end1 = await p1.start_exposure(0.01)
+        end15 = await p15.start_exposure(0.01)
+        line.push(frame("15", "End of Exposure"))
+        await asyncio.wait_for(asyncio.shield(end15), 1)
+        # the end of another module doesn't end this exposure
+        assert not end1.done()
+        # replies are still routed while exposures are running
+        assert await p1.write_readline("L") == "Locked"
+        line.push(frame("01", "End of Exposure"))
+        await asyncio.wait_for(end1, 1)
+        return end1.result(), end15.result()
+
+    end1, end15 = asyncio.run(main())
+    assert "01" in end1 and "End of Exposure" in end1
+    assert "15" in end15
+
+
+def test_sync_slow_write_during_exposure():
+    # the reply arrives before write() returns, while the reader polls the
+    # line for the end of the exposure
+    line = IOLine(write_time=0.02)
+    bus = Bus(line)
+    pfcu = bus.pfcu(15)
+    try:
+        end = pfcu.start_exposure(0.05)
+        for _ in range(5):
+            assert pfcu.write_readline("L") == "Locked"
+        assert not end.done()
+        threading.Timer(0.01, line.push, [frame("15", "End of Exposure")]).start()
+        assert "End of Exposure" in end.result(timeout=1)
+    finally:
+        bus.close()
+    assert count(bus, "timeouts") == 0
+
+
+def test_identical_queries_are_shared():
+    async def main():
+        line = AIOLine(delay=0.01)
+        pfcu = Bus(line).pfcu(15)
+        replies = await asyncio.gather(*[pfcu.shutter_status() for _ in range(3)])
+        return line, pfcu.protocol.bus, replies
+
+    line, bus, replies = asyncio.run(main())
+    assert len(set(replies)) == 1
+    assert commands(line) == [("15", "H")]
+    assert count(bus, "shared") == 2
+
+
+def test_sync_identical_queries_are_shared():
+    line = IOLine(delay=0.05)
+    bus = Bus(line)
+    pfcu = bus.pfcu(15)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(3) as pool:
+            replies = list(pool.map(lambda _: pfcu.shutter_status(), range(3)))
+    finally:
+        bus.close()
+    assert len(set(replies)) == 1
+    assert len(line.written) + count(bus, "shared") == 3
+    assert len(line.written) < 3
+
+
+def test_priority():
+    async def main():
+        line = AIOLine(delay=0.01)
+        bus = Bus(line)
+        p1, p2 = bus.pfcu(1), bus.pfcu(2)
+        first = await in_flight(p1.filters_status(), line)
+        await asyncio.gather(
+            first,
+            p2.filters_status(),
+            p2.shutter_status(),
+            p1.close_shutter(),
+            p2.write_readline("L", priority=Priority.Safety),
+        )
+        return commands(line)
+
+    assert asyncio.run(main()) == [
+        ("01", "F"),
+        ("01", "C"),  # Safety by default
+        ("02", "L"),  # Safety by request
+        ("02", "F"),
+        ("02", "H"),
+    ]
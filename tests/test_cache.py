@@ -0,0 +1,69 @@
+import asyncio
+
+from xia_pfcu import Bus
+from xia_pfcu.protocol import ReplyCache
+
+from lines import AIOLine, count
+
+
+def test_queries_without_ttl_keep_the_cache():
+    cache = ReplyCache(dict(shutter_status=10))
+    cache.update("H", "Shutter Open")
+    cache.update("F", "0010")
+    cache.update("S", None)  # failed query
+    assert cache.get("H") == "Shutter Open"
+    assert cache.get("F") is None  # not cached
+
+
+def test_commands_invalidate_the_cache():
+    cache = ReplyCache(10)
+    cache.update("H", "Shutter Open")
+    cache.update("F", "0010")
+    cache.update("L", "Locked")
+    assert cache.get("H") is None and cache.get("F") is None
+    cache.update("F", "0010")
+    cache.update("D 3", None)  # failed command
+    assert cache.get("F") is None
+
+
+def test_commands_update_the_cache():
+    cache = ReplyCache(10)
+    cache.update("F", "0010")
+    cache.update("C", "Shutter Closed")
+    assert cache.get("H") == "Shutter Closed"
+    # (other state is no longer known)
+    assert cache.get("F") is None
+    cache.update("O", "Shutter Open")
+    assert cache.get("H") == "Shutter Open"
+    # (the reply of W tells the positions before the filters move)
+    cache.update("W 1===", "0010")
+    assert cache.get("F") is None
+    assert cache.get("H") is None
+
+
+def test_protocol_cache():
+    async def main():
+        line = AIOLine()
+        bus = Bus(line)
+        pfcu = bus.pfcu(1, cache=10)
+        other = bus.pfcu(2, cache=10)
+        await pfcu.filters_status()
+        await pfcu.filters_status()
+        assert len(line.written) == 1 and count(bus, "cache_hits") == 1
+        # the reply of close tells the shutter status
+        await pfcu.close_shutter()
+        await pfcu.shutter_status()
+        assert len(line.written) == 2
+        # but the reply of a filter change doesn't tell the filters status
+        await pfcu.insert_filter(1)
+        await pfcu.filters_status()
+        assert len(line.written) == 4
+        await other.filters_status()
+        # a broadcast command invalidates the cache of every module
+        await bus.pfcu("ALL").broadcast("lock")
+        written = len(line.written)
+        await pfcu.shutter_status()
+        await other.filters_status()
+        assert len(line.written) == written + 2
+
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+import asyncio
+import os
+import stat
+
+import pytest
+
+from xia_pfcu.cli import CommandError, Daemon, Remote, parse_line
+
+
+def test_parse_line():
+    assert parse_line("insert a  # comment", 1) == ("01", "insert", ["a"])
+    assert parse_line("@2 remove 1", 1) == ("02", "remove", ["1"])
+    assert parse_line("  # nothing", 1) is None
+
+
+def test_daemon(simulator, tmp_path):
+    path = str(tmp_path / "pfcu.sock")
+
+    async def main():
+        daemon = Daemon(simulator.url, path)
+        server = asyncio.ensure_future(daemon.serve())
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        remote = Remote(path)
+        try:
+            shutter = await remote.run("01", "shutter", [])
+            with pytest.raises(CommandError):
+                await remote.run("01", "bad", [])
+        finally:
+            await remote.close()
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+        return mode, shutter
+
+    mode, shutter = asyncio.run(main())
+    # only the owner can drive the line
+    assert mode & 0o077 == 0
+    assert shutter in ("Open", "Closed")
+    assert not os.path.exists(path)
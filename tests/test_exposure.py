@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus, PFCUError
+from xia_pfcu.protocol import (
+    EXPOSURE_TICK,
+    MAX_DECIMATION,
+    MAX_EXPOSURE,
+    sec_to_exposure_decimation,
+)
+
+from lines import AIOLine, device, frame, request
+
+
+def best_error(ticks):
+    return min(
+        abs(min(round(ticks / d), MAX_EXPOSURE) * d - ticks)
+        for d in range(1, MAX_DECIMATION + 1)
+    )
+
+
+@pytest.mark.parametrize(
+    "sec", [0, 0.01, 0.5, 1.234, 655.35, 700.01, 1234.567, 9999.99]
+)
+def test_least_quantization_error(sec):
+    exposure, decimation = sec_to_exposure_decimation(sec)
+    assert 0 <= exposure <= MAX_EXPOSURE
+    assert 1 <= decimation <= MAX_DECIMATION
+    ticks = sec / EXPOSURE_TICK
+    error = abs(exposure * decimation - ticks)
+    assert error == pytest.approx(best_error(ticks), abs=1e-6)
+
+
+def test_range():
+    assert sec_to_exposure_decimation(0.5) == (50, 1)
+    longest = MAX_EXPOSURE * MAX_DECIMATION * EXPOSURE_TICK
+    assert sec_to_exposure_decimation(longest) == (MAX_EXPOSURE, MAX_DECIMATION)
+    for sec in (-1, longest + 1):
+        with pytest.raises(ValueError):
+            sec_to_exposure_decimation(sec)
+
+
+def test_current_decimation_is_kept():
+    # 2s: 200 x 1 or 100 x 2 are as good
+    assert sec_to_exposure_decimation(2) == (200, 1)
+    assert sec_to_exposure_decimation(2, decimation=2) == (100, 2)
+    # unless another one is better
+    assert sec_to_exposure_decimation(0.03, decimation=2) == (3, 1)
+
+
+def exposures(modules=("01",)):
+    """Responder which ends every exposure right away"""
+    answer = device(modules)
+
+    def respond(data):
+        module, cmd = request(data)
+        replies = answer(data)
+        if cmd.startswith("E"):
+            replies.append(frame(module, "End of Exposure"))
+        return replies
+
+    return respond
+
+
+def sent(line):
+    return [cmd for _, cmd in map(request, line.written)]
+
+
+def test_decimation_is_only_sent_when_it_changes():
+    async def main():
+        line = AIOLine(exposures())
+        pfcu = Bus(line).pfcu(1)
+        for duration in (0.5, 0.3, 2, 1000):
+            await asyncio.wait_for(await pfcu.start_exposure(duration), 1)
+        return line, pfcu
+
+    line, pfcu = asyncio.run(main())
+    assert sent(line) == ["D 1", "E 50", "E 30", "E 200", "D 2", "E 50000"]
+    assert pfcu.protocol.decimation == 2
+
+
+def test_failed_decimation_is_forgotten():
+    def respond(data):
+        module, cmd = request(data)
+        if cmd.startswith("D"):
+            return [frame(module, "Invalid Decimation Value", result="ERROR")]
+        return exposures()(data)
+
+    async def main():
+        line = AIOLine(respond)
+        pfcu = Bus(line).pfcu(1)
+        with pytest.raises(PFCUError):
+            await pfcu.start_exposure(0.5)
+        return line, pfcu
+
+    line, pfcu = asyncio.run(main())
+    assert sent(line) == ["D 1"]
+    assert pfcu.protocol.decimation is None
+
+
+def test_exposure_sequence():
+    async def main():
+        line = AIOLine(exposures())
+        pfcu = Bus(line).pfcu(1)
+        durations = [d async for d in pfcu.protocol.exposure_sequence([0.1, 0.2, 0.2])]
+        return line, durations
+
+    line, durations = asyncio.run(main())
+    assert durations == pytest.approx([0.1, 0.2, 0.2])
+    assert sent(line) == ["D 1", "E 10", "E 20", "E 20"]
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus
+
+from lines import AIOLine, request
+
+
+def w_commands(line):
+    return [cmd for _, cmd in map(request, line.written) if cmd.startswith("W")]
+
+
+def test_concurrent_changes_are_coalesced():
+    async def main():
+        line = AIOLine()
+        pfcu = Bus(line).pfcu(1)
+        statuses = await asyncio.gather(
+            pfcu.insert_filter(1), pfcu.remove_filter("c"), pfcu.insert_filter(4)
+        )
+        return line, statuses
+
+    line, statuses = asyncio.run(main())
+    assert w_commands(line) == ["W 1=01"]
+    assert statuses[0] == statuses[1] == statuses[2]
+
+
+def test_conflicting_changes_are_sent_in_order():
+    async def main():
+        line = AIOLine()
+        pfcu = Bus(line).pfcu(1)
+        await asyncio.gather(pfcu.insert_filter(1), pfcu.remove_filter(1))
+        return line
+
+    assert w_commands(asyncio.run(main())) == ["W 1===", "W 0==="]
+
+
+def test_cancelled_change_is_dropped():
+    async def main():
+        line = AIOLine()
+        pfcu = Bus(line).pfcu(1)
+        pfcu.protocol.FILTER_WINDOW = 0.05
+        kept = asyncio.ensure_future(pfcu.insert_filter(1))
+        cancelled = asyncio.ensure_future(pfcu.insert_filter(4))
+        other = asyncio.ensure_future(pfcu.insert_filter(2))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.gather(kept, other)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        # a value asked for by another caller is kept
+        both = [asyncio.ensure_future(pfcu.remove_filter(3)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        both[0].cancel()
+        await both[1]
+        # nothing is sent if every caller is cancelled
+        alone = asyncio.ensure_future(pfcu.insert_filter(2))
+        await asyncio.sleep(0.01)
+        alone.cancel()
+        await asyncio.sleep(0.1)
+        return line
+
+    assert w_commands(asyncio.run(main())) == ["W 11==", "W ==0="]
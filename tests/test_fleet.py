@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import pytest
+
+from xia_pfcu import Fleet, ShutterStatus
+from xia_pfcu.protocol import PFCUConnectionError, PFCUTimeoutError
+
+from launcher import Simulator, free_port
+from lines import count
+
+EOL = b";\r\n"
+
+
+def test_async_fleet(simulator):
+    unreachable = "tcp://localhost:{}".format(free_port())
+
+    async def main():
+        devices = [(simulator.url, 1), (simulator.url, 2), (unreachable, 1)]
+        async with Fleet(devices, eol=EOL) as fleet:
+            assert len(fleet.buses) == 2
+            opened = await fleet.open()
+            assert set(opened.results) == {simulator.url}
+            assert set(opened.errors) == {unreachable}
+            # already open: nothing to do
+            assert (await fleet.open()).results == {simulator.url: None}
+            statuses = await fleet.shutter_statuses()
+            # the unreachable line fails fast (see LinkState): no new attempt
+            # to connect since the first open()
+            error = statuses.errors[unreachable + "#01"]
+            assert isinstance(error, PFCUConnectionError)
+            bus = fleet.buses[unreachable]
+            assert count(bus, "connect_errors") == 1
+            assert count(bus, "rejected") == 2
+            return statuses.results
+
+    results = asyncio.run(main())
+    assert sorted(results) == [simulator.url + "#01", simulator.url + "#02"]
+    assert set(results.values()) <= set(ShutterStatus)
+
+
+def test_sync_fleet(simulator):
+    devices = [(simulator.url, 1), dict(url=simulator.url, module=2, name="two")]
+    with Fleet(devices, eol=EOL, concurrency="sync") as fleet:
+        assert fleet.open().ok
+        assert fleet.open().ok
+        statuses = fleet.shutter_statuses()
+    assert set(statuses.results) == {simulator.url + "#01", "two"}
+
+
+def test_sync_fleet_timeout():
+    pytest.importorskip("sinstruments")
+    with Simulator(modules=[1, 2], timing={"S": 0.3}) as simulator:
+        devices = [(simulator.url, 1), (simulator.url, 2)]
+        with Fleet(devices, eol=EOL, concurrency="sync", max_concurrency=1) as fleet:
+            result = fleet.snapshots(timeout=0.1)
+            assert all(isinstance(e, PFCUTimeoutError) for e in result.errors.values())
+            assert len(result.errors) == 2
+            time.sleep(0.5)
+            # the call which did not start in time was not made
+            assert count(fleet.buses[simulator.url], "commands") == 1
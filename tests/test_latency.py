@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus
+from xia_pfcu.protocol import LatencyModel, PFCUTimeoutError
+
+from lines import AIOLine, IOLine, count, device
+
+
+def test_unknown_command():
+    latency = LatencyModel()
+    assert latency.expected("S") == LatencyModel.DEFAULT_RTT
+    assert latency.timeout("S") == LatencyModel.DEFAULT_TIMEOUT
+    assert latency.percentile("S", 50) is None
+
+
+def test_timeout_follows_the_rtt():
+    latency = LatencyModel()
+    for _ in range(20):
+        latency.update("H", 0.001)
+    # never below MIN_TIMEOUT (a timeout drops the connection)
+    assert latency.expected("H") == pytest.approx(0.001)
+    assert latency.timeout("H") == LatencyModel.MIN_TIMEOUT
+    for _ in range(50):
+        latency.update("Z", 2.0)
+    assert latency.timeout("Z") == pytest.approx(2.0 + LatencyModel.MIN_TIMEOUT_MARGIN)
+    latency.update("Z", 4.0)
+    # the deviation widens the margin
+    margin = latency.timeout("Z") - latency.expected("Z")
+    assert margin > 4 * LatencyModel.MIN_TIMEOUT_MARGIN
+    assert latency.percentile("Z", 0) == 2.0
+    assert latency.percentile("Z", 100) == 4.0
+
+
+def test_timeout_backoff():
+    latency = LatencyModel()
+    latency.update("S", 0.3)
+    timeout = latency.timeout("S")
+    latency.timed_out("S")
+    latency.timed_out("S")
+    assert latency.timeout("S") == pytest.approx(4 * timeout)
+    for _ in range(10):
+        latency.timed_out("S")
+    assert latency.timeout("S") == LatencyModel.MAX_TIMEOUT
+    # back to normal after the next reply
+    latency.update("S", 0.3)
+    assert latency.timeout("S") < 4 * timeout
+
+
+def test_gaps():
+    latency = LatencyModel(min_gap=0.01, gaps={"Z": 0.5})
+    assert latency.gap("H") == 0.01
+    assert latency.gap("Z") == 0.5
+
+
+def fast_timeouts(bus, timeout=0.1):
+    bus.latency.DEFAULT_TIMEOUT = bus.latency.MIN_TIMEOUT = timeout
+
+
+@pytest.mark.parametrize("line_type", [AIOLine, IOLine])
+def test_timeout_resyncs_line(line_type):
+    answer = device()
+    lost = []
+
+    def respond(data):
+        if not lost:
+            lost.append(data)
+            return []
+        return answer(data)
+
+    line = line_type(respond)
+    bus = Bus(line)
+    fast_timeouts(bus)
+    pfcu = bus.pfcu(1)
+
+    async def main():
+        with pytest.raises(PFCUTimeoutError):
+            await pfcu.write_readline("L")
+        return await pfcu.write_readline("L")
+
+    if line_type is AIOLine:
+        reply = asyncio.run(main())
+    else:
+        try:
+            with pytest.raises(PFCUTimeoutError):
+                pfcu.write_readline("L")
+            reply = pfcu.write_readline("L")
+        finally:
+            bus.close()
+    assert reply == "Locked"
+    # the connection was dropped and re-opened
+    assert line.closes >= 1 and line.opens >= 1
+    assert count(bus, "resyncs") == 1
+    assert count(bus, "timeouts") == 1
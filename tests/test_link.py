@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import pytest
+
+from xia_pfcu import Bus, PFCUConnectionError
+from xia_pfcu.protocol import LinkState
+
+from lines import AIOLine, IOLine, count
+
+
+class Down:
+    """Mixin: a line which can be unplugged (write fails, open is refused)"""
+
+    down = False
+
+    def _replies(self, data):
+        if self.down:
+            raise ConnectionResetError("unplugged")
+        return super()._replies(data)
+
+    def _open(self):
+        if self.down:
+            raise ConnectionRefusedError("unplugged")
+
+
+class AIODownLine(Down, AIOLine):
+    async def open(self):
+        self._open()
+        await super().open()
+
+
+class IODownLine(Down, IOLine):
+    def open(self):
+        self._open()
+        super().open()
+
+
+def test_backoff():
+    link = LinkState()
+    link.check()
+    link.broken(OSError())
+    # first reconnection attempt right away
+    link.check()
+    delays = []
+    for _ in range(12):
+        link.attempt_failed(OSError())
+        delays.append(link.retry_at - time.monotonic())
+        with pytest.raises(PFCUConnectionError):
+            link.check()
+    assert LinkState.MIN_DELAY / 2 <= delays[0] <= LinkState.MIN_DELAY
+    assert delays[3] > delays[0]
+    assert max(delays) <= LinkState.MAX_DELAY
+    link.recovered()
+    assert not link.down and link.failures == 0
+    link.check()
+
+
+def test_reconnection():
+    async def main():
+        line = AIODownLine()
+        bus = Bus(line)
+        bus.link.MIN_DELAY = 0.1
+        pfcu = bus.pfcu(1)
+        assert await pfcu.write_readline("L") == "Locked"
+        line.down = True
+        with pytest.raises(PFCUConnectionError):
+            await pfcu.write_readline("L")
+        assert bus.link.down
+        # first attempt right away (refused), then fail fast
+        with pytest.raises(PFCUConnectionError):
+            await pfcu.write_readline("L")
+        opens = line.opens
+        start = time.monotonic()
+        with pytest.raises(PFCUConnectionError):
+            await pfcu.write_readline("L")
+        assert time.monotonic() - start < 0.05
+        assert line.opens == opens
+        line.down = False
+        await asyncio.sleep(bus.link.MIN_DELAY)
+        assert await pfcu.write_readline("L") == "Locked"
+        assert not bus.link.down
+        return bus
+
+    bus = asyncio.run(main())
+    assert count(bus, "disconnects") == 1
+    assert count(bus, "connect_errors") == 1
+    assert count(bus, "rejected") == 1
+    assert count(bus, "reconnects") == 1
+
+
+def test_sync_reconnection():
+    line = IODownLine()
+    bus = Bus(line)
+    bus.link.MIN_DELAY = 0.1
+    pfcu = bus.pfcu(1)
+    try:
+        line.down = True
+        for _ in range(3):
+            with pytest.raises(PFCUConnectionError):
+                pfcu.write_readline("L")
+        line.down = False
+        time.sleep(bus.link.MIN_DELAY)
+        assert pfcu.write_readline("L") == "Locked"
+    finally:
+        bus.close()
+    assert count(bus, "connect_errors") == 1
+    assert count(bus, "rejected") == 1
+
+
+def test_line_down_doesnt_stall_other_lines():
+    async def main():
+        down, up = AIODownLine(), AIOLine()
+        down.down = True
+        bus = Bus(down)
+        lost, alive = bus.pfcu(1), Bus(up).pfcu(1)
+        results = await asyncio.gather(
+            *[lost.write_readline("L") for _ in range(3)],
+            *[alive.write_readline("L") for _ in range(3)],
+            return_exceptions=True,
+        )
+        return results, bus
+
+    results, bus = asyncio.run(main())
+    assert all(isinstance(result, PFCUConnectionError) for result in results[:3])
+    assert results[3:] == ["Locked"] * 3
+    # one connection attempt: the other commands failed fast
+    assert count(bus, "disconnects") == 1
+    assert count(bus, "connect_errors") == 1
+    assert count(bus, "rejected") == 1
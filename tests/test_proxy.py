@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus
+from xia_pfcu.proxy import Proxy, parse_request
+
+from lines import AIOLine, count, frame
+
+
+def test_parse_request():
+    assert parse_request(b"!pfcu15  w 1=0= ") == ("15", "W 1=0=")
+    assert parse_request(b"!PFCUALL H") == ("ALL", "H")
+    for line in (b"PFCU15 H", b"!PFCU99 H", b"!PFCU15"):
+        with pytest.raises(ValueError):
+            parse_request(line)
+
+
+def test_queries_are_cached():
+    async def main():
+        line = AIOLine()
+        proxy = Proxy(Bus(line))
+        replies = [await proxy.request("15", "H") for _ in range(3)]
+        # any other command invalidates the cache
+        await proxy.request("15", "L")
+        replies.append(await proxy.request("15", "H"))
+        return line, proxy.bus, replies
+
+    line, bus, replies = asyncio.run(main())
+    assert replies == [frame("15", "Shutter Open")] * 4
+    assert len(line.written) == 3
+    assert count(bus, "cache_hits") == 2
+
+
+def test_broadcast_forwards_every_reply():
+    async def main():
+        line = AIOLine()
+        async with Proxy(Bus(line), host="localhost", port=0) as proxy:
+            port = proxy.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("localhost", port)
+            try:
+                writer.write(b"!PFCUALL H\r")
+                replies = [await reader.readline() for _ in range(3)]
+                # the broadcast is not cached
+                writer.write(b"!PFCUALL H\r")
+                replies += [await reader.readline() for _ in range(3)]
+            finally:
+                writer.close()
+        return line, replies
+
+    line, replies = asyncio.run(main())
+    expected = [frame(m, "Shutter Open") for m in ("01", "02", "15")]
+    assert replies == expected * 2
+    assert len(line.written) == 2
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from xia_pfcu import Bus
+
+from lines import AIOLine, IOLine, count, device, frame, request
+
+
+def test_stale_and_garbage_frames_are_discarded():
+    def respond(data):
+        module, cmd = request(data)
+        return [
+            frame("02", "Shutter Open"),  # other module
+            frame(module, "0010"),  # other command
+            b"%PFCU\xff\xfe garbage\r\n",
+            frame(module, "Shutter Closed"),
+        ]
+
+    async def main():
+        line = AIOLine(respond)
+        pfcu = Bus(line).pfcu(1)
+        reply = await pfcu.write_readline("H")
+        line.respond = device()
+        return pfcu.protocol.bus, reply, await pfcu.filters_status()
+
+    bus, reply, filters = asyncio.run(main())
+    assert reply == "Shutter Closed"
+    assert len(filters) == 4
+    assert count(bus, "discarded") == 3
+    assert count(bus, "resyncs") == 0
+    # garbage is counted under "?" (no counter per garbage header)
+    assert bus.stats.counters["discarded", "02", ""] == 1
+    assert bus.stats.counters["discarded", "01", ""] == 1
+    assert bus.stats.counters["discarded", "?", ""] == 1
+
+
+def test_sync_reader_survives_garbage_frame():
+    line = IOLine()
+    bus = Bus(line)
+    pfcu = bus.pfcu(1)
+    line.push(b"\xff\xfe\x00;\r\n")
+    try:
+        assert pfcu.write_readline("H") == "Shutter Open"
+        assert pfcu.write_readline("L") == "Locked"
+    finally:
+        bus.close()
+    assert bus.stats.counters["discarded", "?", ""] == 1
+
+
+def test_cancelled_request_late_reply_is_dropped():
+    async def main():
+        line = AIOLine(delay=0.05)
+        pfcu = Bus(line).pfcu(1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pfcu.close_shutter(), 0.01)
+        # waits for the late reply of the cancelled command, then gets its own
+        return pfcu.protocol.bus, await pfcu.write_readline("L")
+
+    bus, reply = asyncio.run(main())
+    assert reply == "Locked"
+    assert bus.stats.counters["discarded", "01", "C"] == 1
+    assert count(bus, "resyncs") == 0
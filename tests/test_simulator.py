@@ -0,0 +1,69 @@
+import asyncio
+
+from xia_pfcu import FilterStatus, ShutterStatus, bus_for_url
+
+from lines import count
+
+EOL = b";\r\n"
+
+
+def test_async_bus(simulator):
+    async def main():
+        bus = bus_for_url(simulator.url, eol=EOL)
+        try:
+            p1, p2, p5 = bus.pfcu(1), bus.pfcu(2), bus.pfcu(5)
+            statuses = await bus.pfcu("ALL").broadcast("shutter_status")
+            assert sorted(statuses) == ["01", "02", "05"]
+            # concurrent commands of several modules get their own replies
+            filters = await asyncio.gather(
+                *[pfcu.filters_status() for pfcu in (p1, p2, p5) for _ in range(5)]
+            )
+            assert len(filters) == 15
+            end5 = await p5.start_exposure(0.01)
+            end1 = await p1.start_exposure(0.2)
+            await asyncio.wait_for(end5, 1)
+            assert not end1.done()
+            await asyncio.wait_for(end1, 1)
+            status = await p2.insert_filter(1, wait=True)
+            assert status[0] == FilterStatus.In
+            assert count(bus, "discarded") == 0
+            assert count(bus, "resyncs") == 0
+        finally:
+            await bus.close()
+
+    asyncio.run(main())
+
+
+def test_sync_bus(simulator):
+    bus = bus_for_url(simulator.url, eol=EOL, concurrency="sync")
+    try:
+        p1, p5 = bus.pfcu(1), bus.pfcu(5)
+        statuses = bus.pfcu("ALL").broadcast("close_shutter")
+        assert sorted(statuses) == ["01", "02", "05"]
+        assert p1.shutter_status() == ShutterStatus.Closed
+        end = p5.start_exposure(0.01)
+        assert "End of Exposure" in end.result(timeout=1)
+        status = p1.remove_filter(3, wait=True)
+        assert status[2] == FilterStatus.Out
+        assert count(bus, "discarded") == 0
+        assert count(bus, "resyncs") == 0
+    finally:
+        bus.close()
+
+
+def test_cached_filter_change(simulator):
+    async def main():
+        bus = bus_for_url(simulator.url, eol=EOL)
+        try:
+            pfcu = bus.pfcu(5, cache=10)
+            await pfcu.remove_filter(4, wait=True)
+            # the filter is still moving when W is acknowledged
+            status = await pfcu.insert_filter(4)
+            assert status[3] == FilterStatus.Out
+            status = await pfcu.insert_filter(4, wait=True)
+            assert status[3] == FilterStatus.In
+            assert (await pfcu.filters_status())[3] == FilterStatus.In
+        finally:
+            await bus.close()
+
+    asyncio.run(main())
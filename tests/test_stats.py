@@ -0,0 +1,58 @@
+from xia_pfcu.stats import Stats
+
+
+def test_to_dict():
+    stats = Stats()
+    stats.count("commands", "15", "S")
+    stats.count("commands", "15", "S")
+    stats.observe("wire", "15", "S", 0.3)
+    stats.observe("wire", "15", "S", 0.5)
+    metrics = stats.to_dict()["15"]["S"]
+    assert metrics["commands"] == 2
+    assert metrics["wire"]["count"] == 2
+    assert metrics["wire"]["mean"] == 0.4
+    assert metrics["wire"]["buckets"]["0.5"] == 2
+
+
+def test_prometheus():
+    stats = Stats()
+    stats.count("commands", "15", "S", 3)
+    stats.observe("wire", "15", "S", 0.3)
+    stats.observe("wire", "15", "S", 2)
+    text = stats.prometheus(labels={"device": "a/b/c"})
+    lines = text.splitlines()
+    assert text.endswith("\n")
+    assert "# TYPE xia_pfcu_commands_total counter" in lines
+    assert 'xia_pfcu_commands_total{module="15",command="S",device="a/b/c"} 3' in lines
+    assert "# TYPE xia_pfcu_wire_seconds histogram" in lines
+    label = 'module="15",command="S",device="a/b/c"'
+    # cumulative buckets
+    assert 'xia_pfcu_wire_seconds_bucket{{{},le="0.25"}} 0'.format(label) in lines
+    assert 'xia_pfcu_wire_seconds_bucket{{{},le="0.5"}} 1'.format(label) in lines
+    assert 'xia_pfcu_wire_seconds_bucket{{{},le="+Inf"}} 2'.format(label) in lines
+    assert "xia_pfcu_wire_seconds_sum{{{}}} 2.3".format(label) in lines
+    assert "xia_pfcu_wire_seconds_count{{{}}} 2".format(label) in lines
+    # metrics without samples are not exported
+    assert "timeouts" not in text
+
+
+def test_prometheus_escapes_label_values():
+    stats = Stats()
+    stats.count("discarded", 'a"b', "\\")
+    text = stats.prometheus(labels={"url": "tcp://x\n"})
+    sample = (
+        'xia_pfcu_discarded_total{module="a\\"b",command="\\\\",url="tcp://x\\n"} 1'
+    )
+    assert sample in text.splitlines()
+
+
+def test_modules():
+    stats = Stats()
+    stats.count("commands", "01", "S")
+    stats.count("commands", "02", "S")
+    stats.observe("wire", "02", "S", 0.1)
+    assert list(stats.to_dict(modules=["01"])) == ["01"]
+    text = stats.prometheus(modules=["01"])
+    assert 'module="01"' in text
+    assert 'module="02"' not in text
+    assert "wire" not in text
@@ -0,0 +1,88 @@
+import pytest
+
+from xia_pfcu import PFCUError, PFCUStatus
+from xia_pfcu.protocol import parse_status, yes_no
+
+STATUS = """\
+PFCU v1.0 (c) XIA 1999 All Rights Reserved
+CHANNEL IN/OUT (FPanel   TTL  RS232) Shorted? Open?
+    1      IN     OUT    OUT    IN      NO      NO
+    2     OUT     OUT    OUT   OUT      NO      NO
+    3      IN      IN    OUT    IN     YES      NO
+    4     OUT     OUT     IN   OUT      NO     YES
+RS232 Control Enabled: YES
+RS232 Control Only: NO
+Shutter Mode Enabled: {}
+Exposure Decimation:     {}"""
+
+
+def legacy_parse_status(status):
+    # parse_status of xia-pfcu 1.6.0
+    lines = status.split("\n")
+    channels = []
+    for i in range(4):
+        nb, inout, fpanel, ttl, rs232, shorted, open = lines[2 + i].split()
+        ch = dict(
+            nb=int(nb),
+            in_out=inout.capitalize(),
+            front_panel=fpanel.capitalize(),
+            ttl=ttl.capitalize(),
+            rs232=rs232.capitalize(),
+            shorted=yes_no(shorted),
+            open=yes_no(open),
+        )
+        channels.append(ch)
+    shutter_enabled = yes_no(lines[-2])
+    if shutter_enabled:
+        shutter_status = "Closed" if "closed" in lines[-2].lower() else "Open"
+    else:
+        shutter_status = "Disabled"
+    return {
+        "id": lines[0],
+        "channels": channels,
+        "remote_control_enabled": yes_no(lines[-4]),
+        "remote_control_only": yes_no(lines[-3]),
+        "shutter_enabled": shutter_enabled,
+        "shutter_status": shutter_status,
+        "decimation": int(lines[-1].rsplit(" ", 1)[-1]),
+    }
+
+
+@pytest.mark.parametrize(
+    "mode, decimation",
+    [("YES Shutter is Closed", 1), ("YES Shutter is Open", 7), ("NO", 65535)],
+)
+def test_same_as_legacy_parse_status(mode, decimation):
+    status = STATUS.format(mode, decimation)
+    assert parse_status(status) == legacy_parse_status(status)
+    assert PFCUStatus.from_text(status).to_dict() == legacy_parse_status(status)
+
+
+def test_status_instances_are_shared():
+    status = STATUS.format("NO", 1)
+    first = PFCUStatus.from_text(status)
+    assert PFCUStatus.from_text(status) is first
+    other = PFCUStatus.from_text(STATUS.format("NO", 2))
+    # equal channels are shared between reports
+    assert all(a is b for a, b in zip(first.channels, other.channels))
+
+
+def test_unexpected_status():
+    with pytest.raises(PFCUError):
+        PFCUStatus.from_text("Exposure Decimation: 1")
+
+
+def test_diff():
+    closed = PFCUStatus.from_text(STATUS.format("YES Shutter is Closed", 1))
+    opened = PFCUStatus.from_text(STATUS.format("YES Shutter is Open", 1))
+    moved = STATUS.format("YES Shutter is Open", 3).replace(
+        "    2     OUT     OUT", "    2      IN     OUT"
+    )
+    moved = PFCUStatus.from_text(moved)
+    assert closed.diff(closed) == {}
+    assert opened.diff(closed) == {"shutter_status": "Open"}
+    assert moved.diff(opened) == {"channel2.in_out": "In", "decimation": 3}
+    everything = closed.diff(None)
+    assert everything["id"] == closed.id
+    assert everything["channel4.open"] is True
+    assert len(everything) == len(closed._fields) - 1 + 4 * 7
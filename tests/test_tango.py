@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+
+def test_bus_registry():
+    pytest.importorskip("tango")
+    from xia_pfcu.tango.server.pfcu import BusRegistry
+
+    registry = BusRegistry()
+    url = "tcp://localhost:17890"
+    bus = registry.acquire(url, eol=b";\r\n", concurrency="async")
+    assert registry.acquire(url, eol=b";\r\n", concurrency="async") is bus
+    # the line is already open with other settings
+    with pytest.raises(ValueError):
+        registry.acquire(url, eol=b"\n", concurrency="async")
+
+    async def release():
+        await registry.release(url)
+        assert registry.acquire(url, eol=b";\r\n", concurrency="async") is bus
+        await registry.release(url)
+        await registry.release(url)
+
+    asyncio.run(release())
+    assert registry.acquire(url, eol=b"\n", concurrency="async") is not bus
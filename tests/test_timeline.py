@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+
+from xia_pfcu import Bus, ShutterStatus
+from xia_pfcu.timeline import Timeline, load, records
+
+from lines import AIOLine
+
+
+def test_ring_wraparound(tmp_path):
+    path = str(tmp_path / "pfcu.tl")
+    with Timeline(path, capacity=4) as timeline:
+        for module in range(6):
+            timeline.append(module, "C", shutter=ShutterStatus.Closed)
+        assert len(timeline) == 4
+    # oldest first: the first two were overwritten
+    events = records(path)
+    assert [event.module for event in events] == ["02", "03", "04", "05"]
+    assert all(event.shutter == ShutterStatus.Closed for event in events)
+    # an existing file is appended to (with its own capacity)
+    with Timeline(path, capacity=100) as timeline:
+        assert timeline.capacity == 4
+        timeline.append("ALL", "W", filters="0110")
+    events = records(path)
+    assert [event.module for event in events] == ["03", "04", "05", "ALL"]
+    assert events[-1].filters == "0110" and events[-1].shutter is None
+
+
+def test_time_range(tmp_path):
+    path = str(tmp_path / "pfcu.tl")
+    with Timeline(path, capacity=8) as timeline:
+        for _ in range(3):
+            timeline.append(1, "O", shutter=ShutterStatus.Open)
+            time.sleep(0.001)
+    events = records(path)
+    since = events[1].time
+    assert records(path, since=since) == events[1:]
+    assert records(path, until=since) == events[:1]
+
+
+def test_load(tmp_path):
+    numpy = pytest.importorskip("numpy")
+    path = str(tmp_path / "pfcu.tl")
+    with Timeline(path, capacity=4) as timeline:
+        for module in range(5):
+            timeline.append(module, "E", ok=module != 3, shutter=ShutterStatus.Open)
+    array = load(path)
+    assert isinstance(array, numpy.ndarray)
+    assert list(array["module"]) == [1, 2, 3, 4]
+    assert list(array["ok"]) == [1, 1, 0, 1]
+    assert list(load(path, since=array["time"][2])["module"]) == [3, 4]
+
+
+def test_bus_records_transitions(tmp_path):
+    path = str(tmp_path / "pfcu.tl")
+
+    async def main():
+        with Timeline(path) as timeline:
+            pfcu = Bus(AIOLine(), timeline=timeline).pfcu(1)
+            await pfcu.open_shutter()
+            # queries are not recorded
+            await pfcu.shutter_status()
+            await pfcu.insert_filter(3)
+
+    asyncio.run(main())
+    events = records(path)
+    assert [(event.module, event.code) for event in events] == [
+        ("01", "O"),
+        ("01", "W"),
+    ]
+    assert events[0].shutter == ShutterStatus.Open
+    assert events[1].filters == "0010"
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+from xia_pfcu import PFCU
+from xia_pfcu.protocol import PFCUTimeoutError
+from xia_pfcu.wire import WRITE, Capture, Replay, ReplayError, read_capture
+
+from lines import AIOLine, IOLine, device
+
+
+async def session(pfcu):
+    return [
+        await pfcu.shutter_status(),
+        await pfcu.insert_filter(2),
+        await pfcu.status(),
+        await pfcu.close_shutter(),
+    ]
+
+
+def test_capture_replay(tmp_path):
+    path = str(tmp_path / "session.wire")
+
+    async def record():
+        pfcu = PFCU(Capture(AIOLine(delay=0.01), path), module=1)
+        try:
+            return await session(pfcu)
+        finally:
+            await pfcu.protocol.bus.close()
+
+    async def replay(speed):
+        conn = Replay(path, speed=speed)
+        pfcu = PFCU(conn, module=1)
+        start = time.monotonic()
+        replies = await session(pfcu)
+        return replies, time.monotonic() - start, conn.done
+
+    recorded = asyncio.run(record())
+    _, events = read_capture(path)
+    assert [event.kind for event in events].count(WRITE) == 4
+    replies, _, done = asyncio.run(replay(None))
+    assert replies == recorded and done
+    # the recorded timing
+    replies, elapsed, _ = asyncio.run(replay(1))
+    assert replies == recorded
+    assert elapsed >= 4 * 0.01
+
+
+def test_sync_capture_replay(tmp_path):
+    path = str(tmp_path / "session.wire")
+    pfcu = PFCU(Capture(IOLine(), path), module=1)
+    try:
+        recorded = [pfcu.shutter_status(), pfcu.filters_status()]
+    finally:
+        pfcu.protocol.bus.close()
+    conn = Replay(path, concurrency="sync", speed=None)
+    pfcu = PFCU(conn, module=1)
+    try:
+        assert [pfcu.shutter_status(), pfcu.filters_status()] == recorded
+    finally:
+        pfcu.protocol.bus.close()
+    assert conn.done
+
+
+def test_replay_mismatch(tmp_path):
+    path = str(tmp_path / "session.wire")
+    pfcu = PFCU(Capture(IOLine(), path), module=1)
+    try:
+        pfcu.lock()
+        pfcu.shutter_status()
+    finally:
+        pfcu.protocol.bus.close()
+
+    pfcu = PFCU(Replay(path, concurrency="sync", speed=None), module=1)
+    with pytest.raises(ReplayError):
+        pfcu.protocol.bus.conn.write(pfcu.protocol.encode("H"))
+    # the requests the protocol no longer sends are skipped
+    conn = Replay(path, concurrency="sync", speed=None, strict=False)
+    pfcu = PFCU(conn, module=1)
+    try:
+        pfcu.shutter_status()
+    finally:
+        pfcu.protocol.bus.close()
+    assert conn.done
+
+
+def test_capture_across_resync(tmp_path):
+    path = str(tmp_path / "session.wire")
+    answer = device()
+    lost = []
+
+    def respond(data):
+        if not lost:
+            lost.append(data)
+            return []
+        return answer(data)
+
+    line = IOLine(respond)
+    pfcu = PFCU(Capture(line, path), module=1)
+    bus = pfcu.protocol.bus
+    bus.latency.DEFAULT_TIMEOUT = bus.latency.MIN_TIMEOUT = 0.1
+    try:
+        with pytest.raises(PFCUTimeoutError):
+            pfcu.lock()
+        # the connection was dropped (resync): the capture goes on
+        assert pfcu.lock() == "Locked"
+    finally:
+        bus.close()
+    _, events = read_capture(path)
+    assert [event.kind for event in events] == [WRITE, WRITE, b"r"]
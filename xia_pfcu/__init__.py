@@ -1,11 +1,20 @@
 from .protocol import (
     Protocol,
     protocol_for_url,
+    Bus,
+    bus_for_url,
     ShutterStatus,
     FilterStatus,
+    Priority,
+    PFCUStatus,
+    ChannelStatus,
     PFCUError,
+    PFCUConnectionError,
+    PFCUFilterFault,
     BROADCAST,
 )
 from .pfcu import PFCU
+from .fleet import Fleet, FleetResult
+from .background import BackgroundLoop
 
 __version__ = "1.6.0"
@@ -0,0 +1,229 @@
+"""
+# Background loop: drive many PFCUs in parallel from synchronous code
+
+The IO (sync) API blocks the calling thread for each round trip, so a
+script stepping through N devices pays N round trips. A BackgroundLoop runs
+the async API in an asyncio loop on a background thread and gives
+synchronous handles whose methods return concurrent.futures.Future:
+
+    loop = BackgroundLoop()
+    devices = [loop.pfcu(url, module=module) for url, module in addresses]
+    futures = [device.set_filters(1, 0) for device in devices]
+    results = loop.gather(futures, timeout=5)   # ~ one round trip
+    print(devices[0].wait.status())            # blocking call
+    loop.close()
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+
+from .fleet import device_spec
+from .pfcu import PFCU, FilterChanges
+from .protocol import BROADCAST, bus_for_url
+
+# PFCU methods available on BackgroundPFCU
+METHODS = (
+    "write_readline",
+    "enable_shutter",
+    "disable_shutter",
+    "open_shutter",
+    "close_shutter",
+    "shutter_status",
+    "status",
+    "info",
+    "snapshot",
+    "filters_status",
+    "set_filters",
+    "insert_filter",
+    "remove_filter",
+    "wait_filters",
+    "set_decimation",
+    "lock",
+    "unlock",
+    "clear_short_error",
+)
+
+
+class BackgroundLoop:
+    """
+    asyncio loop running on a background (daemon) thread. Holds one bus per
+    URL (modules on the same line share it). kwargs are passed to
+    connection_for_url (ex: eol=b";\\r\\n").
+    """
+
+    def __init__(self, name="PFCULoop", **kwargs):
+        self.kwargs = kwargs
+        self.buses = {}
+        self.loop = asyncio.new_event_loop()
+        self._log = logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule the coroutine in the loop. Returns a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run the coroutine in the loop and wait for its result"""
+        return self.submit(coro).result(timeout)
+
+    def gather(self, futures, timeout=None, return_exceptions=False):
+        """
+        Wait for all futures. Returns the list of their results. If
+        return_exceptions is True, exceptions are returned as results
+        instead of raising the first one
+        """
+        futures = list(futures)
+        _, not_done = concurrent.futures.wait(futures, timeout)
+        for future in not_done:
+            future.cancel()
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(0))
+            except (Exception, concurrent.futures.CancelledError) as error:
+                if not return_exceptions:
+                    raise
+                results.append(error)
+        return results
+
+    def bus(self, url):
+        """The bus of the given URL (created in the loop if needed)"""
+        with self._lock:
+            bus = self.buses.get(url)
+            if bus is None:
+
+                async def new_bus():
+                    return bus_for_url(url, log=self._log, **self.kwargs)
+
+                bus = self.buses[url] = self.run(new_bus())
+        return bus
+
+    def pfcu(self, url, module=BROADCAST, cache=None):
+        """
+        BackgroundPFCU for the given device (url can also be any device
+        description accepted by Fleet: (url, module) or dict)
+        """
+        if not isinstance(url, str):
+            _, url, module = device_spec(url)
+        return BackgroundPFCU(self, self.bus(url).pfcu(module, cache=cache))
+
+    def close(self, timeout=None):
+        async def close():
+            await asyncio.gather(
+                *[bus.close() for bus in self.buses.values()],
+                return_exceptions=True,
+            )
+
+        if self.loop.is_running():
+            try:
+                self.run(close(), timeout)
+            finally:
+                self.buses.clear()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join(timeout)
+        if not self.loop.is_running():
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _future_method(name):
+    def method(self, *args, **kwargs):
+        return self.loop.submit(getattr(self.pfcu, name)(*args, **kwargs))
+
+    method.__name__ = name
+    method.__doc__ = getattr(PFCU, name).__doc__
+    return method
+
+
+class Blocking:
+    """Blocking version of the BackgroundPFCU methods"""
+
+    def __init__(self, pfcu, timeout=None):
+        self._pfcu = pfcu
+        self._timeout = timeout
+
+    def __getattr__(self, name):
+        if name not in METHODS and name != "start_exposure":
+            raise AttributeError(name)
+        method = getattr(self._pfcu, name)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            return method(*args, **kwargs).result(self._timeout)
+
+        return wrapper
+
+
+class BackgroundPFCU:
+    """
+    Synchronous handle of a PFCU running in a BackgroundLoop. Its methods
+    (same as PFCU) return a concurrent.futures.Future, so calls on many
+    devices run in parallel (see BackgroundLoop.gather()). The blocking
+    versions are available through `wait` (ex: `pfcu.wait.status()`)
+    """
+
+    def __init__(self, loop, pfcu):
+        self.loop = loop
+        self.pfcu = pfcu
+        self.protocol = pfcu.protocol
+        self.wait = Blocking(self)
+
+    def filter_changes(self, wait=False, priority=None):
+        """
+        Context manager which collects filter insert/remove and sends them
+        as a single W command on exit (its result is a Future, done once the
+        filters reached their position if wait is True)
+        """
+        return FilterChanges(self, wait=wait, priority=priority)
+
+    def start_exposure(self, duration, priority=None):
+        """
+        Initiates a fixed length exposure. Returns a Future, done when the
+        device acknowledges it, whose result is a Future done when the
+        device reports the end of the exposure
+        """
+
+        async def start():
+            end = await self.pfcu.start_exposure(duration, priority)
+            return self.loop.submit(_wait(end))
+
+        return self.loop.submit(start())
+
+    def exposure_sequence(self, durations, priority=None):
+        """
+        Runs one exposure per duration (see PFCU.exposure_sequence()).
+        Generator of the effective duration of each exposure, yielded when
+        it ends
+        """
+        sequence = self.pfcu.exposure_sequence(durations, priority)
+        try:
+            while True:
+                try:
+                    yield self.loop.run(sequence.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.loop.run(sequence.aclose())
+
+
+for _name in METHODS:
+    setattr(BackgroundPFCU, _name, _future_method(_name))
+del _name
+
+
+async def _wait(future):
+    return await future
@@ -0,0 +1,291 @@
+"""
+PFCU command line interface.
+
+Runs commands either directly on the line (--url) or through a local
+daemon which owns the line (--socket):
+
+    $ xia-pfcu --url tcp://controls.lab.org:17890 --module 1 status
+    $ xia-pfcu --url tcp://controls.lab.org:17890 daemon --socket /tmp/pfcu.sock
+    $ xia-pfcu --socket /tmp/pfcu.sock close
+    $ xia-pfcu --socket /tmp/pfcu.sock batch script.txt
+    $ xia-pfcu --url serial:///dev/ttyS0 proxy :17890
+
+A batch script has one command per line (same syntax as the command line,
+"#" starts a comment). A command can be sent to another module by
+prefixing it with @<module> (ex: "@2 insert a"). All commands of a batch
+run over the same connection.
+
+The proxy command shares the line with many TCP clients speaking the
+native PFCU protocol (see xia_pfcu.proxy).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shlex
+import sys
+
+from .protocol import BROADCAST, bus_for_url, module_name
+from .proxy import Proxy
+
+EOL = b";\r\n"
+SOCKET = os.environ.get("PFCU_SOCKET")
+
+# command: (PFCU method, number of arguments (None: any), help)
+COMMANDS = {
+    "status": ("status", 0, "status report"),
+    "snapshot": ("snapshot", 0, "status report (JSON)"),
+    "shutter": ("shutter_status", 0, "shutter status"),
+    "filters": ("filters_status", 0, "filters status"),
+    "open": ("open_shutter", 0, "open the shutter"),
+    "close": ("close_shutter", 0, "close the shutter"),
+    "expose": ("start_exposure", 1, "exposure of the given seconds (waits its end)"),
+    "insert": ("insert_filter", 1, "insert filter (1-4 or a-d)"),
+    "remove": ("remove_filter", 1, "remove filter (1-4 or a-d)"),
+    "set-filters": ("set_filters", None, "set filters (ex: in out - -)"),
+    "decimation": ("set_decimation", 1, "set the exposure decimation"),
+    "enable-shutter": ("enable_shutter", 0, "enable shutter mode"),
+    "disable-shutter": ("disable_shutter", 0, "disable shutter mode"),
+    "lock": ("lock", 0, "RS232 control only"),
+    "unlock": ("unlock", 0, "enable all control sources"),
+    "clear-short": ("clear_short_error", 0, "clear short circuit errors"),
+    "raw": ("write_readline", None, "send a raw command (ex: raw D 10)"),
+    "stats": (None, 0, "protocol statistics (JSON)"),
+}
+
+
+class CommandError(Exception):
+    pass
+
+
+def parse_line(line, module):
+    """(module, command, args) from a command line (None if empty)"""
+    words = shlex.split(line, comments=True)
+    if words and words[0].startswith("@"):
+        module, words = words[0][1:], words[1:]
+    if not words:
+        return None
+    return module_name(module), words[0], words[1:]
+
+
+def to_json(value):
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    if hasattr(value, "name"):  # enums
+        return value.name
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+
+async def execute(bus, module, command, args):
+    """Runs the given command on the module of the bus. Returns a JSON value"""
+    try:
+        method, nb_args, _ = COMMANDS[command]
+    except KeyError:
+        raise CommandError("Unknown command {!r}".format(command))
+    if nb_args is not None and len(args) != nb_args:
+        raise CommandError("{} takes {} argument(s)".format(command, nb_args))
+    if method is None:
+        return bus.stats.to_dict()
+    pfcu = bus.pfcu(module)
+    if command == "expose":
+        end = await pfcu.start_exposure(float(args[0]))
+        return await end
+    if command == "raw":
+        args = [" ".join(args)]
+    return to_json(await getattr(pfcu, method)(*args))
+
+
+# local (direct) and remote (daemon) command runners
+
+
+class Local:
+    def __init__(self, url, **kwargs):
+        self.bus = bus_for_url(url, eol=EOL, **kwargs)
+
+    async def run(self, module, command, args):
+        return await execute(self.bus, module, command, args)
+
+    async def close(self):
+        await self.bus.close()
+
+
+class Remote:
+    def __init__(self, path):
+        self.path = path
+        self.reader = self.writer = None
+
+    async def run(self, module, command, args):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        request = dict(module=module, command=command, args=args)
+        self.writer.write(json.dumps(request).encode() + b"\n")
+        reply = json.loads(await self.reader.readline())
+        if "error" in reply:
+            raise CommandError(reply["error"])
+        return reply["result"]
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# daemon
+
+
+class Daemon:
+    """
+    Owns the line and runs the commands received on a unix socket (one JSON
+    request per line, one JSON reply per line) on the line queue, so that
+    CLI calls never collide with each other
+    """
+
+    def __init__(self, url, path, **kwargs):
+        self.bus = bus_for_url(url, eol=EOL, **kwargs)
+        self.path = path
+        self._log = logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
+
+    async def handle(self, reader, writer):
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    result = await execute(
+                        self.bus,
+                        module_name(request.get("module", BROADCAST)),
+                        request["command"],
+                        request.get("args", []),
+                    )
+                    reply = dict(result=result)
+                except Exception as error:
+                    reply = dict(error="{}: {}".format(type(error).__name__, error))
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # only the owner may drive the line (the socket is created with the
+        # umask: no window in which others can connect)
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle, self.path)
+        finally:
+            os.umask(umask)
+        self._log.info("listening on %s", self.path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.bus.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def print_result(result):
+    if result is None:
+        return
+    if isinstance(result, str):
+        print(result)
+    else:
+        print(json.dumps(result))
+
+
+async def run_commands(runner, lines, module):
+    errors = 0
+    try:
+        for line in lines:
+            try:
+                parsed = parse_line(line, module)
+                if parsed is None:
+                    continue
+                print_result(await runner.run(*parsed))
+            except Exception as error:
+                errors += 1
+                print("error: {}".format(error), file=sys.stderr)
+    finally:
+        await runner.close()
+    return errors
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="xia-pfcu",
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n"
+        + "\n".join(
+            "  {:18} {}".format(name, info[2]) for name, info in COMMANDS.items()
+        )
+        + "\n  {:18} {}".format("batch [FILE]", "run commands from file (or stdin)")
+        + "\n  {:18} {}".format("daemon", "serve the line on --socket")
+        + "\n  {:18} {}".format("proxy [HOST:]PORT", "serve the line on TCP"),
+    )
+    parser.add_argument("--url", help="device URL (ex: tcp://lab.org:17890)")
+    parser.add_argument(
+        "--socket", default=SOCKET, help="daemon unix socket (default: $PFCU_SOCKET)"
+    )
+    parser.add_argument("-m", "--module", default=BROADCAST)
+    parser.add_argument("--baudrate", type=int, help="serial line baudrate")
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        type=str.upper,
+    )
+    parser.add_argument("command")
+    parser.add_argument("args", nargs="*")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    fmt = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+    logging.basicConfig(level=args.log_level, format=fmt)
+    kwargs = {} if args.baudrate is None else dict(baudrate=args.baudrate)
+    if args.command == "daemon":
+        if not args.url or not args.socket:
+            sys.exit("daemon needs --url and --socket")
+        daemon = Daemon(args.url, args.socket, **kwargs)
+        try:
+            asyncio.run(daemon.serve())
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.command == "proxy":
+        if not args.url or len(args.args) != 1:
+            sys.exit("proxy needs --url and [HOST:]PORT")
+        host, _, port = args.args[0].rpartition(":")
+        bus = bus_for_url(args.url, eol=EOL, **kwargs)
+        proxy = Proxy(bus, host or "0.0.0.0", int(port))
+        try:
+            asyncio.run(proxy.serve())
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.url:
+        runner = Local(args.url, **kwargs)
+    elif args.socket:
+        runner = Remote(args.socket)
+    else:
+        sys.exit("needs either --url or --socket (or $PFCU_SOCKET)")
+    if args.command == "batch":
+        path = args.args[0] if args.args else "-"
+        fobj = sys.stdin if path == "-" else open(path)
+        with fobj:
+            lines = fobj.readlines()
+    else:
+        lines = [" ".join(shlex.quote(arg) for arg in [args.command] + args.args)]
+    errors = asyncio.run(run_commands(runner, lines, args.module))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+# Fleet: many PFCU devices (possibly behind many gateways) at once
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+
+from .protocol import BROADCAST, PFCUTimeoutError, bus_for_url, module_name
+
+
+class FleetResult(collections.namedtuple("FleetResult", "results errors")):
+    """
+    Outcome of a fleet operation: results is a dict of device name to the
+    result of the devices which succeeded and errors a dict of device name
+    to the exception of the devices which failed
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def device_spec(device):
+    """
+    (name, url, module) from a device description: either an URL, an
+    (url, module) pair or a dict(url=..., module=..., name=...)
+    """
+    if isinstance(device, str):
+        device = dict(url=device)
+    elif not isinstance(device, dict):
+        url, module = device
+        device = dict(url=url, module=module)
+    url = device["url"]
+    module = device.get("module")
+    module = BROADCAST if module is None else module_name(module)
+    name = device.get("name")
+    if name is None:
+        name = url if module == BROADCAST else "{}#{}".format(url, module)
+    return name, url, module
+
+
+class BaseFleet:
+    """
+    Holds the connections to a list of PFCU devices and runs operations on
+    all of them (or on a subset) concurrently.
+
+    Devices on the same URL (modules daisy-chained behind the same gateway)
+    share one connection (see xia_pfcu.Bus). At most max_concurrency
+    operations run at the same time. kwargs are passed to connection_for_url
+    (ex: eol=b";\\r\\n").
+    """
+
+    MAX_CONCURRENCY = 32
+
+    def __init__(self, devices, max_concurrency=None, cache=None, **kwargs):
+        self._log = logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
+        self.max_concurrency = max_concurrency or self.MAX_CONCURRENCY
+        self.buses = {}
+        self.devices = {}
+        for device in devices:
+            name, url, module = device_spec(device)
+            if name in self.devices:
+                raise ValueError("Duplicate device {!r}".format(name))
+            bus = self.buses.get(url)
+            if bus is None:
+                bus = self.buses[url] = bus_for_url(url, log=self._log, **kwargs)
+            self.devices[name] = bus.pfcu(module, cache=cache)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def _select(self, names):
+        if names is None:
+            return list(self.devices.items())
+        return [(name, self.devices[name]) for name in names]
+
+    def close_shutters(self, names=None, timeout=None):
+        return self.run("close_shutter", names=names, timeout=timeout)
+
+    def open_shutters(self, names=None, timeout=None):
+        return self.run("open_shutter", names=names, timeout=timeout)
+
+    def shutter_statuses(self, names=None, timeout=None):
+        return self.run("shutter_status", names=names, timeout=timeout)
+
+    def filters_statuses(self, names=None, timeout=None):
+        return self.run("filters_status", names=names, timeout=timeout)
+
+    def snapshots(self, names=None, timeout=None):
+        """PFCUStatus of every device (see PFCU.snapshot())"""
+        return self.run("snapshot", names=names, timeout=timeout)
+
+
+class AIOFleet(BaseFleet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._semaphore = None
+
+    def _bounded(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _call(self, func, timeout):
+        async with self._bounded():
+            return await asyncio.wait_for(func(), timeout)
+
+    async def _gather(self, calls, timeout):
+        names = [name for name, _ in calls]
+        replies = await asyncio.gather(
+            *[self._call(func, timeout) for _, func in calls],
+            return_exceptions=True,
+        )
+        results, errors = {}, {}
+        for name, reply in zip(names, replies):
+            if isinstance(reply, asyncio.TimeoutError):
+                reply = PFCUTimeoutError("No reply after {}s".format(timeout))
+            if isinstance(reply, BaseException):
+                if isinstance(reply, asyncio.CancelledError):
+                    raise reply
+                self._log.debug("%s failed: %r", name, reply)
+                errors[name] = reply
+            else:
+                results[name] = reply
+        return FleetResult(results, errors)
+
+    async def run(self, method, *args, names=None, timeout=None):
+        """
+        Call the given PFCU method (ex: "close_shutter") with the given
+        arguments on every device (or on the given device names)
+        concurrently. Returns a FleetResult.
+        """
+        calls = [
+            (name, lambda pfcu=pfcu: getattr(pfcu, method)(*args))
+            for name, pfcu in self._select(names)
+        ]
+        return await self._gather(calls, timeout)
+
+    async def open(self, timeout=None):
+        """Open the connection of every line. Returns a FleetResult by URL"""
+        calls = [(url, bus.connect) for url, bus in self.buses.items()]
+        return await self._gather(calls, timeout)
+
+    async def close(self):
+        await asyncio.gather(
+            *[bus.close() for bus in self.buses.values()], return_exceptions=True
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+
+
+class IOFleet(BaseFleet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="PFCUFleet"
+        )
+
+    def _call(self, func, deadline):
+        # (a call which did not start before the deadline is not made)
+        if deadline is not None and time.monotonic() >= deadline:
+            raise PFCUTimeoutError("Not started before the deadline")
+        return func()
+
+    def _gather(self, calls, timeout):
+        # a running call can't be interrupted: it ends with its command, which
+        # is bounded by the bus (reply timeout, see LatencyModel)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        futures = {
+            self._executor.submit(self._call, func, deadline): name
+            for name, func in calls
+        }
+        _, not_done = concurrent.futures.wait(futures, timeout)
+        results, errors = {}, {}
+        for future, name in futures.items():
+            if future in not_done:
+                future.cancel()
+                errors[name] = PFCUTimeoutError("No reply after {}s".format(timeout))
+                continue
+            error = future.exception()
+            if error is None:
+                results[name] = future.result()
+            else:
+                self._log.debug("%s failed: %r", name, error)
+                errors[name] = error
+        return FleetResult(results, errors)
+
+    def run(self, method, *args, names=None, timeout=None):
+        """
+        Call the given PFCU method (ex: "close_shutter") with the given
+        arguments on every device (or on the given device names)
+        concurrently. Returns a FleetResult.
+        """
+        calls = [
+            (name, lambda pfcu=pfcu: getattr(pfcu, method)(*args))
+            for name, pfcu in self._select(names)
+        ]
+        return self._gather(calls, timeout)
+
+    def open(self, timeout=None):
+        """Open the connection of every line. Returns a FleetResult by URL"""
+        calls = [(url, bus.connect) for url, bus in self.buses.items()]
+        return self._gather(calls, timeout)
+
+    def close(self):
+        for bus in self.buses.values():
+            try:
+                bus.close()
+            except Exception as error:
+                self._log.debug("error closing %r: %r", bus.conn, error)
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def Fleet(devices, *args, **kwargs):
+    """
+    Fleet of PFCU devices. devices is a list of URLs, (url, module) pairs or
+    dict(url=..., module=..., name=...). Returns an IOFleet if
+    concurrency="sync" (see connio.connection_for_url), an AIOFleet otherwise
+    """
+    klass = IOFleet if kwargs.get("concurrency") == "sync" else AIOFleet
+    return klass(devices, *args, **kwargs)
@@ -6,7 +6,8 @@ import logging
 
 from .protocol import (
     Protocol,
-    parse_status,
+    decode_info,
+    decode_pfcu_status,
     decode_status,
     decode_shutter_status,
     decode_filters_status,
@@ -14,121 +15,268 @@ from .protocol import (
 )
 
 
+# broadcast operations: PFCU method name: (command, reply decoder)
+BROADCASTS = {
+    "enable_shutter": ("2", None),
+    "disable_shutter": ("4", None),
+    "open_shutter": ("O", None),
+    "close_shutter": ("C", None),
+    "shutter_status": ("H", decode_shutter_status.func),
+    "status": ("S", decode_status.func),
+    "info": ("S", decode_info.func),
+    "snapshot": ("S", decode_pfcu_status.func),
+    "filters_status": ("F", decode_filters_status.func),
+    "lock": ("L", None),
+    "unlock": ("U", None),
+    "clear_short_error": ("Z", decode_filters_status.func),
+}
+
+
+FILTER_VALUES = {
+    "out": "0",
+    "o": "0",
+    "0": "0",
+    "in": "1",
+    "i": "1",
+    "1": "1",
+    "-": "=",
+    "": "=",
+    "=": "=",
+}
+
+
+def filter_value(value):
+    """W command value ("0", "1" or "=") of a filter state (None: unchanged)"""
+    return "=" if value is None else FILTER_VALUES[str(value).lower()]
+
+
+def filter_index(filt):
+    """Filter index (0-3) from filter number (1-4) or name ("a"-"d")"""
+    fmap = {"a": 1, "b": 2, "c": 3, "d": 4}
+    filt = int(fmap.get(str(filt).lower(), filt))
+    assert 0 < filt < 5
+    return filt - 1
+
+
+class FilterChanges:
+    """
+    Collects filter changes to be sent as a single W command (see
+    PFCU.filter_changes()). result holds the state of each filter after
+    the changes are applied.
+    """
+
+    def __init__(self, pfcu, wait=False, priority=None):
+        self.pfcu = pfcu
+        self.wait = wait
+        self.priority = priority
+        self.values = [None] * 4
+        self.result = None
+
+    def insert(self, filt):
+        self.values[filter_index(filt)] = "1"
+
+    def remove(self, filt):
+        self.values[filter_index(filt)] = "0"
+
+    def commit(self):
+        return self.pfcu.set_filters(
+            *self.values, wait=self.wait, priority=self.priority
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.result = self.commit()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.result = await self.commit()
+
+
 class PFCU:
     """
     PFCU-4 - Filter Set & Relay Control Unit
 
+    The connection can either be a connio connection or a Bus (see
+    xia_pfcu.Bus) when several modules are daisy-chained on the same line.
+
+    cache (optional) enables a read cache of the queries. It is either a TTL
+    (in seconds) for all queries or a dict of query name to TTL (ex:
+    `dict(status=1, shutter_status=0.1, filters_status=0.1)`). Commands that
+    change the device state invalidate (or update) the cache.
+
+    Every command method accepts priority (see xia_pfcu.Priority) to
+    override the default priority of its command on the bus (ex:
+    `pfcu.status(priority=Priority.Actuation)`).
     """
 
-    def __init__(self, connection, module=BROADCAST):
+    def __init__(self, connection, module=BROADCAST, cache=None):
         self._log = logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
-        self.protocol = Protocol(connection, module=module, log=self._log)
+        self.protocol = Protocol(connection, module=module, log=self._log, cache=cache)
 
-    def write_readline(self, command):
-        return self.protocol.write_readline(command)
+    def write_readline(self, command, priority=None):
+        """
+        Send a raw command and read its reply. priority (see
+        xia_pfcu.Priority) overrides the default priority of the command
+        """
+        return self.protocol.write_readline(command, priority=priority)
 
-    def enable_shutter(self):
+    def enable_shutter(self, priority=None):
         """
         Enables the shutter commands (Close, Open, Exposure). Useful for
         controlling the XIA Model PF2S2 Filter unit with focal plane shutter.
         """
-        return self.write_readline("2")
+        return self.write_readline("2", priority)
 
-    def disable_shutter(self):
+    def disable_shutter(self, priority=None):
         """
         Disable the shutter commands. This is the default condition at power-up.
         """
-        return self.write_readline("4")
+        return self.write_readline("4", priority)
 
-    def open_shutter(self):
+    def open_shutter(self, priority=None):
         """
         Immediately opens the PF2S2 shutter, beginning an indefinite exposure.
         This command only works if shutter mode is enabled.
         """
-        return self.write_readline("O")
+        return self.write_readline("O", priority)
 
-    def close_shutter(self):
+    def close_shutter(self, priority=None):
         """
         Immediately closes the PF2S2 shutter. If an exposure is in progress,
         it is terminated. This command only works if shutter mode is enabled
         """
-        return self.write_readline("C")
+        return self.write_readline("C", priority)
 
-    def shutter_status(self):
-        return decode_shutter_status(self.write_readline("H"))
+    def shutter_status(self, priority=None):
+        return self.protocol.request("H", decode_shutter_status.func, priority)
 
-    def status(self):
-        return decode_status(self.write_readline("S"))
+    def status(self, priority=None):
+        return self.protocol.request("S", decode_status.func, priority)
 
-    def info(self):
-        return parse_status(self.status())
+    def info(self, priority=None):
+        return self.protocol.request("S", decode_info.func, priority)
 
-    def filters_status(self):
-        return decode_filters_status(self.write_readline("F"))
+    def snapshot(self, priority=None):
+        """
+        Status report as a compact PFCUStatus (see PFCUStatus.diff() to
+        get only what changed between two snapshots)
+        """
+        return self.protocol.request("S", decode_pfcu_status.func, priority)
+
+    def filters_status(self, priority=None):
+        return self.protocol.request("F", decode_filters_status.func, priority)
 
-    def set_filters(self, a=None, b=None, c=None, d=None):
+    def set_filters(self, a=None, b=None, c=None, d=None, wait=False, priority=None):
         """
         Set multiple filters at the same time
         Default value (None) indicates that the filter should not change state.
         "IN", "I", "1" or 1 (case insensitive) indicate the filter should be inserted,
         "OUT", "O", "0" or 0 (case insensitive) indicate the filter should be removed.
 
-        Returns the state of each filter
-        """
-        a = "=" if a is None else str(a)
-        b = "=" if b is None else str(b)
-        c = "=" if c is None else str(c)
-        d = "=" if d is None else str(d)
-        vmap = {
-            "out": "0",
-            "o": "0",
-            "0": "0",
-            "in": "1",
-            "i": "1",
-            "1": "1",
-            "-": "=",
-            "": "=",
-            "=": "=",
-        }
-        values = [vmap[v.lower()] for v in (a, b, c, d)]
-        status = self.write_readline("W " + "".join(values))
-        return decode_filters_status(status)
-
-    def insert_filter(self, filt):
-        fmap = {"a":1,"b":2,"c":3,"d":4}
-        filt = fmap.get(filt, filt)
-        return self.write_readline("I {}".format(filt))
-
-    def remove_filter(self, filt):
-        fmap = {"a":1,"b":2,"c":3,"d":4}
-        filt = fmap.get(filt, filt)
-        return self.write_readline("R {}".format(filt))
-
-    def start_exposure(self, duration):
+        Returns the state of each filter. If wait is True, returns once the
+        filters reached their position (see wait_filters())
+        """
+        values = [filter_value(v) for v in (a, b, c, d)]
+        return self.protocol.set_filters(values, wait=wait, priority=priority)
+
+    def insert_filter(self, filt, wait=False, priority=None):
+        """
+        Insert a filter (1-4 or "a"-"d").
+
+        Concurrent insert/remove calls (async only) are coalesced into a
+        single W command. Returns the state of each filter (once the filter
+        is in if wait is True)
+        """
+        return self.protocol.change_filter(
+            filter_index(filt), "1", wait=wait, priority=priority
+        )
+
+    def remove_filter(self, filt, wait=False, priority=None):
+        """
+        Remove a filter (1-4 or "a"-"d").
+
+        Concurrent insert/remove calls (async only) are coalesced into a
+        single W command. Returns the state of each filter (once the filter
+        is out if wait is True)
+        """
+        return self.protocol.change_filter(
+            filter_index(filt), "0", wait=wait, priority=priority
+        )
+
+    def wait_filters(self, a=None, b=None, c=None, d=None):
+        """
+        Wait for the filters to reach the given state ("in"/1, "out"/0 or
+        None: any) after they were changed. The F status is polled when the
+        filters are expected to arrive, based on the settle time learned
+        for each filter (see xia_pfcu.protocol.SettleModel).
+
+        Returns the state of each filter. Raises PFCUFilterFault as soon as
+        one of them reports an open or short circuit
+        """
+        values = [filter_value(v) for v in (a, b, c, d)]
+        return self.protocol.wait_filters(values)
+
+    def filter_changes(self, wait=False, priority=None):
+        """
+        Returns a context manager which collects filter insert/remove and
+        sends them as a single W command on exit (and waits for the filters
+        to reach their position if wait is True). Example::
+
+            with pfcu.filter_changes() as changes:  # async with for async
+                changes.insert("a")
+                changes.remove(3)
+            print(changes.result)
+        """
+        return FilterChanges(self, wait=wait, priority=priority)
+
+    def start_exposure(self, duration, priority=None):
         """
         Initiates a fixed length exposure using the focal plane shutter
         (enabled only in shutter mode (and RS232 control is enabled))
+
+        Returns a future which is done when the device reports the end of
+        the exposure (ex: `await (await pfcu.start_exposure(0.1))`)
+        """
+        return self.protocol.start_exposure(duration, priority)
+
+    def exposure_sequence(self, durations, priority=None):
+        """
+        Runs one exposure per duration (list or generator), each one started
+        as soon as the device reports the end of the previous one. The
+        decimation (D command) is only sent when it changes.
+
+        Returns a generator (async generator for async) of the effective
+        duration of each exposure, yielded when it ends. Example::
+
+            async for duration in pfcu.exposure_sequence([0.1] * 1000):
+                ...
         """
-        return self.protocol.start_exposure(duration)
+        return self.protocol.exposure_sequence(durations, priority)
 
-    def lock(self):
+    def lock(self, priority=None):
         """
         Set the PFCU such that the non-RS232 controls are ignored. This means
         that the front panel switches and the TTL control lines would be
         ignored, until either an unlock command is issued (see below) or RS232
         control is disabled (using the front panel slide switch).
         """
-        return self.write_readline("L")
+        return self.write_readline("L", priority)
 
-    def unlock(self):
+    def unlock(self, priority=None):
         """
         Unlocks exclusive RS232 control and allows filter control by the front
         panel switches and the TTL inputs, as well as RS232 commands (as long
         as RS232 control is enabled with the front panel switch)
         """
-        return self.write_readline("U")
+        return self.write_readline("U", priority)
 
-    def clear_short_error(self):
+    def clear_short_error(self, priority=None):
         """
         Clears any short conditions existing on any of the 4 channels.
         When a short condition is detected, power is immediately removed, and
@@ -140,7 +288,26 @@ class PFCU:
         original state. The cycle time is much much shorter than the response
         time of the filters, so non-shorted filters are not affected.
         """
-        return self.write_readline("Z")
+        return self.write_readline("Z", priority)
 
-    def set_decimation(self, value):
-        return self.protocol.set_decimation(value)
+    def set_decimation(self, value, priority=None):
+        return self.protocol.set_decimation(value, priority)
+
+    def broadcast(self, operation, modules=None, priority=None):
+        """
+        Run the operation (a PFCU method name without arguments, ex:
+        "close_shutter" or "filters_status", or a raw command) on every
+        module of the line with a single broadcast command.
+
+        Returns a dict of module to result (or to PFCUError if the module
+        replied an error). By default it returns once the modules known on
+        the bus replied and no other module replied for a while (modules not
+        known yet are collected too). If modules is given, it returns as
+        soon as they replied (list all the modules of the line: a late reply
+        of another module is not collected). Either way it returns at the
+        deadline with the replies received so far. Example::
+
+            statuses = await pfcu.broadcast("filters_status")
+        """
+        cmd, decoder = BROADCASTS.get(operation, (operation, None))
+        return self.protocol.write_readall(cmd, decoder, modules, priority)
@@ -1,12 +1,23 @@
+import re
+import sys
 import enum
+import math
 import time
+import random
+import weakref
+import heapq
 import asyncio
 import logging
 import functools
+import concurrent.futures
+import itertools
 import threading
+import collections
 
 from connio import connection_for_url
 
+from .stats import Stats
+
 
 class FilterStatus(enum.IntEnum):
     Out = 0
@@ -20,12 +31,55 @@ class ShutterStatus(enum.IntEnum):
     Closed = 1
 
 
+class Priority(enum.IntEnum):
+    """Command priority on the bus (lower value goes first)"""
+
+    Safety = 0
+    Actuation = 1
+    Configuration = 2
+    Monitoring = 3
+
+
 REQ_HEADER = "!PFCU"
 REP_HEADER = "%"
 BROADCAST = "ALL"
+# pseudo command codes (see timeline): End of Exposure message and filters
+# confirmed in position (see wait_filters())
+END_OF_EXPOSURE = "e"
+FILTERS_SETTLED = "f"
+
+# commands without arguments (encoded once per module)
+FIXED_COMMANDS = ("H", "F", "S", "P", "O", "C", "L", "U", "2", "4", "Z")
 
 VALID_MODULES = ["{:02d}".format(i) for i in range(16)] + [BROADCAST]
 
+# read-only commands (by PFCU method name)
+QUERIES = {
+    "status": "S",
+    "shutter_status": "H",
+    "filters_status": "F",
+    "position": "P",
+}
+
+# default priority by command (others are Priority.Configuration)
+PRIORITIES = {
+    "C": Priority.Safety,
+    "O": Priority.Actuation,
+    "E": Priority.Actuation,
+    "W": Priority.Actuation,
+    "I": Priority.Actuation,
+    "R": Priority.Actuation,
+    "Z": Priority.Actuation,
+    "S": Priority.Monitoring,
+    "H": Priority.Monitoring,
+    "F": Priority.Monitoring,
+    "P": Priority.Monitoring,
+}
+
+
+def command_priority(cmd):
+    return PRIORITIES.get(cmd[:1].upper(), Priority.Configuration)
+
 
 def syncer(func):
     async def acall(coro):
@@ -35,9 +89,20 @@ def syncer(func):
     def wrapper(arg):
         return acall(arg) if asyncio.iscoroutine(arg) else func(arg)
 
+    # plain (sync only) version for callers that know what they have
+    wrapper.func = func
     return wrapper
 
 
+def module_name(module):
+    """Normalizes a module address (ex: 2 -> "02")"""
+    module = str(module).upper()
+    if module != BROADCAST and module.isdigit():
+        module = "{:02d}".format(int(module))
+    assert module in VALID_MODULES
+    return module
+
+
 def yes_no(text):
     return "YES" in text
 
@@ -46,20 +111,223 @@ class PFCUError(Exception):
     pass
 
 
+class PFCUTimeoutError(PFCUError, TimeoutError):
+    pass
+
+
+class PFCUConnectionError(PFCUError, ConnectionError):
+    pass
+
+
+class PFCUFilterFault(PFCUError):
+    """A filter being moved reports an open or short circuit"""
+
+    def __init__(self, module, faults):
+        self.module = module
+        # {filter number (1-4): FilterStatus}
+        self.faults = faults
+        super().__init__(
+            "Module {} filter fault: {}".format(
+                module,
+                ", ".join(
+                    "{} {}".format(nb, status.name)
+                    for nb, status in sorted(faults.items())
+                ),
+            )
+        )
+
+
+def is_connection_error(error):
+    """True if the error means the transport is broken (not a device error)"""
+    if isinstance(error, PFCUError):
+        return False
+    return isinstance(error, (OSError, EOFError, asyncio.TimeoutError))
+
+
 def encode(module, cmd):
     return "{}{} {}\r".format(REQ_HEADER, module, cmd).encode()
 
 
+def command_code(data):
+    """Command code of the given raw request (ex: b"!PFCU15 D 10\r" -> "D")"""
+    return data.split(b" ", 2)[1][:1].decode()
+
+
+def reply_module(reply):
+    """Module address of the given raw reply (ex: b"%PFCU15 OK..." -> "15")"""
+    head = reply.split(b" ", 1)[0]
+    # (line noise is not always valid text)
+    return head[len(REP_HEADER) + 4 :].decode(errors="replace")
+
+
+def discarded_module(frame):
+    """
+    Stats label of the module of a discarded frame: "?" for garbage which
+    doesn't come from a valid module (keeps the counter keys bounded)
+    """
+    if frame[:1] == REP_HEADER.encode():
+        module = reply_module(frame)
+        if module in VALID_MODULES:
+            return module
+    return "?"
+
+
+def same_module(a, b):
+    """True if both module addresses are the same (ex: "02" and "2")"""
+    return a == b or (a.isdigit() and b.isdigit() and int(a) == int(b))
+
+
+# expected shape of the text of an OK reply (by command code)
+_SHUTTER = re.compile(rb"Shutter (Open|Closed)")
+_FILTERS = re.compile(rb"[0-3]{4}\b")
+REPLY_SHAPES = {
+    "H": _SHUTTER,
+    "O": _SHUTTER,
+    "C": _SHUTTER,
+    "S": re.compile(rb"PFCU.*Exposure Decimation", re.DOTALL),
+    "F": _FILTERS,
+    "P": _FILTERS,
+    "W": _FILTERS,
+    "I": _FILTERS,
+    "R": _FILTERS,
+    "Z": _FILTERS,
+    "D": re.compile(rb"Decimation"),
+    "E": re.compile(rb"Exposure Started"),
+    "L": re.compile(rb"Locked"),
+    "U": re.compile(rb"Unlocked"),
+    "2": re.compile(rb"Shutter mode"),
+    "4": re.compile(rb"Shutter mode"),
+}
+
+
+def reply_matches(reply, module, code):
+    """
+    True if the raw reply can be the answer to the command with the given
+    code sent to the given module (same module header and expected shape)
+    """
+    if reply[:1] != REP_HEADER.encode():
+        return False
+    if module != BROADCAST and not same_module(reply_module(reply), module):
+        return False
+    try:
+        _, result, text = reply.split(b" ", 2)
+    except ValueError:
+        return False
+    if result != b"OK":
+        return True  # error replies have no particular shape
+    shape = REPLY_SHAPES.get(code)
+    return shape is None or shape.match(text) is not None
+
+
+class Request:
+    """Request waiting for its reply on the line"""
+
+    __slots__ = ("module", "code", "deadline", "reply", "cancelled")
+
+    # the holder of the line blocks reading its reply
+    blocking = True
+
+    def __init__(self, module, code, deadline):
+        self.module = module
+        self.code = code
+        self.deadline = deadline
+        self.reply = None
+        # the caller gave up: its (late) reply is discarded
+        self.cancelled = False
+
+    def matches(self, reply):
+        return reply_matches(reply, self.module, self.code)
+
+
+class Collector:
+    """
+    Broadcast request collecting the reply of every module on the line.
+
+    If the modules expected to reply are given, it is complete as soon as
+    they all replied. Otherwise modules not known yet may reply too: once
+    the known modules replied, the holder of the line stops blocking on it
+    and polls it for the other replies until the line is quiet (no reply
+    during QUIET_INTERVALS times the mean interval between replies) or the
+    deadline
+    """
+
+    MIN_QUIET = 0.05
+    QUIET_INTERVALS = 2
+
+    def __init__(self, code, deadline, expected=None, known=()):
+        self.module = BROADCAST
+        self.code = code
+        self.deadline = deadline
+        self.expected = None if expected is None else set(expected)
+        self.known = set(known)
+        self.replies = {}
+        self.reply = None
+        self.cancelled = False
+        self.start = self.last = time.monotonic()
+
+    @property
+    def complete(self):
+        if self.expected is None:
+            # every module address replied
+            return len(self.replies) == len(VALID_MODULES) - 1
+        return self.expected <= set(self.replies)
+
+    @property
+    def blocking(self):
+        waited = self.known if self.expected is None else self.expected
+        return not waited <= set(self.replies)
+
+    def quiet(self, now):
+        if self.blocking or not self.replies:
+            return False
+        interval = (self.last - self.start) / len(self.replies)
+        quiet = max(self.MIN_QUIET, self.QUIET_INTERVALS * interval)
+        return now - self.last >= quiet
+
+    def matches(self, reply):
+        return reply_matches(reply, BROADCAST, self.code) and (
+            reply_module(reply) not in self.replies
+        )
+
+    def add(self, reply):
+        self.replies[reply_module(reply)] = reply
+        self.last = time.monotonic()
+
+
+def in_waiting(conn):
+    """Number of bytes waiting in the connection input buffer (if supported)"""
+    n = getattr(conn, "in_waiting", 0)
+    return n() if callable(n) else n
+
+
+async def ain_waiting(conn):
+    n = in_waiting(conn)
+    return (await n) if asyncio.iscoroutine(n) else n
+
+
+if hasattr(asyncio, "timeout"):
+
+    async def wait_for(awaitable, timeout):
+        """asyncio.wait_for without its extra task (python >= 3.11)"""
+        async with asyncio.timeout(timeout):
+            return await awaitable
+
+else:
+    wait_for = asyncio.wait_for
+
+
 def decode(reply):
-    reply = reply.decode()
-    assert reply.startswith(REP_HEADER)
-    pfcu, result, text = reply.split(" ", 2)
-    result = "OK" if result == "OK" else "ERROR"
-    text = text.replace("DONE", "")
-    text = text.strip()
-    text = text.rstrip(";")
-    text = text.strip()
-    if result == "ERROR":
+    """
+    Decode a raw reply (ex: b"%PFCU15 OK Shutter Open DONE;\r\n") into its
+    text (ex: "Shutter Open"). Raises PFCUError if the device reports an error
+    """
+    assert reply[:1] == b"%"
+    _, result, text = reply.split(b" ", 2)
+    text = text.rstrip(b" ;\r\n")
+    if text.endswith(b"DONE"):
+        text = text[:-4].rstrip()
+    text = text.rstrip(b";").strip().decode()
+    if result != b"OK":
         raise PFCUError(text)
     return text
 
@@ -84,156 +352,1750 @@ def decode_filters_status(status):
     return [FilterStatus(int(channel)) for channel in status]
 
 
-def sec_to_exposure_decimation(sec):
+EXPOSURE_TICK = 10e-3  # exposure unit (s)
+MAX_EXPOSURE = MAX_DECIMATION = 2 ** 16 - 1
+# number of decimations tried (starting from the smallest possible one)
+DECIMATION_SEARCH = 256
+
+
+def sec_to_exposure_decimation(sec, decimation=None):
     """
-    Convert seconds to exposure and decimation.
+    Convert seconds to exposure and decimation (the device exposes during
+    exposure * decimation * 10ms).
 
-    The algorithm is limited since it multiplies decimation by 10 until the
-    resulting exposure is less than 65_535. This is not perfect because it
-    limits decimation to 10_000 (the next step would be 100_000 which is
-    bigger then max decimation of 65_535).
-    The max theoretical value is ~497 days. This algorithm is limited to
-    ~75 days. If it is not enough for you feel free to improve it :-)
+    Covers the full range (up to 65535 * 65535 * 10ms, ~497 days) with
+    the split of least quantization error (searching the decimations
+    close to the smallest possible one). If the given (current) decimation
+    is as good as the best split it is kept, so that no D command is
+    needed.
+    """
+    ticks = round(sec / EXPOSURE_TICK, 9)
+    return _exposure_decimation(ticks, decimation)
+
+
+@functools.lru_cache(maxsize=1024)
+def _exposure_decimation(ticks, current):
+    if not 0 <= ticks <= MAX_EXPOSURE * MAX_DECIMATION:
+        raise ValueError("Exposure out of range: {}s".format(ticks * EXPOSURE_TICK))
+    lowest = max(1, math.ceil(ticks / MAX_EXPOSURE))
+    stop = min(lowest + DECIMATION_SEARCH, MAX_DECIMATION + 1)
+    decimations = range(lowest, stop)
+    if current is not None and lowest <= current <= MAX_DECIMATION:
+        decimations = itertools.chain((current,), decimations)
+    # exposure * decimation is an integer: can't do better than that
+    floor = abs(ticks - round(ticks))
+    best = None
+    for decimation in decimations:
+        exposure = min(round(ticks / decimation), MAX_EXPOSURE)
+        error = abs(exposure * decimation - ticks)
+        if best is None or error < best[0]:
+            best = error, exposure, decimation
+            if error <= floor + 1e-9:
+                break
+    return best[1], best[2]
+
+
+class ChannelStatus(
+    collections.namedtuple(
+        "ChannelStatus", "nb in_out front_panel ttl rs232 shorted open"
+    )
+):
+    """Status of one filter channel (as reported in the S status report)"""
+
+    __slots__ = ()
 
-    (max theoretical = datetime.timedelta(seconds = 2**16 * 2**16 * 10E-3))
+
+class PFCUStatus(
+    collections.namedtuple(
+        "PFCUStatus",
+        "id channels remote_control_enabled remote_control_only "
+        "shutter_enabled shutter_status decimation",
+    )
+):
+    """
+    Compact (immutable) model of the S status report. channels is a tuple of
+    4 ChannelStatus. Equal channels and strings are shared between
+    instances and parsing a recently seen report returns the same instance,
+    so keeping many snapshots is cheap.
     """
-    decimation = 1
-    deci_millis = sec * 100
-    while (2 ** 16 * decimation) < deci_millis:
-        decimation *= 10
-    exposure = round(deci_millis / decimation)
-    return exposure, decimation
 
+    __slots__ = ()
 
-@syncer
-def parse_status(status):
-    lines = status.split("\n")
-    channels = []
-    for i in range(4):
-        nb, inout, fpanel, ttl, rs232, shorted, open = lines[2 + i].split()
-        ch = dict(
+    @classmethod
+    def from_text(cls, status):
+        return _status_from_text(cls, status)
+
+    @classmethod
+    def _from_text(cls, status):
+        match = _STATUS_RE.match(status)
+        if match is None:
+            raise PFCUError("Unexpected status: {!r}".format(status))
+        groups = match.groups()
+        channels = tuple(_channel(groups[1 + 7 * i : 8 + 7 * i]) for i in range(4))
+        shutter = groups[31]
+        shutter_enabled = yes_no(shutter)
+        if shutter_enabled:
+            shutter_status = "Closed" if "closed" in shutter.lower() else "Open"
+        else:
+            shutter_status = "Disabled"
+        return cls(
+            sys.intern(groups[0]),
+            channels,
+            yes_no(groups[29]),
+            yes_no(groups[30]),
+            shutter_enabled,
+            shutter_status,
+            int(groups[32]),
+        )
+
+    def to_dict(self):
+        result = self._asdict()
+        result["channels"] = [dict(ch._asdict()) for ch in self.channels]
+        return dict(result)
+
+    def diff(self, previous):
+        """
+        Fields which changed since the previous status (None means
+        everything changed). Channel fields are named "channel<nb>.<field>"
+        (ex: {"shutter_status": "Open", "channel3.in_out": "In"})
+        """
+        if previous is None:
+            previous = self._make([None] * len(self._fields))
+        changes = {}
+        for field, value, old in zip(self._fields, self, previous):
+            if field == "channels":
+                old = old or (None,) * len(value)
+                for channel, old_channel in zip(value, old):
+                    if channel == old_channel:
+                        continue
+                    old_channel = old_channel or (None,) * len(channel)
+                    for name, v, o in zip(channel._fields, channel, old_channel):
+                        if v != o:
+                            changes["channel{}.{}".format(channel.nb, name)] = v
+            elif value != old:
+                changes[field] = value
+        return changes
+
+
+_CHANNEL_RE = r" *(\d+)" + 6 * r" +(\S+)" + r" *\n"
+_STATUS_RE = re.compile(
+    r"(.*)\n.*\n"
+    + 4 * _CHANNEL_RE
+    + 3 * r"[^:\n]*: *(.*)\n"
+    + r"[^:\n]*: *(\d+)"
+)
+_status_from_text = functools.lru_cache(maxsize=64)(
+    lambda cls, status: cls._from_text(status)
+)
+_WORDS = {"IN": "In", "OUT": "Out"}
+_CHANNELS = {}
+
+
+def _word(text):
+    return _WORDS.get(text.upper()) or text.capitalize()
+
+
+def _channel(fields):
+    channel = _CHANNELS.get(fields)
+    if channel is None:
+        nb, inout, fpanel, ttl, rs232, shorted, open = fields
+        channel = ChannelStatus(
             nb=int(nb),
-            in_out=inout.capitalize(),
-            front_panel=fpanel.capitalize(),
-            ttl=ttl.capitalize(),
-            rs232=rs232.capitalize(),
+            in_out=_word(inout),
+            front_panel=_word(fpanel),
+            ttl=_word(ttl),
+            rs232=_word(rs232),
             shorted=yes_no(shorted),
             open=yes_no(open),
         )
-        channels.append(ch)
-
-    shutter_enabled = yes_no(lines[-2])
-    if shutter_enabled:
-        shutter_status = "Closed" if "closed" in lines[-2].lower() else "Open"
-    else:
-        shutter_status = "Disabled"
-    return {
-        "id": lines[0],
-        "channels": channels,
-        "remote_control_enabled": yes_no(lines[-4]),
-        "remote_control_only": yes_no(lines[-3]),
-        "shutter_enabled": shutter_enabled,
-        "shutter_status": shutter_status,
-        "decimation": int(lines[-1].rsplit(" ", 1)[-1]),
-    }
+        _CHANNELS[fields] = channel
+    return channel
 
 
-class BaseProtocol:
+@syncer
+def parse_status(status):
+    return PFCUStatus.from_text(status).to_dict()
+
+
+@syncer
+def decode_pfcu_status(status):
+    return PFCUStatus.from_text(decode_status.func(status))
+
+
+@syncer
+def decode_info(status):
+    return parse_status.func(decode_status.func(status))
+
+
+class ReplyCache:
     """
-    Handles communication protocol
-    - latency / back-pressure
-    - encode/decode bytes <-> text
-    - serializes read calls
+    Caches the replies of read-only queries for a configurable time (TTL).
+
+    ttl is either a number (same TTL for all queries) or a dict which maps
+    query (either the command (ex: "S") or the PFCU method name (ex:
+    "status")) to the TTL in seconds. Queries without TTL are not cached.
+
+    Any other command invalidates the cache. Open/close shutter, whose reply
+    tells the new state, update it instead (the reply of a filter change
+    tells the positions before the filters move).
+    """
+
+    def __init__(self, ttl):
+        if not isinstance(ttl, dict):
+            ttl = {query: ttl for query in QUERIES.values()}
+        self.ttl = {QUERIES.get(query, query): t for query, t in ttl.items()}
+        self._replies = {}
+
+    def get(self, cmd):
+        reply = self._replies.get(cmd)
+        if reply is not None and reply[1] > time.monotonic():
+            return reply[0]
+
+    def put(self, cmd, reply):
+        ttl = self.ttl.get(cmd)
+        if ttl:
+            self._replies[cmd] = reply, time.monotonic() + ttl
+
+    def clear(self):
+        self._replies.clear()
+
+    def update(self, cmd, reply):
+        """
+        Update the cache with the reply of the given command. A reply of
+        None means the command failed.
+        """
+        if cmd in QUERIES.values():
+            # (queries without TTL are not cached but don't invalidate it)
+            if reply is not None:
+                self.put(cmd, reply)
+            return
+        self.clear()
+        if reply is None:
+            return
+        if cmd in ("O", "C"):
+            self.put("H", reply)
+
+
+class LatencyModel:
+    """
+    Running model of the round-trip time (RTT) of each command code:
+    smoothed RTT and RTT deviation (EWMA, as TCP does for its retransmission
+    timeout) plus the last samples for percentiles.
+
+    Used by the bus for per-command timeouts (never below MIN_TIMEOUT, as
+    TCP's retransmission timeout: a timeout drops the connection, so a short
+    stall of the host must not cause one) and to predict how long a new
+    command would wait in the queue.
+
+    The minimum gap between commands is not learned: the device doesn't
+    tell when it is ready for the next command, so it is configured (min_gap
+    and gaps by command code).
+    """
+
+    ALPHA = 0.125  # smoothed RTT gain
+    BETA = 0.25  # RTT deviation gain
+    SAMPLES = 64  # samples kept (per command) for percentiles
+    DEFAULT_RTT = 0.5  # expected RTT of a command never seen before
+    DEFAULT_TIMEOUT = 2.0  # timeout of a command never seen before
+    MIN_TIMEOUT_MARGIN = 0.1
+    MIN_TIMEOUT = 1.0
+    MAX_TIMEOUT = 10.0
+
+    def __init__(self, min_gap=0.0, gaps=None):
+        # minimum time between the end of a command and the next one
+        self.min_gap = min_gap
+        self.gaps = dict(gaps or {})
+        self._srtt = {}
+        self._rttvar = {}
+        self._samples = {}
+        self._backoff = {}
+
+    def update(self, code, rtt):
+        srtt = self._srtt.get(code)
+        if srtt is None:
+            self._srtt[code] = rtt
+            self._rttvar[code] = rtt / 2
+            self._samples[code] = collections.deque(maxlen=self.SAMPLES)
+        else:
+            self._rttvar[code] += self.BETA * (abs(srtt - rtt) - self._rttvar[code])
+            self._srtt[code] = srtt + self.ALPHA * (rtt - srtt)
+        self._samples[code].append(rtt)
+        self._backoff.pop(code, None)
+
+    def timed_out(self, code):
+        # double the timeout until the next reply (the device may have
+        # become slower: don't time out forever)
+        self._backoff[code] = 2 * self._backoff.get(code, 1)
+
+    def expected(self, code):
+        """Expected RTT for the given command code"""
+        return self._srtt.get(code, self.DEFAULT_RTT)
+
+    def timeout(self, code):
+        srtt = self._srtt.get(code)
+        if srtt is None:
+            timeout = self.DEFAULT_TIMEOUT * self._backoff.get(code, 1)
+            return min(timeout, self.MAX_TIMEOUT)
+        margin = max(self.MIN_TIMEOUT_MARGIN, 4 * self._rttvar[code])
+        timeout = max(srtt + margin, self.MIN_TIMEOUT) * self._backoff.get(code, 1)
+        return min(timeout, self.MAX_TIMEOUT)
+
+    def gap(self, code):
+        """Configured minimum time between the given command and the next one"""
+        return self.gaps.get(code, self.min_gap)
+
+    def percentile(self, code, q):
+        """q-th percentile (0-100) of the last RTT samples (None if unknown)"""
+        samples = sorted(self._samples.get(code, ()))
+        if samples:
+            return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+    def summary(self):
+        return {
+            code: dict(
+                srtt=srtt,
+                rttvar=self._rttvar[code],
+                timeout=self.timeout(code),
+                p50=self.percentile(code, 50),
+                p99=self.percentile(code, 99),
+            )
+            for code, srtt in self._srtt.items()
+        }
+
+
+class SettleModel:
+    """
+    Learned time the filters take to reach their target once the command
+    is acknowledged (smoothed per module, filter and direction).
+
+    Used to wait for the filters (see AIOProtocol.wait_filters()): the
+    first F poll is made when the slowest filter is expected to arrive,
+    then the line is polled every POLL_FRACTION of the expected time, but
+    never more often than the F round trip time (the line is shared)
     """
 
+    ALPHA = 0.25  # smoothed settle time gain
+    DEFAULT_SETTLE = 0.1  # expected settle time of a filter never seen before
+    EARLY = 0.8  # first poll at EARLY * expected settle time
+    POLL_FRACTION = 0.25
+    MIN_POLL = 0.02
+    MIN_TIMEOUT = 1.0
+    TIMEOUT_FACTOR = 4
+
+    def __init__(self):
+        self._settle = {}
+
+    def update(self, key, settle):
+        current = self._settle.get(key)
+        if current is None:
+            self._settle[key] = settle
+        else:
+            self._settle[key] = current + self.ALPHA * (settle - current)
+
+    def expected(self, keys):
+        """Expected time for all the given (module, index, value) to settle"""
+        return max(
+            (self._settle.get(key, self.DEFAULT_SETTLE) for key in keys),
+            default=0.0,
+        )
+
+    def timeout(self, keys):
+        return max(self.MIN_TIMEOUT, self.TIMEOUT_FACTOR * self.expected(keys))
+
+    def next_poll(self, keys, elapsed, rtt=None):
+        """Time until the next F poll (rtt: F round trip time, if known)"""
+        expected = self.expected(keys)
+        floor = max(self.MIN_POLL, rtt or 0.0)
+        first = self.EARLY * expected - elapsed
+        if first > floor:
+            return first
+        return max(floor, self.POLL_FRACTION * expected)
+
+    def summary(self):
+        return {
+            "{} {} {}".format(module, index + 1, "in" if value == "1" else "out"): t
+            for (module, index, value), t in self._settle.items()
+        }
+
+
+class LinkState:
+    """
+    State of the connection of a line. While it is down, reconnection
+    attempts are spaced with a jittered exponential backoff and commands
+    fail fast in between (see check())
+    """
+
+    MIN_DELAY = 0.1  # delay after the first failed reconnection attempt
+    MAX_DELAY = 30.0
+    CONNECT_TIMEOUT = 2.0
+
+    def __init__(self):
+        self.down_since = None
+        self.retry_at = 0.0
+        self.failures = 0
+        self.error = None
+
+    @property
+    def down(self):
+        return self.down_since is not None
+
+    def broken(self, error):
+        if self.down_since is None:
+            # first reconnection attempt right away
+            self.down_since = self.retry_at = time.monotonic()
+        self.error = error
+
+    def attempt_failed(self, error):
+        self.broken(error)
+        delay = min(self.MIN_DELAY * 2 ** self.failures, self.MAX_DELAY)
+        self.failures += 1
+        # jitter: gateways restarting at once are not all retried at once
+        self.retry_at = time.monotonic() + random.uniform(delay / 2, delay)
+
+    def recovered(self):
+        self.down_since = None
+        self.retry_at = 0.0
+        self.failures = 0
+        self.error = None
+
+    def check(self):
+        """Raises PFCUConnectionError if the line is down until the next attempt"""
+        if self.down_since is None:
+            return
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise PFCUConnectionError(
+                "Line down for {:.1f}s (next attempt in {:.1f}s): {!r}".format(
+                    now - self.down_since, self.retry_at - now, self.error
+                )
+            )
+
+
+class BaseBus:
+    """
+    Owns the connection to a serial line shared by up to 16 modules
+    - latency / back-pressure (shared by all modules on the line)
+    - scheduling of the commands by priority (see Priority) and, within
+      the same priority, fair between the different modules
+    - the holder of the line (the command being sent) reads its reply in
+      its own task (thread for sync), routing every frame it reads: to the
+      pending request if it matches its module and expected shape (see
+      reply_matches(); stale or garbage frames are discarded) and
+      unsolicited messages (ex: "End of Exposure") to subscribers. While an
+      exposure is running, a reader takes the line when it is idle to
+      route the unsolicited messages
+    - broadcast commands which collect the reply of every module (see
+      write_readall())
+    - reconnection when the transport breaks (see LinkState)
+    - optional timeline of the shutter and filter transitions (see
+      xia_pfcu.timeline.Timeline)
+    """
+
+    # default minimum time between two commands (see LatencyModel)
     COMMAND_LATENCY = 0.0
 
-    def __init__(self, connection, module=BROADCAST, log=None):
-        module = str(module)
-        assert module in VALID_MODULES
+    # period to check for unsolicited messages while the line is idle and
+    # some exposure is running
+    IDLE_POLL = 0.05
+    # period to check for the end of an exposure during END_POLL_WINDOW
+    # after its expected end (so that exposures can be chained quickly)
+    END_POLL = 0.002
+    END_POLL_WINDOW = 0.1
+    # period to check for the replies of modules not known yet to a
+    # broadcast (see Collector)
+    COLLECT_POLL = 0.005
+
+    def __init__(self, connection, log=None, timeline=None):
         self.conn = connection
-        self.module = module
+        self.timeline = timeline
+        self.latency = LatencyModel(min_gap=self.COMMAND_LATENCY)
+        self.settle = SettleModel()
+        self.link = LinkState()
+        self.stats = Stats()
         self._last_command = 0
+        self._last_code = None
+        self._busy = False
+        self._waiters = []
+        self._pending = collections.Counter()
+        self._seq = itertools.count()
+        self._handles = {}
+        self._caches = weakref.WeakSet()
+        # last decimation set on each module (see BaseProtocol.set_decimation)
+        self._decimations = {}
+        # request waiting for its reply (or a cancelled one for its late reply)
+        self._inflight = None
+        # modules which replied on this line (expected to answer broadcasts)
+        self._seen = set()
+        self._current = None
+        self._queries = {}
+        self._queries_lock = threading.Lock()
+        self._reader = None
+        self._exposures = collections.defaultdict(list)
+        self._exposure_ends = []
+        self._exposures_lock = threading.Lock()
+        self._subscribers = []
         self._log = log or logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
 
     def _wait_time(self):
-        return self._last_command + self.COMMAND_LATENCY - time.monotonic()
+        gap = self.latency.gap(self._last_code)
+        return self._last_command + gap - time.monotonic()
 
-    def set_decimation(self, value):
-        return self.write_readline("D {}".format(int(value)))
+    def _ticket(self, module, priority, code):
+        # higher priority first. Then modules with less pending commands go
+        # first: round-robin between modules and FIFO within the same module
+        ticket = priority, self._pending[module], next(self._seq), code
+        self._pending[module] += 1
+        return ticket
 
+    def _leave(self, module):
+        self._pending[module] -= 1
+        if not self._pending[module]:
+            del self._pending[module]
 
-class AIOProtocol(BaseProtocol):
+    def predicted_wait(self, priority=Priority.Configuration):
+        """
+        Predicted time (s) a new command with the given priority would wait
+        before being sent (based on the commands in flight and in the queue)
+        """
+        latency = self.latency
+        wait = 0.0
+        if self._busy and self._current is not None:
+            code, start = self._current
+            wait = max(latency.expected(code) - (time.monotonic() - start), 0.0)
+        for ticket in self._queued():
+            if ticket[0] <= priority:
+                wait += latency.expected(ticket[3]) + latency.gap(ticket[3])
+        return wait
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._lock = asyncio.Lock()
+    def _sending(self, request, code):
+        # (in flight before it is written: its reply may come before write()
+        # returns)
+        self._current = code, time.monotonic()
+        self._inflight = request
+
+    def _failed(self, request, error):
+        if self._inflight is not request:
+            return
+        if isinstance(error, Exception):
+            self._inflight = None
+        else:
+            # cancelled: the next holder of the line discards its late reply
+            request.cancelled = True
+
+    def _done(self, module, code, error=None, collected=False):
+        current, self._current = self._current, None
+        self._last_code = code
+        self._last_command = time.monotonic()
+        if current is None:
+            return
+        stats = self.stats
+        stats.count("commands", module, code)
+        if error is None:
+            rtt = self._last_command - current[1]
+            if not collected:
+                # (the RTT of a collected broadcast is the one of N replies)
+                self.latency.update(code, rtt)
+            stats.observe("wire", module, code, rtt)
+            return
+        stats.count("errors", module, code)
+        if isinstance(error, TimeoutError):
+            stats.count("timeouts", module, code)
+            self.latency.timed_out(code)
+
+    def _waited(self, name, module, code, start):
+        now = time.monotonic()
+        self.stats.observe(name, module, code, now - start)
+        return now
+
+    @property
+    def modules(self):
+        """Modules known on the line (with a handle or which replied)"""
+        return self._seen | (set(self._handles) - {BROADCAST})
+
+    def _new_request(self, module, code, collect, expected):
+        """(request, timeout) of a command (see Collector if collect is True)"""
+        timeout = self.latency.timeout(code)
+        if not collect:
+            return Request(module, code, time.monotonic() + timeout), timeout
+        known = self.modules
+        # replies come one module after the other
+        replies = len(known if expected is None else expected)
+        timeout += self.latency.expected(code) * max(replies - 1, 0)
+        timeout = min(timeout, self.latency.MAX_TIMEOUT)
+        deadline = time.monotonic() + timeout
+        return Collector(code, deadline, expected, known), timeout
+
+    def _expected_modules(self, modules):
+        if modules is not None:
+            return {module_name(module) for module in modules}
+
+    def _collected(self, request):
+        # deadline reached: the modules which did not reply yet are absent
+        if isinstance(request, Collector) and request.replies:
+            return dict(request.replies)
+
+    def _close_quiet(self, request, now):
+        # no other module replied for a while (see Collector)
+        if request.quiet(now):
+            self._inflight = None
+            request.reply = dict(request.replies)
+            return True
+        return False
+
+    def _timeout_error(self, data, timeout):
+        return PFCUTimeoutError("No reply to {!r} after {:.3f}s".format(data, timeout))
+
+    def _check_link(self, module, code):
+        try:
+            self.link.check()
+        except PFCUConnectionError:
+            self.stats.count("rejected", module, code)
+            raise
+
+    def _must_connect(self):
+        return self.link.down or not getattr(self.conn, "is_open", True)
+
+    def _connected(self, module, code):
+        link = self.link
+        if link.down:
+            self._log.info(
+                "line back after %.1fs", time.monotonic() - link.down_since
+            )
+            self.stats.count("reconnects", module, code)
+            # the device state may have changed while we were away
+            self._invalidate_caches()
+        link.recovered()
+
+    def _connect_failed(self, module, code, error):
+        self.link.attempt_failed(error)
+        self.stats.count("connect_errors", module, code)
+        self._log.warning("could not connect: %r", error)
+        return PFCUConnectionError("Could not connect: {!r}".format(error))
+
+    def _broken(self, module, code, error):
+        if not self.link.down:
+            self._log.warning("connection lost: %r", error)
+            self.stats.count("disconnects", module, code)
+        self.link.broken(error)
+        self._fail_exposures(error)
+        return PFCUConnectionError("Connection lost: {!r}".format(error))
+
+    def _fail_exposures(self, error):
+        # the end of exposure message is lost with the connection
+        with self._exposures_lock:
+            futures = [f for fs in self._exposures.values() for f in fs]
+            self._exposures.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(
+                    PFCUConnectionError("Connection lost: {!r}".format(error))
+                )
+
+    def _invalidate_caches(self):
+        self._decimations.clear()
+        for cache in self._caches:
+            cache.clear()
+
+    def add_cache(self, cache):
+        """
+        Register a ReplyCache to be cleared when the state of the modules is
+        no longer known (reconnection, broadcast command)
+        """
+        self._caches.add(cache)
+
+    def decimation(self, module):
+        """Last decimation set on the module (None if unknown)"""
+        return self._decimations.get(module)
+
+    def update_state(self, module, cmd, reply):
+        """
+        Update what the bus knows about the state of the module (caches,
+        decimation, timeline) after the given command. reply is its decoded
+        reply (None if it failed)
+        """
+        if module == BROADCAST and cmd not in QUERIES.values():
+            # a broadcast changes the state of every module on the line
+            self._invalidate_caches()
+        if self.timeline is not None:
+            self.timeline.record(module, cmd, reply)
+        if cmd.startswith("D"):
+            if reply is None:
+                self._decimations.pop(module, None)
+            else:
+                self._decimations[module] = int(cmd[2:])
+
+    def subscribe(self, callback):
+        """
+        Register a callback to be called with (module, text) for every
+        unsolicited message (ex: "End of Exposure") received on the line
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def expect_end_of_exposure(self, module, duration=None):
+        """
+        Returns a future which is done when the given module reports the end
+        of exposure (any module if module is BROADCAST). The expected
+        duration (s), if given, is used to detect the end sooner
+        """
+        future = self._new_future()
+        with self._exposures_lock:
+            futures = self._exposures[module]
+            futures[:] = [f for f in futures if not f.done()]
+            futures.append(future)
+            if duration is not None:
+                self._exposure_ends.append(time.monotonic() + duration)
+        self._ensure_reader()
+        return future
+
+    def _exposure_running(self):
+        with self._exposures_lock:
+            for module, futures in list(self._exposures.items()):
+                futures[:] = [f for f in futures if not f.done()]
+                if not futures:
+                    del self._exposures[module]
+            if not self._exposures:
+                self._exposure_ends.clear()
+            return bool(self._exposures)
+
+    def _poll_interval(self):
+        """
+        Time until the next check for unsolicited messages (None if no
+        exposure is running)
+        """
+        if not self._exposure_running():
+            return None
+        now = time.monotonic()
+        with self._exposures_lock:
+            window = now - self.END_POLL_WINDOW
+            ends = [end for end in self._exposure_ends if end > window]
+            self._exposure_ends = ends
+        if not ends:
+            return self.IDLE_POLL
+        return min(max(min(ends) - now, self.END_POLL), self.IDLE_POLL)
+
+    def _route(self, frame):
+        if b"End of Exposure" in frame:
+            self._on_unsolicited(frame)
+            return
+        request = self._inflight
+        if request is None or not request.matches(frame):
+            # garbage or stale reply (ex: extra replies to a broadcast)
+            self._log.warning("discarded unexpected reply %r", frame)
+            self.stats.count("discarded", discarded_module(frame), "")
+            return
+        self._seen.add(reply_module(frame))
+        if isinstance(request, Collector):
+            request.add(frame)
+            if not request.complete:
+                return
+            frame = dict(request.replies)
+        self._inflight = None
+        if request.cancelled:
+            # late reply of a cancelled request
+            self._log.debug("discarded late reply %r", frame)
+            self.stats.count("discarded", request.module, request.code)
+        else:
+            request.reply = frame
+
+    def _route_frame(self, frame):
+        # nothing (ex: a garbage frame) may fail the read
+        try:
+            self._route(frame)
+        except Exception:
+            self._log.exception("error routing frame %r", frame)
+
+    def _on_unsolicited(self, frame):
+        module, text = reply_module(frame), frame.decode(errors="replace").strip()
+        self._log.debug("unsolicited message %r", text)
+        with self._exposures_lock:
+            futures = self._exposures.pop(module, [])
+            futures += self._exposures.pop(BROADCAST, [])
+        for future in futures:
+            if not future.done():
+                future.set_result(text)
+        for callback in self._subscribers:
+            try:
+                callback(module, text)
+            except Exception:
+                self._log.exception("error in subscriber %r", callback)
+        if self.timeline is not None:
+            self.timeline.record(module, END_OF_EXPOSURE, text)
+
+    def _read_failed(self, error):
+        # error of the reader (no command on the line)
+        self._log.warning("error reading from line: %r", error)
+        if is_connection_error(error):
+            self._broken(BROADCAST, "", error)
+
+    def pfcu(self, module, **kwargs):
+        """
+        Returns the PFCU handle for the given module on this line
+        (the same handle is returned for the same module; kwargs are only
+        used when the handle is created)
+        """
+        from .pfcu import PFCU
+
+        module = module_name(module)
+        handle = self._handles.get(module)
+        if handle is None:
+            handle = self._handles[module] = PFCU(self, module=module, **kwargs)
+        return handle
+
+
+class AIOBus(BaseBus):
+    def _new_future(self):
+        return asyncio.get_event_loop().create_future()
 
     async def _back_pressure(self):
         wait = self._wait_time()
         if wait > 0:
             await asyncio.sleep(wait)
 
-    async def write_readline(self, data):  # aka: query or put_get
-        data = encode(self.module, data)
-        self._log.debug("write: %r", data)
-        await self._back_pressure()
-        try:
-            async with self._lock:
-                # TODO: maybe consume garbage in the buffer ?
-                reply = await self.conn.write_readline(data)
-                if b"End of Exposure" in reply:
-                    self._log.debug("Received end of exposure")
-                    reply = await self.conn.readline()
-            self._log.debug("read: %r", reply)
-            return decode(reply)
+    def _queued(self):
+        return [ticket for ticket, waiter in self._waiters if not waiter.done()]
+
+    async def _acquire(self, module, priority, code):
+        ticket = self._ticket(module, priority, code)
+        try:
+            if self._busy or self._waiters:
+                waiter = self._new_future()
+                heapq.heappush(self._waiters, (ticket, waiter))
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        # line was given to us just before being cancelled
+                        self._release()
+                    raise
+            self._busy = True
         finally:
-            self._last_command = time.monotonic()
+            self._leave(module)
+
+    def _release(self):
+        self._busy = False
+        while self._waiters:
+            _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._busy = True
+                waiter.set_result(None)
+                break
 
-    async def start_exposure(self, duration):
+    def _ensure_reader(self):
+        if self._reader is None or self._reader.done():
+            self._wakeup = asyncio.Event()
+            self._reader = asyncio.ensure_future(self._read_loop())
+        else:
+            self._wakeup.set()
+
+    async def _read_loop(self):
+        # while exposures are running, check the line for unsolicited
+        # messages when no command holds it (the holder routes them)
+        while True:
+            timeout = self._poll_interval()
+            if timeout is None:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue  # a new exposure: its end may come sooner
+            except asyncio.TimeoutError:
+                pass
+            if self._busy or self._waiters:
+                continue
+            self._busy = True
+            try:
+                if await ain_waiting(self.conn):
+                    deadline = time.monotonic() + self.latency.MIN_TIMEOUT
+                    self._route_frame(await self._readline(deadline))
+            except asyncio.TimeoutError:
+                await self._resync(BROADCAST, "")
+            except Exception as error:
+                self._read_failed(error)
+                if is_connection_error(error):
+                    await self._close_conn()
+            finally:
+                self._release()
+
+    async def _readline(self, deadline):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        return await wait_for(self.conn.readline(), timeout)
+
+    async def _read_reply(self, request):
+        # read and route the frames until the reply of the request
+        while self._inflight is request:
+            if request.blocking or await self._collecting(request):
+                self._route_frame(await self._readline(request.deadline))
+        return request.reply
+
+    async def _collecting(self, request):
+        # (collector which no longer blocks the line, see Collector) True if
+        # a reply is waiting. Closes it once the line is quiet
+        if await ain_waiting(self.conn):
+            return True
+        now = time.monotonic()
+        if self._close_quiet(request, now):
+            return False
+        if now >= request.deadline:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(min(self.COLLECT_POLL, request.deadline - now))
+        return False
+
+    async def write_readline(
+        self, data, module=BROADCAST, priority=Priority.Configuration
+    ):
+        return await self._exchange(data, module, priority)
+
+    async def write_readall(
+        self, data, priority=Priority.Configuration, modules=None
+    ):
         """
-        Initiates a fixed length exposure using the focal plane shutter
-        (enabled only in shutter mode (and RS232 control is enabled))
+        Send a broadcast command and collect the reply of every module.
+        Returns a dict of module to raw reply as soon as the given modules
+        have replied, or at the deadline with the replies received so far.
+        If modules is None, collects until the deadline (see Collector)
         """
-        exposure, decimation = sec_to_exposure_decimation(duration)
-        await self.set_decimation(decimation)
-        return await self.write_readline("E {}".format(exposure))
+        expected = self._expected_modules(modules)
+        return await self._exchange(data, BROADCAST, priority, True, expected)
 
+    async def _exchange(self, data, module, priority, collect=False, expected=None):
+        code = command_code(data)
+        # fail fast while the line is down
+        self._check_link(module, code)
+        start = time.monotonic()
+        await self._acquire(module, priority, code)
+        error = request = None
+        try:
+            start = self._waited("queue_wait", module, code, start)
+            await self._back_pressure()
+            self._waited("back_pressure", module, code, start)
+            await self._wait_idle(module, code)
+            if self._must_connect():
+                await self._connect(module, code)
+            request, timeout = self._new_request(module, code, collect, expected)
+            self._sending(request, code)
+            await self.conn.write(data)
+            try:
+                return await self._read_reply(request)
+            except asyncio.TimeoutError:
+                if request.blocking:
+                    # (a reply may be on its way: drop it with the connection)
+                    await self._resync(module, code)
+                self._inflight = None
+                replies = self._collected(request)
+                if replies is not None:
+                    return replies
+                raise self._timeout_error(data, timeout)
+        except BaseException as err:
+            error = err
+            self._failed(request, err)
+            if is_connection_error(err):
+                error = self._broken(module, code, err)
+                await self._close_conn()
+                raise error from err
+            raise
+        finally:
+            self._done(module, code, error, collected=collect)
+            self._release()
+
+    async def _connect(self, module, code):
+        self._check_link(module, code)
+        if self.link.down:
+            await self._close_conn()
+        try:
+            await asyncio.wait_for(self.conn.open(), self.link.CONNECT_TIMEOUT)
+        except Exception as error:
+            await self._close_conn()
+            raise self._connect_failed(module, code, error) from error
+        self._connected(module, code)
+
+    async def _close_conn(self):
+        try:
+            await self.conn.close()
+        except Exception as error:
+            self._log.debug("error closing connection: %r", error)
+
+    async def _wait_idle(self, module, code):
+        # a cancelled request may still be waiting for its (late) reply: read
+        # it until its deadline, then drop it
+        request = self._inflight
+        if request is None:
+            return
+        try:
+            await self._read_reply(request)
+        except asyncio.TimeoutError:
+            await self._resync(module, code)
+        except Exception:
+            self._inflight = None
+            raise
+
+    async def _resync(self, module, code):
+        # drop the connection: the late reply (if any) is lost with it and the
+        # next command starts on a clean stream
+        self._log.warning("resynchronizing line")
+        self.stats.count("resyncs", module, code)
+        self._inflight = None
+        await self._close_conn()
+
+    async def query(self, data, module=BROADCAST, priority=Priority.Monitoring):
+        """
+        write_readline for read-only commands: identical queries made while
+        one is in flight share its reply instead of being sent again
+        """
+        waiters = self._queries.get(data)
+        if waiters is not None:
+            self.stats.count("shared", module, command_code(data))
+            waiter = self._new_future()
+            waiters.append(waiter)
+            reply = await waiter
+            if reply is None:
+                # the caller which sent it was cancelled: send it again
+                return await self.query(data, module, priority)
+            return reply
+        waiters = self._queries[data] = []
+        reply = error = None
+        try:
+            reply = await self.write_readline(data, module, priority)
+            return reply
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            del self._queries[data]
+            for waiter in waiters:
+                if waiter.done():
+                    pass  # cancelled
+                elif error is None:
+                    waiter.set_result(reply)
+                else:
+                    waiter.set_exception(error)
+
+    async def connect(self):
+        """
+        Open the line if it is not open yet (through the same reconnection
+        logic as the commands, see LinkState)
+        """
+        self._check_link(BROADCAST, "")
+        await self._acquire(BROADCAST, Priority.Configuration, "")
+        try:
+            if self._must_connect():
+                await self._connect(BROADCAST, "")
+        finally:
+            self._release()
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.conn.close()
+
+
+class IOBus(BaseBus):
+
+    # the connection readline has no timeout: the line is polled (with a
+    # growing period) until the reply is there or the deadline is reached
+    READ_POLL = 0.0001
+    READ_POLL_MAX = 0.001
 
-class IOProtocol(BaseProtocol):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+    def _new_future(self):
+        return concurrent.futures.Future()
 
     def _back_pressure(self):
         wait = self._wait_time()
         if wait > 0:
             time.sleep(wait)
 
-    def write_readline(self, data):  # aka: query or put_get
-        data = encode(self.module, data)
+    def _queued(self):
+        with self._cond:
+            return list(self._waiters)
+
+    def _acquire(self, module, priority, code):
+        with self._cond:
+            ticket = self._ticket(module, priority, code)
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while self._busy or self._waiters[0] is not ticket:
+                    self._cond.wait()
+            except BaseException:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+            finally:
+                self._leave(module)
+            heapq.heappop(self._waiters)
+            self._busy = True
+
+    def _release(self):
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+    def _ensure_reader(self):
+        with self._cond:
+            self._closed = False
+            self._wakeup.set()
+            if self._reader is None:
+                self._reader = threading.Thread(
+                    target=self._read_loop, name="PFCUBusReader", daemon=True
+                )
+                self._reader.start()
+
+    def _read_loop(self):
+        # while exposures are running, check the line for unsolicited
+        # messages when no command holds it (the holder routes them)
+        while True:
+            with self._cond:
+                timeout = None if self._closed else self._poll_interval()
+                if timeout is None:
+                    self._reader = None
+                    return
+            if self._wakeup.wait(timeout):
+                self._wakeup.clear()
+                continue  # a new exposure: its end may come sooner
+            with self._cond:
+                if self._busy or self._waiters:
+                    continue
+                self._busy = True
+            try:
+                if in_waiting(self.conn):
+                    deadline = time.monotonic() + self.latency.MIN_TIMEOUT
+                    self._route_frame(self._readline(deadline))
+            except TimeoutError:
+                self._resync(BROADCAST, "")
+            except Exception as error:
+                self._read_failed(error)
+                if is_connection_error(error):
+                    self._close_conn()
+            finally:
+                self._release()
+
+    def _readline(self, deadline):
+        conn, delay = self.conn, 0
+        if hasattr(conn, "in_waiting"):
+            while not in_waiting(conn):
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    raise TimeoutError()
+                time.sleep(min(delay, wait))
+                delay = min(2 * delay or self.READ_POLL, self.READ_POLL_MAX)
+        return conn.readline()
+
+    def _read_reply(self, request):
+        # read and route the frames until the reply of the request
+        while self._inflight is request:
+            if request.blocking or self._collecting(request):
+                self._route_frame(self._readline(request.deadline))
+        return request.reply
+
+    def _collecting(self, request):
+        # (collector which no longer blocks the line, see Collector) True if
+        # a reply is waiting. Closes it once the line is quiet
+        if in_waiting(self.conn):
+            return True
+        now = time.monotonic()
+        if self._close_quiet(request, now):
+            return False
+        if now >= request.deadline:
+            raise TimeoutError()
+        time.sleep(min(self.COLLECT_POLL, request.deadline - now))
+        return False
+
+    def write_readline(
+        self, data, module=BROADCAST, priority=Priority.Configuration
+    ):
+        return self._exchange(data, module, priority)
+
+    def write_readall(self, data, priority=Priority.Configuration, modules=None):
+        """
+        Send a broadcast command and collect the reply of every module.
+        Returns a dict of module to raw reply as soon as the given modules
+        have replied, or at the deadline with the replies received so far.
+        If modules is None, collects until the deadline (see Collector)
+        """
+        expected = self._expected_modules(modules)
+        return self._exchange(data, BROADCAST, priority, True, expected)
+
+    def _exchange(self, data, module, priority, collect=False, expected=None):
+        code = command_code(data)
+        # fail fast while the line is down
+        self._check_link(module, code)
+        start = time.monotonic()
+        self._acquire(module, priority, code)
+        error = request = None
+        try:
+            start = self._waited("queue_wait", module, code, start)
+            self._back_pressure()
+            self._waited("back_pressure", module, code, start)
+            self._wait_idle(module, code)
+            if self._must_connect():
+                self._connect(module, code)
+            request, timeout = self._new_request(module, code, collect, expected)
+            self._sending(request, code)
+            self.conn.write(data)
+            try:
+                return self._read_reply(request)
+            except TimeoutError:
+                if request.blocking:
+                    # (a reply may be on its way: drop it with the connection)
+                    self._resync(module, code)
+                self._inflight = None
+                replies = self._collected(request)
+                if replies is not None:
+                    return replies
+                raise self._timeout_error(data, timeout)
+        except BaseException as err:
+            error = err
+            self._failed(request, err)
+            if is_connection_error(err):
+                error = self._broken(module, code, err)
+                self._close_conn()
+                raise error from err
+            raise
+        finally:
+            self._done(module, code, error, collected=collect)
+            self._release()
+
+    def _connect(self, module, code):
+        # (use the connection_timeout of the connection to limit the time
+        # spent connecting to an unreachable gateway)
+        self._check_link(module, code)
+        if self.link.down:
+            self._close_conn()
+        try:
+            self.conn.open()
+        except Exception as error:
+            self._close_conn()
+            raise self._connect_failed(module, code, error) from error
+        self._connected(module, code)
+
+    def _close_conn(self):
+        try:
+            self.conn.close()
+        except Exception as error:
+            self._log.debug("error closing connection: %r", error)
+
+    def _wait_idle(self, module, code):
+        # a request interrupted (ex: KeyboardInterrupt) may still be waiting
+        # for its (late) reply: read it until its deadline, then drop it
+        request = self._inflight
+        if request is None:
+            return
+        try:
+            self._read_reply(request)
+        except TimeoutError:
+            self._resync(module, code)
+        except Exception:
+            self._inflight = None
+            raise
+
+    def _resync(self, module, code):
+        # drop the connection: the late reply (if any) is lost with it and the
+        # next command starts on a clean stream
+        self._log.warning("resynchronizing line")
+        self.stats.count("resyncs", module, code)
+        self._inflight = None
+        self._close_conn()
+
+    def query(self, data, module=BROADCAST, priority=Priority.Monitoring):
+        """
+        write_readline for read-only commands: identical queries made while
+        one is in flight share its reply instead of being sent again
+        """
+        with self._queries_lock:
+            waiters = self._queries.get(data)
+            waiter = None
+            if waiters is None:
+                waiters = self._queries[data] = []
+            else:
+                waiter = self._new_future()
+                waiters.append(waiter)
+        if waiter is not None:
+            self.stats.count("shared", module, command_code(data))
+            return waiter.result()
+        reply = error = None
+        try:
+            reply = self.write_readline(data, module, priority)
+            return reply
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            with self._queries_lock:
+                del self._queries[data]
+            for waiter in waiters:
+                if error is None:
+                    waiter.set_result(reply)
+                else:
+                    waiter.set_exception(error)
+
+    def connect(self):
+        """
+        Open the line if it is not open yet (through the same reconnection
+        logic as the commands, see LinkState)
+        """
+        self._check_link(BROADCAST, "")
+        self._acquire(BROADCAST, Priority.Configuration, "")
+        try:
+            if self._must_connect():
+                self._connect(BROADCAST, "")
+        finally:
+            self._release()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.conn.close()
+
+
+def Bus(connection, *args, **kwargs):
+    func = connection.write_readline
+    klass = AIOBus if asyncio.iscoroutinefunction(func) else IOBus
+    return klass(connection, *args, **kwargs)
+
+
+class BaseProtocol:
+    """
+    Handles communication protocol for a single module
+    - encode/decode bytes <-> text
+    - delegates latency / back-pressure and serialization to the bus
+
+    - optional cache of read-only queries (see ReplyCache)
+    - statistics (see stats), shared with the other modules on the bus
+
+    The connection can be a connio connection (in which case a private
+    bus is created) or a bus shared with other modules on the same line.
+    """
+
+    def __init__(self, connection, module=BROADCAST, log=None, cache=None):
+        module = module_name(module)
+        if not isinstance(connection, BaseBus):
+            connection = Bus(connection, log=log)
+        self.bus = connection
+        self.conn = connection.conn
+        self.stats = connection.stats
+        self.module = module
+        self._encoded = {cmd: encode(module, cmd) for cmd in FIXED_COMMANDS}
+        self.cache = None if cache is None else ReplyCache(cache)
+        if self.cache is not None:
+            self.bus.add_cache(self.cache)
+        self._log = log or logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
+
+    def _update_cache(self, cmd, reply):
+        self.bus.update_state(self.module, cmd, reply)
+        if self.cache is not None:
+            self.cache.update(cmd, reply)
+
+    def _decode(self, cmd, raw_reply):
+        start = time.monotonic()
+        try:
+            return decode(raw_reply)
+        except PFCUError:
+            self.stats.count("errors", self.module, cmd[:1])
+            raise
+        finally:
+            stop = time.monotonic()
+            self.stats.observe("decode", self.module, cmd[:1], stop - start)
+
+    def encode(self, cmd):
+        data = self._encoded.get(cmd)
+        return encode(self.module, cmd) if data is None else data
+
+    @property
+    def decimation(self):
+        """Last decimation set on the module (None if unknown)"""
+        return self.bus.decimation(self.module)
+
+    def set_decimation(self, value, priority=None):
+        return self.write_readline("D {}".format(int(value)), priority)
+
+    def _decode_all(self, cmd, replies, decoder):
+        """{module: decoded reply (or PFCUError)} of a collected broadcast"""
+        if cmd not in QUERIES.values():
+            # a broadcast changes the state of every module on the line
+            self.bus._invalidate_caches()
+        timeline = self.bus.timeline
+        results = {}
+        for module, raw_reply in sorted(replies.items()):
+            try:
+                reply = self._decode(cmd, raw_reply)
+            except PFCUError as error:
+                results[module], reply = error, None
+            else:
+                results[module] = reply if decoder is None else decoder(reply)
+            if timeline is not None:
+                timeline.record(module, cmd, reply)
+        return results
+
+    def _settle_keys(self, target):
+        module = self.module
+        return [(module, i, value) for i, value in enumerate(target) if value != "="]
+
+    def _settled(self, keys, status, elapsed):
+        """
+        Removes from keys the filters which reached their target (updating
+        the settle model). Raises PFCUFilterFault if one of them has a fault
+        """
+        faults = {
+            index + 1: status[index]
+            for _, index, _ in keys
+            if status[index] in (FilterStatus.OpenCircuit, FilterStatus.ShortCircuit)
+        }
+        if faults:
+            raise PFCUFilterFault(self.module, faults)
+        settled = [key for key in keys if status[key[1]] == int(key[2])]
+        for key in settled:
+            self.bus.settle.update(key, elapsed)
+            self.stats.observe("settle", self.module, "F", elapsed)
+            keys.remove(key)
+        if settled and self.bus.timeline is not None:
+            filters = "".join(str(int(f)) for f in status)
+            self.bus.timeline.record(self.module, FILTERS_SETTLED, filters)
+
+    def _next_poll(self, keys, elapsed):
+        rtt = self.bus.latency.percentile("F", 50)
+        return self.bus.settle.next_poll(keys, elapsed, rtt)
+
+    def _settle_timeout(self, target, status, timeout):
+        return PFCUTimeoutError(
+            "Filters {} not settled after {:.3f}s (status: {})".format(
+                "".join(target), timeout, "".join(str(int(f)) for f in status)
+            )
+        )
+
+    def _exposure_commands(self, duration):
+        # D is only needed if the decimation changes
+        current = self.decimation
+        exposure, decimation = sec_to_exposure_decimation(duration, current)
+        commands = [] if decimation == current else ["D {}".format(decimation)]
+        commands.append("E {}".format(exposure))
+        return commands, exposure * decimation * EXPOSURE_TICK
+
+
+def filters_command(values):
+    """W command which sets the filters with the given values ("0", "1" or "=")"""
+    return "W " + "".join(values)
+
+
+class AIOProtocol(BaseProtocol):
+
+    # time to wait for other filter changes to coalesce into a single W
+    FILTER_WINDOW = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._filter_batch = None
+
+    async def write_readline(self, cmd, priority=None):  # aka: query or put_get
+        if self.cache is not None:
+            reply = self.cache.get(cmd)
+            if reply is not None:
+                self.stats.count("cache_hits", self.module, cmd[:1])
+                return reply
+        data = self.encode(cmd)
         self._log.debug("write: %r", data)
-        self._back_pressure()
-        try:
-            with self._lock:
-                # TODO: maybe consume garbage in the buffer ?
-                reply = self.conn.write_readline(data)
-                if b"End of Exposure" in reply:
-                    self._log.debug("Received end of exposure")
-                    reply = self.conn.readline()
-            self._log.debug("read: %r", reply)
-            return decode(reply)
+        reply = None
+        try:
+            if priority is None:
+                priority = command_priority(cmd)
+            if cmd in QUERIES.values():
+                raw_reply = await self.bus.query(data, self.module, priority)
+            else:
+                raw_reply = await self.bus.write_readline(data, self.module, priority)
+            self._log.debug("read: %r", raw_reply)
+            reply = self._decode(cmd, raw_reply)
         finally:
-            self._last_command = time.monotonic()
+            self._update_cache(cmd, reply)
+        return reply
+
+    async def request(self, cmd, decoder, priority=None):
+        """write_readline followed by the given (sync) decoder"""
+        return decoder(await self.write_readline(cmd, priority))
 
-    def start_exposure(self, duration):
+    async def write_readall(self, cmd, decoder=None, modules=None, priority=None):
+        """
+        Send the command to all modules at once and collect their replies
+        (see Bus.write_readall()). Returns a dict of module to reply
+        (decoded with the given decoder) or to PFCUError
+        """
+        data = encode(BROADCAST, cmd)
+        if priority is None:
+            priority = command_priority(cmd)
+        replies = await self.bus.write_readall(data, priority, modules)
+        return self._decode_all(cmd, replies, decoder)
+
+    async def change_filter(self, index, value, wait=False, priority=None):
+        """
+        Changes the filter at the given index (0-3) to value ("0" or "1").
+        Changes made concurrently (within FILTER_WINDOW) are sent together
+        in a single W command (with the highest priority asked for). The
+        change of a caller cancelled before the W is sent is dropped.
+        Returns the state of each filter (once the filter reached its
+        position if wait is True, see wait_filters())
+        """
+        batch = self._filter_batch
+        if batch is None or batch["values"][index] not in ("=", value):
+            # conflicting changes go in a new batch sent after this one
+            future = asyncio.get_event_loop().create_future()
+            batch = self._filter_batch = dict(
+                values=["="] * 4, future=future, callers={}, sent=False
+            )
+            asyncio.ensure_future(self._send_filters(batch))
+        batch["values"][index] = value
+        caller = object()
+        batch["callers"][caller] = index, priority
+        try:
+            reply = await asyncio.shield(batch["future"])
+        except asyncio.CancelledError:
+            self._withdraw_filter(batch, caller)
+            raise
+        status = decode_filters_status.func(reply)
+        if wait:
+            target = ["="] * 4
+            target[index] = value
+            status = await self.wait_filters(target, status)
+        return status
+
+    async def set_filters(self, values, wait=False, priority=None):
+        """
+        Set the filters to values ("0", "1" or "=" each). Returns the state
+        of each filter (once they reached their position if wait is True)
+        """
+        cmd, decoder = filters_command(values), decode_filters_status.func
+        status = await self.request(cmd, decoder, priority)
+        if wait:
+            status = await self.wait_filters(values, status)
+        return status
+
+    async def wait_filters(self, target, status=None):
+        """
+        Wait for the filters to reach the target ("0", "1" or "=" each)
+        after a filter change was acknowledged, polling F when they are
+        expected to arrive (see SettleModel). Returns the state of each
+        filter. Raises PFCUFilterFault as soon as one of the filters
+        reports an open or short circuit and PFCUTimeoutError if they don't
+        settle in time
+        """
+        start = time.monotonic()
+        keys = self._settle_keys(target)
+        timeout = self.bus.settle.timeout(keys)
+        data = self.encode("F")
+        while True:
+            elapsed = time.monotonic() - start
+            if status is not None:
+                self._settled(keys, status, elapsed)
+                if not keys:
+                    return status
+                if elapsed > timeout:
+                    raise self._settle_timeout(target, status, timeout)
+            await asyncio.sleep(self._next_poll(keys, elapsed))
+            # (bypass the read cache: the filters are moving)
+            reply = await self.bus.query(data, self.module, Priority.Monitoring)
+            status = decode_filters_status.func(self._decode("F", reply))
+
+    def _withdraw_filter(self, batch, caller):
+        index, _ = batch["callers"].pop(caller)
+        if batch["sent"]:
+            return
+        if all(other != index for other, _ in batch["callers"].values()):
+            batch["values"][index] = "="
+
+    async def _send_filters(self, batch):
+        # every caller of the batch waits for its future: always resolve it
+        future = batch["future"]
+        try:
+            await asyncio.sleep(self.FILTER_WINDOW)
+            if self._filter_batch is batch:
+                self._filter_batch = None
+            batch["sent"] = True
+            if not batch["callers"]:
+                # every caller was cancelled
+                future.cancel()
+                return
+            priorities = [p for _, p in batch["callers"].values() if p is not None]
+            priority = min(priorities) if priorities else None
+            cmd = filters_command(batch["values"])
+            reply = await self.write_readline(cmd, priority)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(reply)
+        finally:
+            if self._filter_batch is batch:
+                self._filter_batch = None
+
+    async def start_exposure(self, duration, priority=None):
         """
         Initiates a fixed length exposure using the focal plane shutter
         (enabled only in shutter mode (and RS232 control is enabled))
+
+        Returns a future which is done when the device reports the end of
+        the exposure.
+        """
+        commands, effective = self._exposure_commands(duration)
+        return await self._expose(commands, effective, priority)
+
+    async def _expose(self, commands, duration, priority=None):
+        *setup, start = commands
+        for cmd in setup:
+            await self.write_readline(cmd, priority)
+        end = self.bus.expect_end_of_exposure(self.module, duration)
+        try:
+            await self.write_readline(start, priority)
+        except BaseException:
+            end.cancel()
+            raise
+        return end
+
+    async def exposure_sequence(self, durations, priority=None):
+        """
+        Runs one exposure per duration (list or generator), each one started
+        as soon as the previous one ends. The decimation is only sent when
+        it changes.
+
+        Async generator of the effective duration (s) of each exposure,
+        yielded when it ends.
         """
-        exposure, decimation = sec_to_exposure_decimation(duration)
-        self.set_decimation(decimation)
-        return self.write_readline("E {}".format(exposure))
+        for duration in durations:
+            commands, effective = self._exposure_commands(duration)
+            await (await self._expose(commands, effective, priority))
+            yield effective
+
+
+class IOProtocol(BaseProtocol):
+    def write_readline(self, cmd, priority=None):  # aka: query or put_get
+        if self.cache is not None:
+            reply = self.cache.get(cmd)
+            if reply is not None:
+                self.stats.count("cache_hits", self.module, cmd[:1])
+                return reply
+        data = self.encode(cmd)
+        self._log.debug("write: %r", data)
+        reply = None
+        try:
+            if priority is None:
+                priority = command_priority(cmd)
+            if cmd in QUERIES.values():
+                raw_reply = self.bus.query(data, self.module, priority)
+            else:
+                raw_reply = self.bus.write_readline(data, self.module, priority)
+            self._log.debug("read: %r", raw_reply)
+            reply = self._decode(cmd, raw_reply)
+        finally:
+            self._update_cache(cmd, reply)
+        return reply
+
+    def request(self, cmd, decoder, priority=None):
+        """write_readline followed by the given (sync) decoder"""
+        return decoder(self.write_readline(cmd, priority))
+
+    def write_readall(self, cmd, decoder=None, modules=None, priority=None):
+        """
+        Send the command to all modules at once and collect their replies
+        (see Bus.write_readall()). Returns a dict of module to reply
+        (decoded with the given decoder) or to PFCUError
+        """
+        data = encode(BROADCAST, cmd)
+        if priority is None:
+            priority = command_priority(cmd)
+        replies = self.bus.write_readall(data, priority, modules)
+        return self._decode_all(cmd, replies, decoder)
+
+    def change_filter(self, index, value, wait=False, priority=None):
+        """
+        Changes the filter at the given index (0-3) to value ("0" or "1").
+        Returns the state of each filter (once the filter reached its
+        position if wait is True, see wait_filters())
+        """
+        values = ["="] * 4
+        values[index] = value
+        return self.set_filters(values, wait=wait, priority=priority)
+
+    def set_filters(self, values, wait=False, priority=None):
+        """
+        Set the filters to values ("0", "1" or "=" each). Returns the state
+        of each filter (once they reached their position if wait is True)
+        """
+        cmd, decoder = filters_command(values), decode_filters_status.func
+        status = self.request(cmd, decoder, priority)
+        if wait:
+            status = self.wait_filters(values, status)
+        return status
+
+    def wait_filters(self, target, status=None):
+        """
+        Wait for the filters to reach the target ("0", "1" or "=" each)
+        after a filter change was acknowledged, polling F when they are
+        expected to arrive (see SettleModel). Returns the state of each
+        filter. Raises PFCUFilterFault as soon as one of the filters
+        reports an open or short circuit and PFCUTimeoutError if they don't
+        settle in time
+        """
+        start = time.monotonic()
+        keys = self._settle_keys(target)
+        timeout = self.bus.settle.timeout(keys)
+        data = self.encode("F")
+        while True:
+            elapsed = time.monotonic() - start
+            if status is not None:
+                self._settled(keys, status, elapsed)
+                if not keys:
+                    return status
+                if elapsed > timeout:
+                    raise self._settle_timeout(target, status, timeout)
+            time.sleep(self._next_poll(keys, elapsed))
+            # (bypass the read cache: the filters are moving)
+            reply = self.bus.query(data, self.module, Priority.Monitoring)
+            status = decode_filters_status.func(self._decode("F", reply))
+
+    def start_exposure(self, duration, priority=None):
+        """
+        Initiates a fixed length exposure using the focal plane shutter
+        (enabled only in shutter mode (and RS232 control is enabled))
+
+        Returns a concurrent.futures.Future which is done when the device
+        reports the end of the exposure.
+        """
+        commands, effective = self._exposure_commands(duration)
+        return self._expose(commands, effective, priority)
+
+    def _expose(self, commands, duration, priority=None):
+        *setup, start = commands
+        for cmd in setup:
+            self.write_readline(cmd, priority)
+        end = self.bus.expect_end_of_exposure(self.module, duration)
+        try:
+            self.write_readline(start, priority)
+        except BaseException:
+            end.cancel()
+            raise
+        return end
+
+    def exposure_sequence(self, durations, priority=None):
+        """
+        Runs one exposure per duration (list or generator), each one started
+        as soon as the previous one ends. The decimation is only sent when
+        it changes.
+
+        Generator of the effective duration (s) of each exposure, yielded
+        when it ends.
+        """
+        for duration in durations:
+            commands, effective = self._exposure_commands(duration)
+            self._expose(commands, effective, priority).result()
+            yield effective
 
 
 def Protocol(connection, *args, **kwargs):
@@ -247,3 +2109,10 @@ def protocol_for_url(url, *args, **kwargs):
     log = kwargs.pop("log", None)
     conn = connection_for_url(url, *args, **kwargs)
     return Protocol(conn, module=module, log=log)
+
+
+def bus_for_url(url, *args, **kwargs):
+    log = kwargs.pop("log", None)
+    timeline = kwargs.pop("timeline", None)
+    conn = connection_for_url(url, *args, **kwargs)
+    return Bus(conn, log=log, timeline=timeline)
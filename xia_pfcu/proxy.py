@@ -0,0 +1,227 @@
+"""
+# Proxy: share one PFCU line between many TCP clients
+
+The proxy owns the connection to the line (through an AIOBus) and accepts
+TCP clients speaking the native PFCU protocol (`!PFCU<module> <cmd>\\r`).
+Existing clients (ex: a PFCU object on a connio TCP connection) can use it
+instead of the ser2net/socat gateway without any change:
+
+- commands of all clients are serialized (and scheduled by priority) on
+  the bus queue
+- identical queries in flight are shared and read-only queries are answered
+  from a short TTL cache (see ReplyCache)
+- unsolicited messages (ex: "End of Exposure") are forwarded to every client
+- a broadcast (`!PFCUALL <cmd>`) gets the replies of every module on the line
+"""
+
+import asyncio
+import logging
+import re
+
+from .protocol import (
+    BROADCAST,
+    EXPOSURE_TICK,
+    QUERIES,
+    REQ_HEADER,
+    PFCUError,
+    ReplyCache,
+    command_priority,
+    decode,
+    encode,
+    module_name,
+)
+
+EOL = b"\r\n"
+_LINE = re.compile(rb"[\r\n]+")
+
+
+def parse_request(line):
+    """(module, cmd) of a raw request (ex: b"!PFCU15 S" -> ("15", "S"))"""
+    text = line.decode().strip().upper()
+    if not text.startswith(REQ_HEADER):
+        raise ValueError("Invalid request {!r}".format(line))
+    try:
+        module, cmd = text[len(REQ_HEADER) :].split(None, 1)
+        module = module_name(module)
+    except (ValueError, AssertionError):
+        raise ValueError("Invalid request {!r}".format(line))
+    return module, " ".join(cmd.split())
+
+
+class Proxy:
+    """
+    Multiplexes the TCP clients connected to host:port on the given AIOBus.
+
+    cache is the TTL (s) of the read-only query replies: a number (same TTL
+    for all queries) or a dict (see ReplyCache). 0 or None disables it.
+    """
+
+    CACHE_TTL = 0.1
+
+    def __init__(self, bus, host="0.0.0.0", port=17890, cache=CACHE_TTL):
+        self.bus = bus
+        self.host = host
+        self.port = port
+        self.ttl = cache
+        self.clients = set()
+        self.server = None
+        self._caches = {}
+        self._log = logging.getLogger("xia_pfcu.{}".format(type(self).__name__))
+
+    def _cache(self, module):
+        if module == BROADCAST:
+            # (the replies of all modules: not invalidated by their commands)
+            return None
+        cache = self._caches.get(module)
+        if cache is None and self.ttl:
+            cache = self._caches[module] = ReplyCache(self.ttl)
+            # invalidated by the bus when the line reconnects
+            self.bus.add_cache(cache)
+        return cache
+
+    def _update_state(self, module, cmd, reply):
+        """Decoded reply (None if it failed) once the bus state is updated"""
+        text = None
+        if reply is not None:
+            try:
+                text = decode(reply)
+            except PFCUError:
+                pass
+        self.bus.update_state(module, cmd, text)
+        return text
+
+    def _update_cache(self, module, cmd, reply):
+        if module == BROADCAST:
+            return  # (see _update_all)
+        if self._update_state(module, cmd, reply) is None:
+            reply = None
+        cache = self._cache(module)
+        if cache is not None:
+            # (the cache holds raw replies)
+            cache.update(cmd, reply)
+
+    def _update_all(self, cmd, replies):
+        # a broadcast changes the state of every module on the line
+        if cmd not in QUERIES.values():
+            self.bus._invalidate_caches()
+        for module, reply in replies.items():
+            self._update_state(module, cmd, reply)
+
+    def _expect_end_of_exposure(self, module, cmd):
+        # the bus only listens for unsolicited messages while it knows an
+        # exposure is running
+        decimation = self.bus.decimation(module)
+        try:
+            duration = int(cmd[2:]) * decimation * EXPOSURE_TICK
+        except (TypeError, ValueError):
+            duration = None
+        return self.bus.expect_end_of_exposure(module, duration)
+
+    async def _write_readall(self, cmd):
+        data = encode(BROADCAST, cmd)
+        replies = {}
+        try:
+            replies = await self.bus.write_readall(data, command_priority(cmd))
+        finally:
+            self._update_all(cmd, replies)
+        # (in the order they arrived, as on the line)
+        return b"".join(replies.values())
+
+    async def _write_readline(self, module, cmd):
+        if module == BROADCAST:
+            return await self._write_readall(cmd)
+        data = encode(module, cmd)
+        priority = command_priority(cmd)
+        if cmd in QUERIES.values():
+            return await self.bus.query(data, module, priority)
+        return await self.bus.write_readline(data, module, priority)
+
+    async def request(self, module, cmd):
+        """Raw reply to the given command (from the cache if possible)"""
+        cache = self._cache(module)
+        if cache is not None:
+            reply = cache.get(cmd)
+            if reply is not None:
+                self.bus.stats.count("cache_hits", module, cmd[:1])
+                return reply
+        end = self._expect_end_of_exposure(module, cmd) if cmd[:1] == "E" else None
+        reply = None
+        try:
+            reply = await self._write_readline(module, cmd)
+        finally:
+            self._update_cache(module, cmd, reply)
+            if end is not None and (reply is None or b" OK " not in reply):
+                end.cancel()
+        return reply
+
+    def _forward(self, module, text):
+        message = text.encode() + EOL
+        for writer in list(self.clients):
+            writer.write(message)
+
+    async def _handle_line(self, line, writer, peer):
+        try:
+            module, cmd = parse_request(line)
+        except ValueError as error:
+            # as the device does: no reply
+            self._log.warning("%s: %s", peer, error)
+            return
+        try:
+            reply = await self.request(module, cmd)
+        except Exception as error:
+            # as the device does: no reply (the client times out)
+            self._log.warning("%s: %r failed: %r", peer, line, error)
+            return
+        writer.write(reply)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        self._log.info("client %s connected", peer)
+        self.clients.add(writer)
+        buff = b""
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                *lines, buff = _LINE.split(buff + data)
+                for line in lines:
+                    if line.strip():
+                        await self._handle_line(line, writer, peer)
+        except ConnectionError as error:
+            self._log.info("client %s: %r", peer, error)
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+            self._log.info("client %s disconnected", peer)
+
+    async def start(self):
+        self.bus.subscribe(self._forward)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        for sock in self.server.sockets:
+            self._log.info("listening on %s", sock.getsockname())
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.bus.unsubscribe(self._forward)
+        for writer in list(self.clients):
+            writer.close()
+        await self.bus.close()
+
+    async def serve(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
@@ -11,188 +11,386 @@
     devices:
     - class: PFCU
       package: xia_pfcu.simulator
-      module_id: 15
+      module_id: 15            # module address
       shutter_mode: true       # start in shutter mode
       shutter_open: false      # start with shutter closed
       decimation: 1            # initial decimation
       lock: false              # initial lock status
+      filters: "0010"          # initial filter positions (channels 1 to 4)
+      shorted: []              # channels (1-4) with a short circuit
+      open: []                 # channels (1-4) with an open circuit
+      settle_time: 0           # time (s) a filter takes to move
+      timing: realistic        # realistic, zero-latency or jittery
       transports:
       - type: serial
         url: /tmp/pfcu-1
+
+Several modules (up to 16) daisy-chained on the same line are simulated
+with `modules`, a list of module addresses or of dicts with the module
+options (the options above are the defaults of every module). Each module
+answers the commands sent to its address and broadcast commands (ALL) are
+answered by every module in turn:
+
+.. code-block:: yaml
+
+      modules:
+      - 1
+      - module_id: 2
+        filters: "1100"
+
+timing can also be a dict of command code to delay (seconds) before the
+reply (ex: `timing: {S: 0.1}`).
 """
 
+import random
+import socket
+import time
+
 import gevent
 from sinstruments.simulator import BaseDevice
 
 STATUS = """\
 %PFCU{addr} OK PFCU v1.0 (c) XIA 1999 All Rights Reserved\r
 CHANNEL IN/OUT (FPanel   TTL  RS232) Shorted? Open? \r
-    1     OUT     OUT    OUT   OUT      NO      NO\r
-    2     OUT     OUT    OUT   OUT      NO      NO\r
-    3      IN     OUT    OUT    IN      NO      NO\r
-    4     OUT     OUT    OUT   OUT      NO      NO\r
+{channels}\r
 RS232 Control Enabled: YES\r
 RS232 Control Only: {rs232only}\r
 Shutter Mode Enabled: {mode}\r
 Exposure Decimation: {decimation:5d}\r
 DONE;"""
 
+CHANNEL = "{nb:5d}{in_out:>8}{fpanel:>8}{ttl:>7}{rs232:>6}{shorted:>8}{open:>8}"
 
-class PFCU(BaseDevice):
+# delay (seconds) before replying, by command code
+TIMINGS = {
+    "realistic": {"S": 0.5, "Z": 0.85, "C": 0.2, "O": 0.05},
+    "zero-latency": {},
+    "jittery": {"S": 0.5, "Z": 0.85, "C": 0.2, "O": 0.05},
+}
 
-    newline = b"\r"
+# jittery: delay * uniform(1 - SPREAD, 1 + SPREAD) + uniform(0, JITTER)
+SPREAD = 0.5
+JITTER = 0.05
+
+
+class Timing:
+    """Delay before replying to each command"""
+
+    def __init__(self, delays=None, jitter=False):
+        self.delays = dict(delays or {})
+        self.jitter = jitter
+
+    @classmethod
+    def from_config(cls, timing):
+        if isinstance(timing, dict):
+            return cls(timing)
+        return cls(TIMINGS[timing], jitter=timing == "jittery")
+
+    def delay(self, code):
+        delay = self.delays.get(code, 0.0)
+        if self.jitter:
+            delay *= random.uniform(1 - SPREAD, 1 + SPREAD)
+            delay += random.uniform(0, JITTER)
+        return delay
+
+
+class CommandError(Exception):
+    pass
+
+
+def yes_no(value):
+    return "YES" if value else "NO"
+
+
+def channels_config(channels):
+    channels = {int(channel) for channel in channels}
+    assert channels <= {1, 2, 3, 4}
+    return channels
+
+
+def filter_number(args):
+    try:
+        nb = int(args[0])
+    except (IndexError, ValueError):
+        raise CommandError("Invalid Filter Number")
+    if not 0 < nb < 5:
+        raise CommandError("Invalid Filter Number")
+    return nb
+
+
+class Module:
+    """State and commands of one PFCU module"""
 
     DEFAULT = {
-        "module_id": 15,
         "shutter_mode": False,
         "shutter_open": False,
         "decimation": 1,
         "lock": False,
+        "filters": "0010",
+        "shorted": (),
+        "open": (),
+        "settle_time": 0.0,
     }
 
-    def __init__(self, name, **opts):
-        kwargs = {}
-        if "newline" in opts:
-            kwargs["newline"] = opts.pop("newline")
-        self._config = dict(self.DEFAULT, **opts)
-        self._open = False
-        super().__init__(name, **kwargs)
-
-    @property
-    def module_id(self):
-        return self._config["module_id"]
+    def __init__(self, device, module_id, **opts):
+        opts = dict(self.DEFAULT, **opts)
+        assert 0 <= module_id < 16
+        assert len(opts["filters"]) == 4 and set(opts["filters"]) <= set("01")
+        self.device = device
+        self.module_id = module_id
+        self.addr = "{:02d}".format(module_id)
+        self.shutter_mode = opts["shutter_mode"]
+        self.shutter_open = opts["shutter_open"]
+        self.decimation = int(opts["decimation"])
+        self.lock = opts["lock"]
+        self.settle_time = float(opts["settle_time"])
+        # filter positions: [(position before the last move, target, end)]
+        self.moves = [(value == "1",) * 2 + (0,) for value in opts["filters"]]
+        self.shorted = channels_config(opts["shorted"])
+        self.open = channels_config(opts["open"])
+        self.commands = {
+            "C": self.close_shutter,
+            "O": self.open_shutter,
+            "H": self.get_shutter_status,
+            "E": self.start_exposure,
+            "D": self.set_decimation,
+            "S": self.get_status,
+            "P": self.get_position,
+            "F": self.get_filters_status,
+            "W": self.set_filters,
+            "I": self.insert_filter,
+            "R": self.remove_filter,
+            "Z": self.clear_short_error,
+            "L": self.set_lock,
+            "U": self.set_unlock,
+            "2": self.enable_shutter,
+            "4": self.disable_shutter,
+        }
 
     @property
-    def shutter_mode(self):
-        return self._config["shutter_mode"]
-
-    @shutter_mode.setter
-    def shutter_mode(self, enable):
-        self._config["shutter_mode"] = enable
+    def shutter_status(self):
+        return "Open" if self.shutter_open else "Closed"
 
     @property
-    def shutter_open(self):
-        return self._config["shutter_open"]
+    def filters(self):
+        """Current position of the filters (moving ones at their old one)"""
+        now = time.monotonic()
+        return [target if now >= end else old for old, target, end in self.moves]
 
-    @shutter_open.setter
-    def shutter_open(self, value):
-        self._config["shutter_open"] = value
+    def move_filter(self, index, value):
+        old, target, end = self.moves[index]
+        if value != target:
+            self.moves[index] = self.filters[index], value, (
+                time.monotonic() + self.settle_time
+            )
 
     @property
-    def shutter_status(self):
-        return "Open" if self.shutter_open else "Closed"
+    def position(self):
+        return "".join("1" if value else "0" for value in self.filters)
 
     @property
     def filters_status(self):
-        return "0010" if self.shutter_open else "0000"
+        result = ""
+        for nb, value in enumerate(self.filters, start=1):
+            if nb in self.shorted:
+                result += "3"
+            elif nb in self.open:
+                result += "2"
+            else:
+                result += "1" if value else "0"
+        return result
 
-    @property
-    def decimation(self):
-        return self._config["decimation"]
+    def handle(self, cmd, args):
+        """Reply to the given command (without delay)"""
+        handler = self.commands.get(cmd)
+        try:
+            if handler is None:
+                raise CommandError("Unknown Command")
+            text = handler(*args)
+        except CommandError as error:
+            return "%PFCU{} ERROR: {};".format(self.addr, error)
+        if text.startswith("%"):
+            return text
+        return "%PFCU{} OK {} DONE;".format(self.addr, text)
 
-    @decimation.setter
-    def decimation(self, value):
-        self._config["decimation"] = int(value)
+    def check_shutter_mode(self):
+        if not self.shutter_mode:
+            raise CommandError("Shutter mode disabled")
 
-    @property
-    def lock(self):
-        return self._config["lock"]
+    def close_shutter(self, *args):
+        self.check_shutter_mode()
+        self.shutter_open = False
+        return "Shutter Closed"
 
-    @lock.setter
-    def lock(self, value):
-        self._config["lock"] = value
+    def open_shutter(self, *args):
+        self.check_shutter_mode()
+        self.shutter_open = True
+        return "Shutter Open"
 
-    def handle_message(self, line):
-        self._log.debug("request: %r", line)
-        line = line.decode().strip().upper()
-        assert line.startswith("!PFCU")
-        addr, cmd, *args = line[5:].split()
-        if cmd == "C":  # Close shutter
-            if self.shutter_mode:
-                self.shutter_open = False
-                result = "%PFCU{} OK Shutter Closed DONE;".format(self.module_id)
-            else:
-                result = "%PFCU{} ERROR: Shutter mode disabled;".format(self.module_id)
-            gevent.sleep(0.2)
-        elif cmd == "O":  # Open shutter
-            if self.shutter_mode:
-                self.shutter_open = True
-                result = "%PFCU{} OK Shutter Open DONE;".format(self.module_id)
-            else:
-                result = "%PFCU{} ERROR: Shutter mode disabled;".format(self.module_id)
-            gevent.sleep(0.05)
-        elif cmd == "P":  # Position inquiry
-            result = "%PFCU{} OK 0000 DONE;".format(self.module_id)
-        elif cmd == "S":  # Status report
-            if self.shutter_mode:
-                mode = "YES Shutter is {}".format(self.shutter_status)
-            else:
-                mode = "NO"
-            rs232only = "YES" if self.lock else "NO"
-            result = STATUS.format(
-                addr=self.module_id,
-                mode=mode,
-                decimation=self.decimation,
-                rs232only=rs232only,
-            )
-            gevent.sleep(0.5)
-        elif cmd == "H":  # Shutter status
-            if self.shutter_mode:
-                result = "%PFCU{} OK Shutter {} DONE;".format(
-                    self.module_id, self.shutter_status
-                )
-            else:
-                result = "%PFCU{} ERROR: Shutter mode disabled;".format(self.module_id)
-        elif cmd == "D":  # Decimation
-            try:
-                self.decimation = args[0]
-            except ValueError:
-                result = "%PFCU{} ERROR: Invalid Decimation Value;".format(
-                    self.module_id
-                )
-            else:
-                result = "%PFCU{} OK Decimation = {} DONE;".format(
-                    self.module_id, args[0]
-                )
-        elif cmd == "F":  # Fault status
-            result = "%PFCU{} OK {} DONE;".format(self.module_id, self.filters_status)
-        elif cmd == "2":  # Enable shutter mode
-            self.shutter_mode = True
-            result = "%PFCU{} OK Shutter mode Enabled DONE;".format(self.module_id)
-        elif cmd == "L":  # Lock (RS232 control only)
-            self.lock = True
-            result = "%PFCU{} OK Locked DONE;".format(self.module_id)
-        elif cmd == "Z":  # Clear short error condition
-            gevent.sleep(0.850)
-            result = "%PFCU{} OK 0123 DONE;".format(self.module_id)
-        elif cmd == "U":  # Unlock (enable all control sources)
-            self.lock = False
-            result = "%PFCU{} OK Unlocked DONE;".format(self.module_id)
-        elif cmd == "E":  # Start exposure
-            if self.shutter_mode:
-                try:
-                    exp_time = int(args[0]) * self.decimation * 10e-3
-                except ValueError:
-                    result = "%PFCU{} ERROR: Invalid Exposure Time;".format(
-                        self.module_id
-                    )
-                gevent.spawn(self.start_exposure, exp_time)
-                result = "%PFCU{} OK Exposure Started;".format(self.module_id)
-            else:
-                result = "%PFCU{} ERROR: Shutter mode disabled;".format(self.module_id)
-        elif cmd == "4":  # Disable shutter mode
-            self.shutter_mode = False
-            result = "%PFCU{} OK Shutter mode Disabled DONE;".format(self.module_id)
-        result = result.encode() + b"\r\n"
-        self._log.debug("reply: %r", result)
-        return result
+    def get_shutter_status(self, *args):
+        self.check_shutter_mode()
+        return "Shutter {}".format(self.shutter_status)
 
-    def start_exposure(self, exp_time):
-        self._log.info("starting exposure of %f s", exp_time)
+    def start_exposure(self, *args):
+        self.check_shutter_mode()
+        try:
+            exp_time = int(args[0]) * self.decimation * 10e-3
+        except (IndexError, ValueError):
+            raise CommandError("Invalid Exposure Time")
+        gevent.spawn(self.exposure, exp_time)
+        return "%PFCU{} OK Exposure Started;".format(self.addr)
+
+    def exposure(self, exp_time):
+        log = self.device._log
+        log.info("module %s: starting exposure of %f s", self.addr, exp_time)
         self.shutter_open = True
         gevent.sleep(exp_time)
         self.shutter_open = False
-        self._log.info("finished exposure of %f s", exp_time)
-        self.broadcast(
-            "%PFCU{} End of Exposure DONE;\r\n".format(self.module_id).encode()
+        log.info("module %s: finished exposure of %f s", self.addr, exp_time)
+        self.device.broadcast(
+            "%PFCU{} End of Exposure DONE;\r\n".format(self.addr).encode()
         )
+
+    def set_decimation(self, *args):
+        try:
+            self.decimation = int(args[0])
+        except (IndexError, ValueError):
+            raise CommandError("Invalid Decimation Value")
+        return "Decimation = {}".format(self.decimation)
+
+    def get_status(self, *args):
+        if self.shutter_mode:
+            mode = "YES Shutter is {}".format(self.shutter_status)
+        else:
+            mode = "NO"
+        channels = []
+        positions = zip(self.filters, self.moves)
+        for nb, (value, (_, target, _)) in enumerate(positions, start=1):
+            in_out = "IN" if value and nb not in self.shorted else "OUT"
+            channels.append(
+                CHANNEL.format(
+                    nb=nb,
+                    in_out=in_out,
+                    fpanel="OUT",
+                    ttl="OUT",
+                    rs232="IN" if target else "OUT",
+                    shorted=yes_no(nb in self.shorted),
+                    open=yes_no(nb in self.open),
+                )
+            )
+        return STATUS.format(
+            addr=self.addr,
+            channels="\r\n".join(channels),
+            mode=mode,
+            decimation=self.decimation,
+            rs232only=yes_no(self.lock),
+        )
+
+    def get_position(self, *args):
+        return self.position
+
+    def get_filters_status(self, *args):
+        return self.filters_status
+
+    def set_filters(self, *args):
+        values = args[0] if args else ""
+        if len(values) != 4 or not set(values) <= set("01="):
+            raise CommandError("Invalid Filter Value")
+        for i, value in enumerate(values):
+            if value != "=":
+                self.move_filter(i, value == "1")
+        return self.filters_status
+
+    def insert_filter(self, *args):
+        self.move_filter(filter_number(args) - 1, True)
+        return self.filters_status
+
+    def remove_filter(self, *args):
+        self.move_filter(filter_number(args) - 1, False)
+        return self.filters_status
+
+    def clear_short_error(self, *args):
+        self.shorted.clear()
+        return self.filters_status
+
+    def set_lock(self, *args):
+        self.lock = True
+        return "Locked"
+
+    def set_unlock(self, *args):
+        self.lock = False
+        return "Unlocked"
+
+    def enable_shutter(self, *args):
+        self.shutter_mode = True
+        return "Shutter mode Enabled"
+
+    def disable_shutter(self, *args):
+        self.shutter_mode = False
+        return "Shutter mode Disabled"
+
+
+class PFCU(BaseDevice):
+
+    newline = b"\r"
+
+    DEFAULT = {
+        "module_id": 15,
+        "timing": "realistic",
+    }
+
+    def __init__(self, name, **opts):
+        kwargs = {}
+        if "newline" in opts:
+            kwargs["newline"] = opts.pop("newline")
+        self._config = dict(self.DEFAULT, **opts)
+        super().__init__(name, **kwargs)
+        module_opts = {
+            key: value for key, value in self._config.items() if key in Module.DEFAULT
+        }
+        modules = self._config.get("modules") or [self._config["module_id"]]
+        assert len(modules) <= 16
+        self.modules = {}
+        for module in modules:
+            if not isinstance(module, dict):
+                module = dict(module_id=module)
+            module = dict(module_opts, **module)
+            module = Module(self, int(module.pop("module_id")), **module)
+            self.modules[module.module_id] = module
+        self.timing = Timing.from_config(self._config["timing"])
+
+    def broadcast(self, msg):
+        # unsolicited messages are written right after a reply: disable
+        # Nagle on TCP clients or they would be delayed by ~40ms
+        for transport in self.transports:
+            for sock in getattr(transport, "connections", {}).values():
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError:
+                    pass
+        super().broadcast(msg)
+
+    def handle_message(self, line):
+        self._log.debug("request: %r", line)
+        line = line.decode().strip().upper()
+        if not line.startswith("!PFCU"):
+            self._log.warning("ignored invalid request %r", line)
+            return
+        try:
+            addr, cmd, *args = line[5:].split()
+        except ValueError:
+            self._log.warning("ignored invalid request %r", line)
+            return
+        if addr == "ALL":
+            modules = [self.modules[key] for key in sorted(self.modules)]
+        else:
+            try:
+                modules = [self.modules[int(addr)]]
+            except (ValueError, KeyError):
+                self._log.debug("no module %r on the line", addr)
+                return
+        for module in modules:
+            gevent.sleep(self.timing.delay(cmd))
+            result = module.handle(cmd, args).encode() + b"\r\n"
+            self._log.debug("reply: %r", result)
+            yield result
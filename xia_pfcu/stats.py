@@ -0,0 +1,144 @@
+"""
+Protocol instrumentation: counters and latency histograms per module and
+per command, readable as a dict or in prometheus text exposition format.
+"""
+
+import bisect
+import collections
+
+
+# latency histogram buckets (seconds)
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HISTOGRAMS = {
+    "queue_wait": "Time waiting for the line (lock/queue)",
+    "back_pressure": "Time waiting for the minimum gap between commands",
+    "wire": "Time between sending a command and receiving its reply",
+    "decode": "Time decoding a reply",
+    "settle": "Time for a filter to reach its position once acknowledged",
+}
+
+COUNTERS = {
+    "commands": "Commands sent",
+    "errors": "Commands which failed (device error, timeout, connection error)",
+    "timeouts": "Commands without reply in time",
+    "shared": "Queries answered by an identical query already in flight",
+    "cache_hits": "Queries answered from the read cache",
+    "discarded": "Unexpected frames discarded",
+    "resyncs": "Line re-synchronizations (desync recoveries)",
+    "disconnects": "Connections lost",
+    "reconnects": "Connections re-established after being lost",
+    "connect_errors": "Failed (re)connection attempts",
+    "rejected": "Commands failed fast because the line is down",
+}
+
+
+def label_value(value):
+    """Escape a label value (prometheus text exposition format)"""
+    value = str(value)
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            mean=self.sum / self.count if self.count else None,
+            buckets=dict(zip([str(le) for le in BUCKETS] + ["+Inf"], self.counts)),
+        )
+
+
+class Stats:
+    """
+    Counters and latency histograms of a bus, labeled by module and command
+    code (ex: stats.observe("wire", "15", "S", 0.5))
+    """
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+
+    def observe(self, name, module, code, value):
+        self.histograms[name, module, code].observe(value)
+
+    def count(self, name, module, code, n=1):
+        self.counters[name, module, code] += n
+
+    def clear(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    def to_dict(self, modules=None):
+        """{module: {command: {metric: value}}} (of the given modules only)"""
+        result = collections.defaultdict(lambda: collections.defaultdict(dict))
+        for (name, module, code), value in self.counters.items():
+            result[module][code][name] = value
+        for (name, module, code), histogram in self.histograms.items():
+            result[module][code][name] = histogram.to_dict()
+        return {
+            module: dict(codes)
+            for module, codes in result.items()
+            if modules is None or module in modules
+        }
+
+    def prometheus(self, prefix="xia_pfcu", labels=None, modules=None):
+        """Prometheus text exposition format (of the given modules only)"""
+        extra = "".join(
+            ',{}="{}"'.format(key, label_value(value))
+            for key, value in (labels or {}).items()
+        )
+        lines = []
+        for name, doc in COUNTERS.items():
+            metric = "{}_{}_total".format(prefix, name)
+            samples = [
+                (module, code, value)
+                for (n, module, code), value in sorted(self.counters.items())
+                if n == name and (modules is None or module in modules)
+            ]
+            if not samples:
+                continue
+            lines.append("# HELP {} {}".format(metric, doc))
+            lines.append("# TYPE {} counter".format(metric))
+            for module, code, value in samples:
+                label = 'module="{}",command="{}"{}'.format(
+                    label_value(module), label_value(code), extra
+                )
+                lines.append("{}{{{}}} {}".format(metric, label, value))
+        for name, doc in HISTOGRAMS.items():
+            metric = "{}_{}_seconds".format(prefix, name)
+            samples = [
+                (module, code, histogram)
+                for (n, module, code), histogram in sorted(self.histograms.items())
+                if n == name and (modules is None or module in modules)
+            ]
+            if not samples:
+                continue
+            lines.append("# HELP {} {}".format(metric, doc))
+            lines.append("# TYPE {} histogram".format(metric))
+            for module, code, histogram in samples:
+                label = 'module="{}",command="{}"{}'.format(
+                    label_value(module), label_value(code), extra
+                )
+                total = 0
+                for le, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    total += count
+                    lines.append(
+                        '{}_bucket{{{},le="{}"}} {}'.format(metric, label, le, total)
+                    )
+                lines.append("{}_sum{{{}}} {}".format(metric, label, histogram.sum))
+                lines.append("{}_count{{{}}} {}".format(metric, label, histogram.count))
+        return "\n".join(lines) + "\n"
@@ -1,4 +1,5 @@
 import json
+import asyncio
 
 from tango import DevState, GreenMode
 from tango.server import Device, attribute, command, device_property
@@ -7,6 +8,42 @@ from connio import connection_for_url
 import xia_pfcu
 
 
+class BusRegistry:
+    """
+    Process-wide registry of the buses (one per URL) shared by all devices
+    addressing a module on the same line. Buses are reference counted and
+    closed when the last device using them is deleted
+    """
+
+    def __init__(self):
+        self._buses = {}
+
+    def acquire(self, url, **kwargs):
+        entry = self._buses.get(url)
+        if entry is None:
+            bus = xia_pfcu.Bus(connection_for_url(url, **kwargs))
+            entry = self._buses[url] = [bus, 0, kwargs]
+        elif entry[2] != kwargs:
+            # one connection per line: all its devices must agree on it
+            raise ValueError(
+                "{} already open with {} (not {})".format(url, entry[2], kwargs)
+            )
+        entry[1] += 1
+        return entry[0]
+
+    async def release(self, url):
+        entry = self._buses.get(url)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._buses[url]
+            await entry[0].close()
+
+
+BUSES = BusRegistry()
+
+
 class PFCU(Device):
 
     green_mode = GreenMode.Asyncio
@@ -17,6 +54,16 @@ class PFCU(Device):
     parity = device_property(dtype=str, default_value="N")
 
     module = device_property(dtype=str, default_value=xia_pfcu.BROADCAST)
+    polling_period = device_property(dtype=float, default_value=1.0)
+
+    EVENT_ATTRIBUTES = (
+        "State",
+        "Status",
+        "shutter_status",
+        "filters_status",
+        "exclusive_remote_control",
+        "json_status",
+    )
 
     async def init_device(self):
         await super().init_device()
@@ -25,98 +72,166 @@ class PFCU(Device):
             kwargs.update(
                 dict(baudrate=self.baudrate, bytesize=self.bytesize, parity=self.parity)
             )
-        self.connection = connection_for_url(self.url, **kwargs)
-        self.pfcu = xia_pfcu.PFCU(self.connection, module=self.module)
+        # devices on the same line share the same (serialized) bus
+        self.bus = BUSES.acquire(self.url, **kwargs)
+        self.pfcu = self.bus.pfcu(self.module)
+        self.snapshot = None
+        self._snapshot_ready = asyncio.Event()
+        self._poll_now = asyncio.Event()
+        for name in self.EVENT_ATTRIBUTES:
+            self.set_change_event(name, True, False)
+            self.set_archive_event(name, True, False)
+        self._poll_task = asyncio.ensure_future(self._poll_loop())
 
     async def delete_device(self):
-        await self.connection.close()
+        self._poll_task.cancel()
+        await BUSES.release(self.url)
 
-    async def dev_state(self):
+    async def _read_snapshot(self):
         try:
-            status = await self.pfcu.shutter_status()
-        except xia_pfcu.PFCUError as error:
-            if "disabled" in error.args[0].lower():
-                return DevState.DISABLE
-            else:
-                return DevState.FAULT
-        except:
-            return DevState.FAULT
-        if status == xia_pfcu.ShutterStatus.Closed:
-            return DevState.CLOSE
-        elif status == xia_pfcu.ShutterStatus.Open:
-            return DevState.OPEN
-        return DevState.UNKNOWN
+            status = await self.pfcu.status()
+            info = xia_pfcu.PFCUStatus.from_text(status)
+            filters = await self.pfcu.filters_status()
+        except Exception as error:
+            return dict(error=error, State=DevState.FAULT, Status=repr(error))
+        if not info.shutter_enabled:
+            state = DevState.DISABLE
+        elif info.shutter_status == "Closed":
+            state = DevState.CLOSE
+        else:
+            state = DevState.OPEN
+        return dict(
+            error=None,
+            info=info,
+            State=state,
+            Status=status,
+            shutter_status=info.shutter_status,
+            filters_status=[f.name for f in filters],
+            exclusive_remote_control=info.remote_control_only,
+            json_status=json.dumps(info.to_dict()),
+        )
+
+    def _push_changes(self, snapshot, previous):
+        for name in self.EVENT_ATTRIBUTES:
+            value = snapshot.get(name)
+            if value is None or (previous and previous.get(name) == value):
+                continue
+            self.push_change_event(name, value)
+            self.push_archive_event(name, value)
+
+    async def _poll_loop(self):
+        while True:
+            snapshot = await self._read_snapshot()
+            previous, self.snapshot = self.snapshot, snapshot
+            self.set_state(snapshot["State"])
+            self.set_status(snapshot["Status"])
+            try:
+                self._push_changes(snapshot, previous)
+            except Exception:
+                self.error_stream("Error pushing events")
+            self._snapshot_ready.set()
+            self._poll_now.clear()
+            try:
+                await asyncio.wait_for(self._poll_now.wait(), self.polling_period)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _last_snapshot(self):
+        await self._snapshot_ready.wait()
+        snapshot = self.snapshot
+        if snapshot["error"] is not None:
+            raise snapshot["error"]
+        return snapshot
+
+    def _poll(self):
+        """Request an immediate poll (ex: after a command changed the state)"""
+        self._poll_now.set()
+
+    async def dev_state(self):
+        await self._snapshot_ready.wait()
+        return self.snapshot["State"]
 
     async def dev_status(self):
-        try:
-            self.__status = await self.pfcu.status()
-        except Exception as error:
-            self.__status = repr(error)
-        return self.__status
+        await self._snapshot_ready.wait()
+        return self.snapshot["Status"]
 
     @command()
     async def enable_shutter(self):
         await self.pfcu.enable_shutter()
+        self._poll()
 
     @command()
     async def disable_shutter(self):
         await self.pfcu.disable_shutter()
+        self._poll()
 
     @command()
     async def open_shutter(self):
         await self.pfcu.open_shutter()
+        self._poll()
 
     @command()
     async def close_shutter(self):
         await self.pfcu.close_shutter()
+        self._poll()
 
     @command(dtype_in=float)
     async def start_exposure(self, exp_time):
         await self.pfcu.start_exposure(exp_time)
+        self._poll()
 
     @command()
     async def clear_short_error(self):
         await self.pfcu.clear_short_error()
+        self._poll()
 
     @command(dtype_in=int)
     async def insert_filter(self, filt):
         assert 0 < filt < 5
         await self.pfcu.insert_filter(filt)
+        self._poll()
 
     @command(dtype_in=int)
     async def remove_filter(self, filt):
         assert 0 < filt < 5
         await self.pfcu.remove_filter(filt)
+        self._poll()
 
     @attribute(dtype=bool)
     async def exclusive_remote_control(self):
-        info = await self.pfcu.info()
-        return info["remote_control_only"]
+        return (await self._last_snapshot())["exclusive_remote_control"]
 
     @exclusive_remote_control.write
     async def exclusive_remote_control(self, value):
         await (self.pfcu.lock() if value else self.pfcu.unlock())
+        self._poll()
 
     @attribute(dtype=str)
     async def shutter_status(self):
-        try:
-            status = await self.pfcu.shutter_status()
-        except xia_pfcu.PFCUError as error:
-            if "disabled" in error.args[0].lower():
-                return "Disabled"
-            raise
-        return status.name
+        return (await self._last_snapshot())["shutter_status"]
 
     @attribute(dtype=[str], max_dim_x=4)
     async def filters_status(self):
-        status = await self.pfcu.filters_status()
-        return [f.name for f in status]
+        return (await self._last_snapshot())["filters_status"]
 
     @filters_status.write
     async def filters_status(self, value):
         assert len(value) == 4
         await self.pfcu.set_filters(*value)
+        self._poll()
 
     @attribute(dtype=str)
     async def json_status(self):
-        return json.dumps(await self.pfcu.info())
+        return (await self._last_snapshot())["json_status"]
+
+    @attribute(dtype=str, doc="protocol statistics (JSON)")
+    def statistics(self):
+        # (the bus is shared: only the metrics of this module)
+        modules = [self.pfcu.protocol.module]
+        return json.dumps(self.pfcu.protocol.stats.to_dict(modules=modules))
+
+    @attribute(dtype=str, doc="protocol statistics (prometheus text format)")
+    def prometheus_metrics(self):
+        labels = dict(device=self.get_name())
+        modules = [self.pfcu.protocol.module]
+        return self.pfcu.protocol.stats.prometheus(labels=labels, modules=modules)
@@ -0,0 +1,224 @@
+"""
+# Timeline: binary record of the shutter and filter transitions
+
+Fixed size records appended to a memory-mapped ring file: when the file is
+full the oldest records are overwritten. Appending a record costs a
+struct.pack_into on the mmap (no system call, no formatting), so it can
+stay enabled on the command path for weeks:
+
+    bus = bus_for_url(url, eol=b";\\r\\n", timeline=Timeline("pfcu.tl"))
+
+Each record holds the monotonic and wall time, the module, the command
+code ("e" for an End of Exposure message), whether it succeeded and the
+resulting shutter and filters state (when the reply tells it).
+
+Filter commands (W, I, R, Z) are recorded when the device acknowledges
+them, with the filters state it reports then (the filters are still
+moving). When the filters are waited for (see PFCU.wait_filters()) an "f"
+record marks when they were confirmed in position.
+
+Read it back with records() (list of Event) or, for large ranges, load()
+(numpy structured array: `pip install xia-pfcu[timeline]`).
+
+Only one process should write a timeline file at a time.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .protocol import BROADCAST, END_OF_EXPOSURE, FILTERS_SETTLED, ShutterStatus
+
+MAGIC = b"PFCUTL01"
+# magic, record size, capacity, number of records written
+HEADER = struct.Struct("<8sIIQ8x")
+COUNT_OFFSET = 16
+# monotonic, wall time, module, code, ok, shutter, filters
+RECORD = struct.Struct("<ddBcBB4s")
+CAPACITY = 2 ** 20
+
+BROADCAST_MODULE = 255
+UNKNOWN = 255
+NO_FILTERS = b"----"
+
+# shutter state after a successful command (by command code)
+SHUTTER = {
+    "O": ShutterStatus.Open,
+    "C": ShutterStatus.Closed,
+    "E": ShutterStatus.Open,
+    END_OF_EXPOSURE: ShutterStatus.Closed,
+}
+# commands whose reply is the filters status
+FILTERS = ("W", "I", "R", "Z", FILTERS_SETTLED)
+# recorded commands (shutter mode enable/disable included)
+EVENTS = set(SHUTTER) | set(FILTERS) | {"2", "4"}
+
+DTYPE = [
+    ("monotonic", "<f8"),
+    ("time", "<f8"),
+    ("module", "u1"),
+    ("code", "S1"),
+    ("ok", "u1"),
+    ("shutter", "u1"),
+    ("filters", "S4"),
+]
+
+
+class Event(
+    collections.namedtuple(
+        "Event", "monotonic time module code ok shutter filters"
+    )
+):
+    """
+    Decoded timeline record. shutter is a ShutterStatus and filters the
+    filters status (ex: "0010"), or None if the command doesn't tell them
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_record(cls, record):
+        monotonic, wall, module, code, ok, shutter, filters = record
+        return cls(
+            monotonic,
+            wall,
+            BROADCAST if module == BROADCAST_MODULE else "{:02d}".format(module),
+            code.decode(),
+            bool(ok),
+            None if shutter == UNKNOWN else ShutterStatus(shutter),
+            None if filters == NO_FILTERS else filters.decode(),
+        )
+
+
+def _open(path, capacity, create):
+    exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+    if not exists and not create:
+        raise FileNotFoundError(path)
+    fobj = open(path, "r+b" if exists else "w+b")
+    try:
+        if exists:
+            magic, size, capacity, count = HEADER.unpack(fobj.read(HEADER.size))
+            if magic != MAGIC or size != RECORD.size:
+                raise ValueError("{!r} is not a PFCU timeline file".format(path))
+        else:
+            count = 0
+            fobj.truncate(HEADER.size + capacity * RECORD.size)
+            fobj.write(HEADER.pack(MAGIC, RECORD.size, capacity, count))
+            fobj.flush()
+        return fobj, capacity, count
+    except BaseException:
+        fobj.close()
+        raise
+
+
+class Timeline:
+    """
+    Writer of a timeline ring file of the given capacity (number of
+    records). An existing file is appended to (with its own capacity)
+    """
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self._file, self.capacity, self._count = _open(path, capacity, True)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, module, code, ok=True, shutter=None, filters=None):
+        module = BROADCAST_MODULE if module == BROADCAST else int(module)
+        shutter = UNKNOWN if shutter is None else int(shutter)
+        filters = NO_FILTERS if filters is None else filters.encode()
+        with self._lock:
+            offset = HEADER.size + (self._count % self.capacity) * RECORD.size
+            RECORD.pack_into(
+                self._map,
+                offset,
+                time.monotonic(),
+                time.time(),
+                module,
+                code.encode(),
+                ok,
+                shutter,
+                filters,
+            )
+            self._count += 1
+            # written last: readers never see a partially written record
+            struct.pack_into("<Q", self._map, COUNT_OFFSET, self._count)
+
+    def record(self, module, cmd, reply):
+        """
+        Record the given command and its (decoded) reply (None if it
+        failed) if it changes the shutter or filters state
+        """
+        code = cmd[:1]
+        if code not in EVENTS:
+            return
+        if reply is None:
+            self.append(module, code, ok=False)
+        elif code in FILTERS:
+            self.append(module, code, filters=reply[:4])
+        else:
+            self.append(module, code, shutter=SHUTTER.get(code))
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _raw(path):
+    """Records of the ring file (oldest first) as bytes"""
+    fobj, capacity, count = _open(path, 0, False)
+    with fobj, mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as buff:
+        start = HEADER.size
+        if count <= capacity:
+            return buff[start : start + count * RECORD.size]
+        split = start + (count % capacity) * RECORD.size
+        return buff[split:] + buff[start:split]
+
+
+def records(path, since=None, until=None):
+    """
+    Events of the timeline file (oldest first), optionally restricted to
+    the ones which happened between the since and until wall times
+    """
+    events = (Event.from_record(record) for record in RECORD.iter_unpack(_raw(path)))
+    return [
+        event
+        for event in events
+        if (since is None or event.time >= since)
+        and (until is None or event.time < until)
+    ]
+
+
+def load(path, since=None, until=None):
+    """
+    Records of the timeline file (oldest first) as a numpy structured array
+    (see DTYPE), optionally restricted to the given wall time range
+    """
+    import numpy
+
+    array = numpy.frombuffer(_raw(path), dtype=numpy.dtype(DTYPE))
+    if since is not None or until is not None:
+        # wall time is not monotonic (NTP steps): filter, don't bisect
+        mask = numpy.ones(len(array), dtype=bool)
+        if since is not None:
+            mask &= array["time"] >= since
+        if until is not None:
+            mask &= array["time"] < until
+        array = array[mask]
+    return array
@@ -0,0 +1,288 @@
+"""
+# Wire capture and replay
+
+Capture records the exact byte exchange of a session (requests as encoded
+by the protocol, raw replies and unsolicited messages) with their timing
+to a compact binary file. It wraps any connio connection:
+
+    conn = Capture(connection_for_url(url, eol=b";\\r\\n"), "session.wire")
+    pfcu = PFCU(conn)
+
+Replay is an in-memory connection (sync or async, with the connio
+interface used by the protocol) which plays a capture back: each request
+written must match the next recorded one and the frames which followed it
+are delivered with the recorded delays (speed=1), scaled (speed=10: ten
+times faster) or right away (speed=None):
+
+    pfcu = PFCU(Replay("session.wire", speed=None))
+
+so that a session (and its timing pathologies) can be reproduced and
+protocol changes benchmarked against real traffic without the hardware.
+"""
+
+import asyncio
+import collections
+import struct
+import threading
+import time
+
+MAGIC = b"PFCUWIRE"
+# magic, wall time of the start of the capture
+HEADER = struct.Struct("<8sd")
+# kind (b"w": written, b"r": read), time since the start (s), data size
+EVENT = struct.Struct("<cdI")
+WRITE = b"w"
+READ = b"r"
+
+WireEvent = collections.namedtuple("WireEvent", "kind time data")
+
+
+class ReplayError(Exception):
+    pass
+
+
+def read_capture(path):
+    """(start wall time, list of WireEvent) of the given capture file"""
+    with open(path, "rb") as fobj:
+        magic, start = HEADER.unpack(fobj.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{!r} is not a PFCU wire capture".format(path))
+        events = []
+        while True:
+            head = fobj.read(EVENT.size)
+            if len(head) < EVENT.size:
+                break
+            kind, t, size = EVENT.unpack(head)
+            events.append(WireEvent(kind, t, fobj.read(size)))
+    return start, events
+
+
+class CaptureFile:
+    """Appends wire events to a capture file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, time.time()))
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, kind, data):
+        t = time.monotonic() - self._start
+        with self._lock:
+            if self._file.closed:
+                # the connection was re-opened (ex: after a resync)
+                self._file = open(self.path, "ab")
+            self._file.write(EVENT.pack(kind, t, len(data)) + data)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class BaseCapture:
+    """Connection wrapper recording the exchanged bytes (see CaptureFile)"""
+
+    def __init__(self, connection, path):
+        self.conn = connection
+        self.capture = CaptureFile(path)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class AIOCapture(BaseCapture):
+    async def open(self, *args, **kwargs):
+        return await self.conn.open(*args, **kwargs)
+
+    async def close(self):
+        try:
+            await self.conn.close()
+        finally:
+            self.capture.close()
+
+    async def write(self, data):
+        self.capture.add(WRITE, data)
+        return await self.conn.write(data)
+
+    async def readline(self, *args, **kwargs):
+        frame = await self.conn.readline(*args, **kwargs)
+        self.capture.add(READ, frame)
+        return frame
+
+    async def write_readline(self, data, *args, **kwargs):
+        await self.write(data)
+        return await self.readline(*args, **kwargs)
+
+
+class IOCapture(BaseCapture):
+    def open(self, *args, **kwargs):
+        return self.conn.open(*args, **kwargs)
+
+    def close(self):
+        try:
+            self.conn.close()
+        finally:
+            self.capture.close()
+
+    def write(self, data):
+        self.capture.add(WRITE, data)
+        return self.conn.write(data)
+
+    def readline(self, *args, **kwargs):
+        frame = self.conn.readline(*args, **kwargs)
+        self.capture.add(READ, frame)
+        return frame
+
+    def write_readline(self, data, *args, **kwargs):
+        self.write(data)
+        return self.readline(*args, **kwargs)
+
+
+def Capture(connection, path):
+    """Wraps the connection (sync or async) to record its traffic to path"""
+    func = connection.write_readline
+    klass = AIOCapture if asyncio.iscoroutinefunction(func) else IOCapture
+    return klass(connection, path)
+
+
+class BaseReplay:
+    """
+    Connection replaying a capture file (or a list of WireEvent).
+
+    speed scales the recorded delays (None: no delay). If strict is False,
+    recorded requests which don't match the written one are skipped (ex:
+    commands the protocol no longer sends) instead of raising ReplayError.
+    """
+
+    def __init__(self, capture, speed=1.0, strict=True):
+        if isinstance(capture, str):
+            _, capture = read_capture(capture)
+        self.events = list(capture)
+        self.speed = speed
+        self.strict = strict
+        self.is_open = False
+        self._position = 0
+        # frames to deliver: [(monotonic time when available, frame)]
+        self._frames = collections.deque()
+
+    @property
+    def done(self):
+        """True if all the recorded requests have been replayed"""
+        return not any(e.kind == WRITE for e in self.events[self._position :])
+
+    def _delay(self, dt):
+        return 0.0 if not self.speed else dt / self.speed
+
+    def _match(self, data):
+        events, position = self.events, self._position
+        for index in range(position, len(events)):
+            event = events[index]
+            if event.kind != WRITE:
+                continue
+            if event.data == data:
+                return index
+            if self.strict:
+                raise ReplayError(
+                    "Expected {!r}, got {!r}".format(event.data, data)
+                )
+        raise ReplayError("Unexpected request {!r}".format(data))
+
+    def _written(self, data):
+        index = self._match(data)
+        events = self.events
+        now, start = time.monotonic(), events[index].time
+        index += 1
+        while index < len(events) and events[index].kind != WRITE:
+            event = events[index]
+            self._frames.append((now + self._delay(event.time - start), event.data))
+            index += 1
+        self._position = index
+
+    def _available(self):
+        now = time.monotonic()
+        return sum(len(f) for t, f in self._frames if t <= now)
+
+    def _next_delay(self):
+        return max(self._frames[0][0] - time.monotonic(), 0)
+
+
+class AIOReplay(BaseReplay):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._written_event = None
+
+    def _new_frames(self):
+        if self._written_event is None:
+            self._written_event = asyncio.Event()
+        return self._written_event
+
+    async def open(self, *args, **kwargs):
+        self.is_open = True
+
+    async def close(self):
+        self.is_open = False
+
+    async def in_waiting(self):
+        return self._available()
+
+    async def write(self, data):
+        self.is_open = True
+        self._written(data)
+        self._new_frames().set()
+
+    async def readline(self, *args, **kwargs):
+        while not self._frames:
+            event = self._new_frames()
+            event.clear()
+            await event.wait()
+        await asyncio.sleep(self._next_delay())
+        return self._frames.popleft()[1]
+
+    async def write_readline(self, data, *args, **kwargs):
+        await self.write(data)
+        return await self.readline()
+
+
+class IOReplay(BaseReplay):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def open(self, *args, **kwargs):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def in_waiting(self):
+        with self._cond:
+            return self._available()
+
+    def write(self, data):
+        with self._cond:
+            self.is_open = True
+            self._written(data)
+            self._cond.notify_all()
+
+    def readline(self, *args, **kwargs):
+        with self._cond:
+            self._cond.wait_for(lambda: self._frames)
+            delay = self._next_delay()
+        time.sleep(delay)
+        with self._cond:
+            return self._frames.popleft()[1]
+
+    def write_readline(self, data, *args, **kwargs):
+        self.write(data)
+        return self.readline()
+
+
+def Replay(capture, concurrency="async", speed=1.0, strict=True):
+    """
+    Connection replaying the given capture file. concurrency is "async"
+    (default) or "sync" (as in connio.connection_for_url)
+    """
+    klass = IOReplay if concurrency == "sync" else AIOReplay
+    return klass(capture, speed=speed, strict=strict)